@@ -1,23 +1,625 @@
+import base64
+import binascii
 import os
-from flask import Flask, request, abort, jsonify
+from functools import wraps
+from urllib.parse import urlencode
+from flask import Flask, request, abort, Response, stream_with_context, g
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from models import Movie, Actor, setup_db
-from auth import AuthError, requires_auth
+from models import db, Movie, Actor, setup_db, paginate, stream_all, select_columns, insert_batch, upsert_batch, get_rows, get_change_stamps, changes_since, load_related, render_page
+from auth import AuthError, requires_auth, setup_auth, http_client, jwks_cache, token_cache, rejection_cache
+from cache import row_cache, response_cache
+from compression import COMPRESSION, COMPRESSION_MIN_SIZE, COMPRESSION_LEVEL, CompressionMiddleware, accepts_encoding, compress, decompress
+from events import RESET, broadcaster, encode_change, setup_events
+from cooperative import setup_cooperative
+from metrics import registry
+from serialization import JSON_MIMETYPE, get_encoder, api_response, rows_response, json_rows_response, response_mimetype, loads
+
+
+# Page size of the list endpoints when ?limit= is not given
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 50))
+# Largest page the list endpoints return, whatever ?limit= asks for
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 200))
+# Rows fetched (and sent) per chunk by the streaming list endpoints
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 1000))
+# Rows inserted per statement by the bulk create endpoints
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 1000))
+# Serve the public list endpoints from the in-process response cache
+RESPONSE_CACHE = os.environ.get('RESPONSE_CACHE', 'true').lower() == 'true'
+# Have the database render the JSON of the list pages
+DB_JSON_RENDER = os.environ.get('DB_JSON_RENDER', 'false').lower() == 'true'
+
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson',
+                    'application/jsonl')
+
+# Key under which ?include=cast adds the related rows
+CAST_KEYS = {Movie: 'actors', Actor: 'movies'}
 
 
 def create_app(test_config=None):
   # create and configure the app
   app = Flask(__name__)
+  app.config.from_mapping(
+    DEFAULT_PAGE_SIZE=DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE=MAX_PAGE_SIZE,
+    STREAM_BATCH_SIZE=STREAM_BATCH_SIZE,
+    BULK_BATCH_SIZE=BULK_BATCH_SIZE,
+    RESPONSE_CACHE=RESPONSE_CACHE,
+    DB_JSON_RENDER=DB_JSON_RENDER,
+    COMPRESSION=COMPRESSION,
+    COMPRESSION_MIN_SIZE=COMPRESSION_MIN_SIZE,
+    COMPRESSION_LEVEL=COMPRESSION_LEVEL
+  )
+  if test_config is not None:
+    app.config.from_mapping(test_config)
+  # Before the first database connection is opened
+  setup_cooperative(app, shared=[
+    http_client, jwks_cache, token_cache, rejection_cache, row_cache,
+    response_cache, broadcaster, registry])
   with app.app_context():
     setup_db(app)
+  setup_auth(app)
+  setup_events(app)
   CORS(app)
+  if app.config['COMPRESSION']:
+    app.wsgi_app = CompressionMiddleware(app.wsgi_app,
+                                         app.config['COMPRESSION_MIN_SIZE'],
+                                         app.config['COMPRESSION_LEVEL'])
 
   return app
 
 APP = create_app()
 
 
+#----------------------------------------------------------------------------#
+# Helpers
+#----------------------------------------------------------------------------#
+
+'''
+encode_cursor(last_id) / decode_cursor(cursor)
+    the opaque next_cursor handed to clients of the list endpoints;
+    decode_cursor aborts with 400 on anything it did not produce
+'''
+def encode_cursor(last_id):
+    return base64.urlsafe_b64encode(f'id:{last_id}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        prefix, _, last_id = base64.urlsafe_b64decode(
+            cursor.encode()).decode().partition(':')
+        if prefix != 'id':
+            raise ValueError(cursor)
+        return int(last_id)
+    except (ValueError, binascii.Error):
+        abort(400)
+
+
+'''
+encode_change_cursor(position) / decode_change_cursor(cursor)
+    the opaque cursor of the change feed, for a (change_seq, source, id)
+    position; decode_change_cursor aborts with 400 on anything it did
+    not produce
+'''
+def encode_change_cursor(position):
+    return base64.urlsafe_b64encode(
+        ('chg:%d:%d:%d' % position).encode()).decode()
+
+
+def decode_change_cursor(cursor):
+    try:
+        prefix, *position = base64.urlsafe_b64decode(
+            cursor.encode()).decode().split(':')
+        if prefix != 'chg' or len(position) != 3:
+            raise ValueError(cursor)
+        return tuple(int(value) for value in position)
+    except (ValueError, binascii.Error):
+        abort(400)
+
+
+'''
+get_limit()
+    reads ?limit= from the request, clamping it to the server maximum
+    page size
+'''
+def get_limit():
+    try:
+        limit = int(request.args.get('limit',
+                                     APP.config['DEFAULT_PAGE_SIZE']))
+    except ValueError:
+        abort(400)
+    if limit < 1:
+        abort(400)
+    return min(limit, APP.config['MAX_PAGE_SIZE'])
+
+
+'''
+get_page_args()
+    reads ?limit= and ?after= from the request, clamping limit to the
+    server maximum page size
+'''
+def get_page_args():
+    limit = get_limit()
+    after = request.args.get('after')
+    if after is not None:
+        after = decode_cursor(after)
+    return after, limit
+
+
+'''
+get_fields(model)
+    reads ?fields=id,title from the request: the list of columns of
+    model to return, None for all of them; 400 on an unknown column
+'''
+def get_fields(model):
+    fields = request.args.get('fields')
+    if fields is None:
+        return None
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+    try:
+        select_columns(model, fields)
+    except ValueError:
+        abort(400)
+    return fields or None
+
+
+'''
+get_ids_arg()
+    reads ?ids=1,2,3 from the request: the distinct ids, in the order
+    given, or None when absent; 400 on anything but integers or on more
+    ids than the server maximum page size
+'''
+def get_ids_arg():
+    ids = request.args.get('ids')
+    if ids is None:
+        return None
+    try:
+        ids = [int(id) for id in ids.split(',') if id.strip()]
+    except ValueError:
+        abort(400)
+    ids = list(dict.fromkeys(ids))
+    if not ids or len(ids) > APP.config['MAX_PAGE_SIZE']:
+        abort(400)
+    return ids
+
+
+'''
+get_include(model)
+    reads ?include=cast from the request: whether to add the related
+    rows (the actors of movies, the movies of actors); 400 on anything
+    else
+'''
+def get_include(model):
+    include = request.args.get('include')
+    if include is None:
+        return False
+    if include != 'cast':
+        abort(400)
+    return True
+
+
+'''
+with_cast(model, rows)
+    copies of the row dicts of model, which must carry their id, with
+    the related rows added under `actors` or `movies`, all of them read
+    in one query
+'''
+def with_cast(model, rows):
+    key = CAST_KEYS[model]
+    cast = load_related(model, [row['id'] for row in rows])
+    return [dict(row, **{key: cast[row['id']]}) for row in rows]
+
+
+'''
+load_rows(model, ids)
+    the rows of model with these ids as a dict by id, served from the
+    row cache where possible; the misses are read in one IN query. The
+    change stamp of the table is the one read for the ETag, if any
+'''
+def load_rows(model, ids):
+    stamp = g.get('change_stamps', {}).get(model)
+    if stamp is None:
+        stamp = row_cache.stamp(model)
+    rows = {}
+    misses = []
+    for id in ids:
+        row = row_cache.get(model, id, stamp)
+        if row is None:
+            misses.append(id)
+        else:
+            rows[id] = row
+    if misses:
+        for id, row in get_rows(model, misses).items():
+            row_cache.put(model, id, row, stamp)
+            rows[id] = row
+    return rows
+
+
+'''
+get_many(model, key, ids)
+    serves the rows of model with these ids under `key`, in the order
+    asked, listing the ids that have no row under `missing`
+'''
+def get_many(model, key, ids):
+    fields = get_fields(model)
+    include = get_include(model)
+    try:
+        rows = load_rows(model, ids)
+        if include:
+            rows = {row['id']: row for row in with_cast(model, [
+                rows[id] for id in ids if id in rows])}
+    except:
+        abort(422)
+
+    if fields is not None:
+        rows = {id: project(row, fields, include and CAST_KEYS[model])
+                for id, row in rows.items()}
+    return rows_response(
+        key, [rows[id] for id in ids if id in rows],
+        get_row_encoder(model, fields, include).encode_rows,
+        missing=[id for id in ids if id not in rows])
+
+
+def project(row, fields, extra=None):
+    projected = {field: row[field] for field in fields}
+    if extra:
+        projected[extra] = row[extra]
+    return projected
+
+
+'''
+get_row_encoder(model, fields, include)
+    the encoder of the rows of model served with these fields, and with
+    their cast under ?include=cast
+'''
+def get_row_encoder(model, fields, include):
+    if include:
+        related = [related for related in CAST_KEYS if related is not model]
+        return get_encoder(model, fields, (CAST_KEYS[model], related[0]))
+    return get_encoder(model, fields)
+
+
+'''
+get_one(model, key, id)
+    serves the row of model with that id under `key`; 404 when missing
+'''
+def get_one(model, key, id):
+    fields = get_fields(model)
+    include = get_include(model)
+    try:
+        row = load_rows(model, [id]).get(id)
+        if row is not None and include:
+            row = with_cast(model, [row])[0]
+    except:
+        abort(422)
+
+    if row is None:
+        abort(404)
+    if fields is not None:
+        row = project(row, fields, include and CAST_KEYS[model])
+    return rows_response(
+        key, row, get_row_encoder(model, fields, include).encode_row)
+
+
+'''
+get_related(model, id)
+    serves the cast of the movie, or the movies of the actor, with that
+    id; 404 when it does not exist
+'''
+def get_related(model, id):
+    key = CAST_KEYS[model]
+    related_model = model.__mapper__.relationships[key].mapper.class_
+    fields = get_fields(related_model)
+    try:
+        related = None
+        if id in load_rows(model, [id]):
+            related = load_related(model, [id], fields=fields)[id]
+    except:
+        abort(422)
+
+    if related is None:
+        abort(404)
+    return rows_response(
+        key, related, get_encoder(related_model, fields).encode_rows)
+
+
+'''
+cached_response(model)
+    serves a GET endpoint reading model conditionally and from the
+    response cache. The change stamps of the tables shown, read first,
+    give the strong ETag of the response, one per negotiated format: a
+    matching If-None-Match is answered 304 without reading any row.
+    Otherwise the body is looked up in the response cache under the
+    stamp, format, path and normalized query string; only 200 responses
+    are kept and ?stream=true always goes to the endpoint. The X-Cache
+    header tells whether the body came from the cache
+'''
+def cached_response(model):
+    def cached_response_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if request.args.get('stream') == 'true':
+                return f(*args, **kwargs)
+
+            # With the cast, the response also shows the related table
+            models = [model]
+            if get_include(model):
+                models += [related for related in CAST_KEYS
+                           if related is not model]
+            try:
+                stamps = get_change_stamps(models)
+            except:
+                abort(422)
+            # Read for the ETag; the row cache takes them from there
+            g.change_stamps = dict(zip(models, stamps))
+            stamp = '.'.join(str(stamp) for stamp in stamps)
+            mimetype = response_mimetype()
+            etag = f'{model.__tablename__}-{stamp}'
+            if mimetype != JSON_MIMETYPE:
+                etag += '-' + mimetype.rpartition('/')[2]
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                response.headers['Cache-Control'] = 'no-cache'
+                response.vary.add('Accept')
+                return response
+
+            response = None
+            use_cache = APP.config['RESPONSE_CACHE']
+            if use_cache:
+                key = (stamp, mimetype, request.path + '?' + urlencode(
+                    sorted(request.args.items(multi=True))))
+                cached = response_cache.get(model, key)
+                if cached is not None:
+                    body, mimetype, encoding = cached
+                    response = Response(mimetype=mimetype)
+                    response.vary.add('Accept')
+                    set_cached_body(response, body, encoding)
+                    response.headers['X-Cache'] = 'HIT'
+                else:
+                    version = response_cache.version(model)
+
+            if response is None:
+                response = APP.make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                if use_cache:
+                    if not response.is_streamed:
+                        cache_body(model, key, response, version)
+                    response.headers['X-Cache'] = 'MISS'
+
+            # Compressed, the bytes sent differ from the unencoded ones
+            response.set_etag(etag,
+                              weak='Content-Encoding' in response.headers)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return cached_response_decorator
+
+
+'''
+cache_body(model, key, response, version)
+    stores the body of response in the response cache, compressed with
+    gzip when large enough to be sent compressed, so that it is
+    compressed once rather than on every hit; gives the response the
+    compressed body when the client accepts gzip
+'''
+def cache_body(model, key, response, version):
+    body = response.get_data()
+    encoding = None
+    if (APP.config['COMPRESSION'] and
+            len(body) >= APP.config['COMPRESSION_MIN_SIZE']):
+        encoding = 'gzip'
+        body = compress(body, encoding, APP.config['COMPRESSION_LEVEL'])
+    response_cache.put(model, key, body, response.mimetype, version, encoding)
+    if encoding is not None:
+        set_cached_body(response, body, encoding)
+
+
+'''
+set_cached_body(response, body, encoding)
+    gives response a body kept by the response cache: as it is when the
+    client accepts its encoding, decompressed otherwise
+'''
+def set_cached_body(response, body, encoding):
+    if encoding is not None:
+        response.vary.add('Accept-Encoding')
+        if accepts_encoding(request.headers.get('Accept-Encoding'), encoding):
+            response.headers['Content-Encoding'] = encoding
+        else:
+            body = decompress(body, encoding)
+    response.set_data(body)
+
+
+'''
+list_page(model, key)
+    serves one keyset-paginated page of model under `key`, with their
+    cast under ?include=cast for one more query per page; 404 when the
+    table is empty
+'''
+def list_page(model, key):
+    after, limit = get_page_args()
+    fields = get_fields(model)
+    include = get_include(model)
+    if APP.config['DB_JSON_RENDER'] and response_mimetype() == JSON_MIMETYPE:
+        return rendered_page(model, key, after, limit, fields, include)
+    try:
+        if include and fields is not None and 'id' not in fields:
+            # The cast is matched to the rows by id
+            rows, next_after = paginate(model, after=after, limit=limit,
+                                        fields=fields + ['id'])
+            rows = with_cast(model, rows)
+            for row in rows:
+                del row['id']
+        else:
+            rows, next_after = paginate(model, after=after, limit=limit,
+                                        fields=fields)
+            if include:
+                rows = with_cast(model, rows)
+    except:
+        abort(422)
+
+    if len(rows) == 0 and after is None:
+        abort(404)
+    return rows_response(
+        key, rows, get_row_encoder(model, fields, include).encode_rows,
+        next_cursor=None if next_after is None else encode_cursor(next_after))
+
+
+'''
+rendered_page(model, key, after, limit, fields, include)
+    list_page with the JSON of the rows rendered by the database and
+    passed into the response as is; only used for JSON responses
+'''
+def rendered_page(model, key, after, limit, fields, include):
+    try:
+        rows_json, count, next_after = render_page(
+            model, after=after, limit=limit, fields=fields, include=include)
+    except:
+        abort(422)
+
+    if count == 0 and after is None:
+        abort(404)
+    return json_rows_response(
+        key, rows_json.encode('utf-8'),
+        next_cursor=None if next_after is None else encode_cursor(next_after))
+
+
+'''
+stream_list(model, key)
+    serves every row of model as one JSON document produced
+    incrementally: rows are read through a server-side cursor and sent
+    in chunks of STREAM_BATCH_SIZE, so memory use does not depend on
+    the size of the table; 404 when the table is empty. Always JSON, as
+    a MessagePack array needs its length up front
+'''
+def stream_list(model, key):
+    batch_size = APP.config['STREAM_BATCH_SIZE']
+    fields = get_fields(model)
+    if get_include(model):
+        abort(400)
+    try:
+        rows = stream_all(model, batch_size=batch_size, fields=fields)
+        first = next(rows, None)
+    except:
+        abort(422)
+
+    if first is None:
+        abort(404)
+    encoder = get_encoder(model, fields)
+
+    def generate():
+        yield b'{"success":true,"%s":[' % key.encode()
+        chunk = [first]
+        separator = b''
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == batch_size:
+                yield separator + encoder.encode_items(chunk)
+                separator = b','
+                chunk = []
+        if chunk:
+            yield separator + encoder.encode_items(chunk)
+        yield b']}\n'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
+
+
+'''
+read_bulk_body()
+    iterates over the objects of a bulk request body: a JSON array, or
+    NDJSON (one object per line) read line by line from the request
+    stream. Lines that are not valid JSON are yielded as ValueError.
+'''
+def read_bulk_body():
+    if request.mimetype in NDJSON_MIMETYPES:
+        for line in request.stream:
+            line = line.strip()
+            if line:
+                try:
+                    yield loads(line)
+                except ValueError:
+                    yield ValueError('invalid JSON')
+        return
+
+    body = request.get_json(silent=True)
+    if not isinstance(body, list):
+        abort(400)
+    yield from body
+
+
+'''
+bulk_create(model, key)
+    validates the rows of a bulk request as they are read and inserts
+    the valid ones in batches of BULK_BATCH_SIZE; answers with the number
+    of rows created and the index and reason of every rejected row.
+    With ?upsert=true (movies only) existing titles are updated instead
+    of rejected, and counted apart.
+'''
+def bulk_create(model, key):
+    batch_size = APP.config['BULK_BATCH_SIZE']
+    upsert = get_upsert_flag(model)
+    created = 0
+    updated = 0
+    failed = []
+    batch = []
+    count = 0
+
+    def flush(batch):
+        nonlocal updated
+        if upsert:
+            failures, batch_updated = upsert_batch(model, batch)
+            updated += batch_updated
+        else:
+            failures, batch_updated = insert_batch(model, batch), 0
+        failed.extend({'index': index, 'error': error}
+                      for index, error in failures)
+        return len(batch) - len(failures) - batch_updated
+
+    for index, body in enumerate(read_bulk_body()):
+        count += 1
+        try:
+            if isinstance(body, ValueError):
+                raise body
+            batch.append((index, model.parse(body)))
+        except ValueError as error:
+            failed.append({'index': index, 'error': str(error)})
+            continue
+        if len(batch) == batch_size:
+            created += flush(batch)
+            batch = []
+    if batch:
+        created += flush(batch)
+
+    if count == 0:
+        abort(400)
+    results = {
+        'received': count,
+        'created': created,
+        'failed': sorted(failed, key=lambda failure: failure['index'])
+    }
+    if upsert:
+        results['updated'] = updated
+    return api_response({
+        'success': True,
+        key: results
+    })
+
+
+'''
+get_upsert_flag(model)
+    reads ?upsert=true from the request; 400 for models without a
+    natural key to upsert on
+'''
+def get_upsert_flag(model):
+    if request.args.get('upsert') != 'true':
+        return False
+    if not hasattr(model, 'upsert'):
+        abort(400)
+    return True
+
+
 #----------------------------------------------------------------------------#
 # Routes
 #----------------------------------------------------------------------------#
@@ -25,69 +627,162 @@ APP = create_app()
 '''
 API endpoint to handle GET requests for details of all Movies
 This endpoint will be accessible to all persons
+Results are paginated: ?limit= sets the page size and ?after= takes the
+next_cursor of the previous page; ?stream=true sends all Movies at once
+?fields=id,title restricts the columns returned
+?ids=1,2,3 fetches those Movies only, in one query
+?include=cast adds the Actors of each Movie, in one more query
+Responses are kept in the response cache until Movies (and, with the
+cast, Actors) change and carry
+an ETag: a matching If-None-Match is answered 304 Not Modified
 '''
 @APP.route('/movies', methods=['GET'])
+@cached_response(Movie)
 def get_movies():
-    try:
-        movies = Movie.query.all()
-        if len(movies) == 0:
-            abort(404)
-        else:
-            movies_list = [movie.format() for movie in movies]
-            return jsonify({
-                'success': True,
-                'movies': movies_list
-            }), 200
-    except:
-        abort(422)
+    ids = get_ids_arg()
+    if ids is not None:
+        return get_many(Movie, 'movies', ids)
+    if request.args.get('stream') == 'true':
+        return stream_list(Movie, 'movies')
+    return list_page(Movie, 'movies')
+
+
+'''
+API endpoint to handle GET requests for the details of one Movie
+This endpoint will be accessible to all persons
+?fields=id,title restricts the columns returned
+?include=cast adds its Actors
+'''
+@APP.route('/movies/<int:id>', methods=['GET'])
+def get_movie(id):
+    return get_one(Movie, 'movies', id)
 
 
 '''
 API endpoint to handle GET requests for details of all Actors
 This endpoint will be accessible to all persons
+Results are paginated: ?limit= sets the page size and ?after= takes the
+next_cursor of the previous page; ?stream=true sends all Actors at once
+?fields=id,name restricts the columns returned
+?ids=1,2,3 fetches those Actors only, in one query
+?include=cast adds the Movies of each Actor, in one more query
+Responses are kept in the response cache until Actors (and, with the
+cast, Movies) change and carry
+an ETag: a matching If-None-Match is answered 304 Not Modified
 '''
 @APP.route('/actors', methods=['GET'])
+@cached_response(Actor)
 def get_actors():
+    ids = get_ids_arg()
+    if ids is not None:
+        return get_many(Actor, 'actors', ids)
+    if request.args.get('stream') == 'true':
+        return stream_list(Actor, 'actors')
+    return list_page(Actor, 'actors')
+
+
+'''
+API endpoint to handle GET requests for the details of one Actor
+This endpoint will be accessible to all persons
+?fields=id,name restricts the columns returned
+?include=cast adds its Movies
+'''
+@APP.route('/actors/<int:id>', methods=['GET'])
+def get_actor(id):
+    return get_one(Actor, 'actors', id)
+
+
+'''
+API endpoint to handle GET requests for the cast of a Movie
+This endpoint will be accessible to all persons
+?fields=id,name restricts the columns returned
+'''
+@APP.route('/movies/<int:id>/actors', methods=['GET'])
+def get_movie_actors(id):
+    return get_related(Movie, id)
+
+
+'''
+API endpoint to handle GET requests for the Movies of an Actor
+This endpoint will be accessible to all persons
+?fields=id,title restricts the columns returned
+'''
+@APP.route('/actors/<int:id>/movies', methods=['GET'])
+def get_actor_movies(id):
+    return get_related(Actor, id)
+
+
+'''
+API endpoint to set the cast of a Movie, from {"actors": [1, 2, 3]}
+This endpoint will be accessible to only authorized persons
+'''
+@APP.route('/movies/<int:id>/actors', methods=['PUT'])
+@requires_auth('patch:movies')
+def set_movie_actors(token, id):
+    body = request.get_json(silent=True)
+    actor_ids = body.get('actors') if isinstance(body, dict) else None
+    if not isinstance(actor_ids, list) or not all(
+            isinstance(actor_id, int) and not isinstance(actor_id, bool)
+            for actor_id in actor_ids):
+        abort(400)
+
     try:
-        actors = Actor.query.all()
-        if len(actors) == 0:
-            abort(404)
-        else:
-            actors_list = [actor.format() for actor in actors]
-            return jsonify({
-                'success': True,
-                'actors': actors_list
-            }), 200
+        found = Movie.set_cast(id, actor_ids)
     except:
+        db.session.rollback()
         abort(422)
 
+    if not found:
+        abort(404)
+    return api_response({
+        'success': True,
+        'actors': load_related(Movie, [id])[id]
+    })
+
 
 '''
 API endpoint to Create a new Movie
 This endpoint will be accessible to only authorized persons
+With ?upsert=true an existing title is updated instead of rejected, in
+the same single statement, and `created` tells which happened
 '''
 @APP.route('/movies', methods=['POST'])
 @requires_auth('post:movies')
 def create_movie(token):
-    body = request.get_json()
-
-    if 'title' in body and 'release_date' in body:
-        movie_title = body.get('title')
-        movie_release_date = body.get('release_date')
-        new_movie = Movie(
-            title = movie_title,
-            recipe = movie_release_date
-        )
+    body = request.get_json(silent=True)
+
+    try:
+        values = Movie.parse(body)
+    except ValueError:
+        abort(400)
+
+    if get_upsert_flag(Movie):
         try:
-            new_movie.insert()
-            return jsonify({
-                'success': True,
-                'movies': new_movie.format()
-            }), 200
+            stored = Movie.upsert([values])[values['title']]
+            db.session.commit()
         except:
+            db.session.rollback()
             abort(422)
-    else:
-        abort(400)
+        created = stored.pop('created')
+        return api_response({
+            'success': True,
+            'movies': stored,
+            'created': created
+        })
+
+    new_movie = Movie(
+        title = values['title'],
+        release_date = values['release_date']
+    )
+    try:
+        new_movie.insert()
+        return api_response({
+            'success': True,
+            'movies': new_movie.format()
+        })
+    except:
+        db.session.rollback()
+        abort(422)
 
 
 '''
@@ -97,28 +792,48 @@ This endpoint will be accessible to only authorized persons
 @APP.route('/actors', methods=['POST'])
 @requires_auth('post:actors')
 def create_actor(token):
-    body = request.get_json()
-
-    if 'name' in body:
-        actor_name = body.get('name')
-        actor_age = body.get('age')
-        actor_gender = body.get('gender')
-        new_actor = Actor(
-            name = actor_name,
-            age = actor_age,
-            gender = actor_gender
-        )
-        try:
-            new_actor.insert()
-            return jsonify({
-                'success': True,
-                'actors': new_actor.format()
-            }), 200
-        except:
-            abort(422)
-    else:
+    body = request.get_json(silent=True)
+
+    try:
+        values = Actor.parse(body)
+    except ValueError:
         abort(400)
 
+    new_actor = Actor(
+        name = values['name'],
+        age = values['age'],
+        gender = values['gender']
+    )
+    try:
+        new_actor.insert()
+        return api_response({
+            'success': True,
+            'actors': new_actor.format()
+        })
+    except:
+        db.session.rollback()
+        abort(422)
+
+
+'''
+API endpoint to Create Movies in bulk, from a JSON array or an NDJSON body
+This endpoint will be accessible to only authorized persons
+'''
+@APP.route('/movies/bulk', methods=['POST'])
+@requires_auth('post:movies')
+def create_movies_bulk(token):
+    return bulk_create(Movie, 'movies')
+
+
+'''
+API endpoint to Create Actors in bulk, from a JSON array or an NDJSON body
+This endpoint will be accessible to only authorized persons
+'''
+@APP.route('/actors/bulk', methods=['POST'])
+@requires_auth('post:actors')
+def create_actors_bulk(token):
+    return bulk_create(Actor, 'actors')
+
 
 '''
 API endpoint to Update an existing Movie data
@@ -127,26 +842,30 @@ This endpoint will be accessible to only authorized persons
 @APP.route('/movies/<int:id>', methods=['PATCH'])
 @requires_auth('patch:movies')
 def update_movie(token, id):
-    body = request.get_json()
+    body = request.get_json(silent=True)
 
     try:
-        # Get the Movie to be updated
-        existing_movie = Movie.query.get(id)
-        
-        if existing_movie is None:
-            abort(404)
-        else:
-            existing_movie.title = body.get('title')
-            existing_movie.release_date = body.get('release_date')
-            existing_movie.update()
-            return jsonify({
-                'success': True,
-                'movies': existing_movie.format()
-            }), 200
-    
+        # Only the fields present in the body are updated
+        values = Movie.parse(body, partial=True)
+    except ValueError:
+        abort(400)
+
+    try:
+        # A single UPDATE ... RETURNING, no prior SELECT, and no write
+        # at all when the stored values already match
+        updated_movie, modified = Movie.update_by_id(id, values)
     except:
+        db.session.rollback()
         abort(422)
 
+    if updated_movie is None:
+        abort(404)
+    return api_response({
+        'success': True,
+        'movies': updated_movie,
+        'modified': modified
+    })
+
 
 '''
 API endpoint to Update an existing Actor data
@@ -155,27 +874,30 @@ This endpoint will be accessible to only authorized persons
 @APP.route('/actors/<int:id>', methods=['PATCH'])
 @requires_auth('patch:actors')
 def update_actor(token, id):
-    body = request.get_json()
+    body = request.get_json(silent=True)
 
     try:
-        # Get the Actor to be updated
-        existing_actor = Actor.query.get(id)
-        
-        if existing_actor is None:
-            abort(404)
-        else:
-            existing_actor.name = body.get('name')
-            existing_actor.age = body.get('age')
-            existing_actor.gender = body.get('gender')
-            existing_actor.update()
-            return jsonify({
-                'success': True,
-                'actors': existing_actor.format()
-            }), 200
-    
+        # Only the fields present in the body are updated
+        values = Actor.parse(body, partial=True)
+    except ValueError:
+        abort(400)
+
+    try:
+        # A single UPDATE ... RETURNING, no prior SELECT, and no write
+        # at all when the stored values already match
+        updated_actor, modified = Actor.update_by_id(id, values)
     except:
+        db.session.rollback()
         abort(422)
 
+    if updated_actor is None:
+        abort(404)
+    return api_response({
+        'success': True,
+        'actors': updated_actor,
+        'modified': modified
+    })
+
 
 '''
 API endpoint to Delete a Movie
@@ -185,17 +907,18 @@ This endpoint will be accessible to only authorized persons
 @requires_auth('delete:movies')
 def delete_movie(token, id):
     try:
-        movie = Movie.query.filter(Movie.id == id).one_or_none()
-        if movie is None:
-            abort(404)
-        movie.delete()
-        return jsonify({
-            'success': True,
-            'delete': id
-        }), 200
+        deleted = Movie.delete_by_id(id)
     except:
+        db.session.rollback()
         abort(422)
 
+    if not deleted:
+        abort(404)
+    return api_response({
+        'success': True,
+        'delete': id
+    })
+
 
 '''
 API endpoint to Delete an Actor
@@ -205,17 +928,149 @@ This endpoint will be accessible to only authorized persons
 @requires_auth('delete:actors')
 def delete_actor(token, id):
     try:
-        actor = Actor.query.filter(Actor.id == id).one_or_none()
-        if actor is None:
-            abort(404)
-        actor.delete()
-        return jsonify({
-            'success': True,
-            'delete': id
-        }), 200
+        deleted = Actor.delete_by_id(id)
     except:
+        db.session.rollback()
         abort(422)
 
+    if not deleted:
+        abort(404)
+    return api_response({
+        'success': True,
+        'delete': id
+    })
+
+
+'''
+API endpoint to handle GET requests for the changes to Movies and Actors
+This endpoint will be accessible to all persons
+Returns the changes made after ?since=, the next_cursor of a previous
+call (from the beginning without it), oldest first: upserts carry the
+row, deletes only the id. ?limit= sets the page size; has_more tells
+whether to call again right away with next_cursor
+'''
+@APP.route('/changes', methods=['GET'])
+def get_changes():
+    limit = get_limit()
+    since = request.args.get('since')
+    if since is not None:
+        since = decode_change_cursor(since)
+    try:
+        changes, position, more = changes_since(since, limit)
+    except:
+        abort(422)
+
+    return api_response({
+        'success': True,
+        'changes': changes,
+        'next_cursor': encode_change_cursor(position),
+        'has_more': more
+    })
+
+
+'''
+sse_event(position, op, data)
+    one Server-Sent Event carrying a change, its id being the change
+    feed cursor to resume after it
+'''
+def sse_event(position, op, data):
+    return b'id: %s\nevent: %s\ndata: %s\n\n' % (
+        encode_change_cursor(position).encode(), op.encode(), data)
+
+
+'''
+change_stream(subscription, replay, last)
+    the body of a change stream: the replayed events, then the changes
+    published to the subscription, with a comment line after each
+    heartbeat interval of silence. A subscriber that fell behind gets a
+    `reset` event carrying the cursor to resume from with /changes, and
+    the stream ends. The subscription is dropped when the client goes
+    away, even before the body was started.
+'''
+def change_stream(subscription, replay, last):
+    heartbeat = APP.config['SSE_HEARTBEAT_INTERVAL']
+
+    def generate():
+        nonlocal last
+        try:
+            yield b'retry: 3000\n\n'
+            for position, op, data in replay:
+                yield sse_event(position, op, data)
+                last = position
+            while True:
+                event = subscription.get(timeout=heartbeat)
+                if event is None:
+                    yield b': heartbeat\n\n'
+                    continue
+                if event is RESET:
+                    yield b'event: reset\ndata: %s\n\n' % encode_change({
+                        'since': None if last is None
+                        else encode_change_cursor(last)
+                    })
+                    return
+                position, op, data = event
+                if last is not None and position <= last:
+                    continue
+                yield sse_event(position, op, data)
+                last = position
+        finally:
+            broadcaster.unsubscribe(subscription)
+
+    response = Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # The finally of generate() only runs once it was started
+    response.call_on_close(lambda: broadcaster.unsubscribe(subscription))
+    return response
+
+
+'''
+API endpoint streaming the changes to Movies and Actors as Server-Sent
+Events (`upsert` and `delete`, with the same data as /changes)
+This endpoint will be accessible to all persons
+A reconnecting client sending Last-Event-ID first gets what it missed.
+Each subscriber holds a connection, and would hold a whole sync worker
+until it timed out: outside cooperative (gevent) workers, 503 is sent
+'''
+@APP.route('/stream/changes', methods=['GET'])
+def stream_changes():
+    if not APP.config['COOPERATIVE']:
+        abort(503)
+    last = request.headers.get('Last-Event-ID')
+    if last is not None:
+        last = decode_change_cursor(last)
+    try:
+        subscription = broadcaster.subscribe()
+    except:
+        abort(422)
+
+    replay = []
+    if last is not None:
+        try:
+            changes, _, more = changes_since(
+                last, broadcaster.buffer_size, positions=True)
+        except:
+            broadcaster.unsubscribe(subscription)
+            abort(422)
+        replay = [(change.pop('position'), change['op'],
+                   encode_change(change)) for change in changes]
+        if more:
+            # Too far behind to replay: resync from /changes
+            subscription.reset()
+    return change_stream(subscription, replay, last)
+
+
+'''
+API endpoint to report the in-process metrics of this worker
+'''
+@APP.route('/metrics', methods=['GET'])
+def get_metrics():
+    return api_response({
+        'success': True,
+        'metrics': registry.snapshot()
+    })
+
 
 #----------------------------------------------------------------------------#
 # Error Handlers
@@ -226,11 +1081,11 @@ Example error handling for unprocessable entity
 '''
 @APP.errorhandler(422)
 def unprocessable(error):
-    return jsonify({
+    return api_response({
         "success": False,
         "error": 422,
         "message": "Unprocessable"
-    }), 422
+    }, 422)
 
 
 '''
@@ -238,11 +1093,11 @@ Error Handler for Resource Not Found Error
 '''
 @APP.errorhandler(404)
 def not_found(error):
-    return jsonify({
+    return api_response({
         "success": False,
         "error": 404,
         "message": "Resource Not Found"
-    }), 404
+    }, 404)
 
 
 '''
@@ -250,11 +1105,23 @@ Error Handler for Bad Request Error
 '''
 @APP.errorhandler(400)
 def bad_request(error):
-    return jsonify({
+    return api_response({
         "success": False,
         "error": 400,
         "message": "Bad Request"
-    }), 400
+    }, 400)
+
+
+'''
+Error Handler for Service Unavailable Error
+'''
+@APP.errorhandler(503)
+def service_unavailable(error):
+    return api_response({
+        "success": False,
+        "error": 503,
+        "message": "Service Unavailable"
+    }, 503)
 
 
 '''
@@ -262,11 +1129,11 @@ Error Handler for AuthError
 '''
 @APP.errorhandler(AuthError)
 def authentication_problem(error):
-    return jsonify({
+    return api_response({
         "success": False,
         "error": error.status_code,
         "message": error.error.get('description')
-    }), error.status_code
+    }, error.status_code)
 
 
 if __name__ == '__main__':
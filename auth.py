@@ -1,13 +1,60 @@
+import base64
+import binascii
+import hashlib
+import http.client
 import json
-from flask import request, _request_ctx_stack
+import logging
+import os
+import re
+import threading
+import time
+from flask import g, request, _request_ctx_stack
+from collections import OrderedDict
 from functools import wraps
-from jose import jwt
-from urllib.request import urlopen
+import rsa
+from jose import jwk, jwt
+from urllib.parse import urlsplit
+from metrics import registry
+
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding, rsa as crypto_rsa
+except ImportError:  # optional native backend
+    crypto_rsa = None
 # import pdb
 
+logger = logging.getLogger(__name__)
+
 AUTH0_DOMAIN = 'balanafsnd.us.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'CoffeeShop'
+JWKS_URL = f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
+
+# Seconds a fetched key set is trusted when Auth0 sends no Cache-Control max-age
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 600))
+# Minimum seconds between refreshes forced by tokens carrying an unknown kid
+JWKS_MIN_REFRESH_INTERVAL = int(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+# Seconds to wait before retrying after a failed JWKS download
+JWKS_RETRY_INTERVAL = int(os.environ.get('JWKS_RETRY_INTERVAL', 30))
+# Seconds the last good key set may still be used while downloads fail
+JWKS_STALE_IF_ERROR = int(os.environ.get('JWKS_STALE_IF_ERROR', 86400))
+# Seconds before expiry at which the background thread refreshes the keys
+JWKS_REFRESH_AHEAD = int(os.environ.get('JWKS_REFRESH_AHEAD', 60))
+JWKS_FETCH_TIMEOUT = float(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+JWKS_PREFETCH = os.environ.get('JWKS_PREFETCH', 'true').lower() == 'true'
+JWKS_BACKGROUND_REFRESH = \
+    os.environ.get('JWKS_BACKGROUND_REFRESH', 'true').lower() == 'true'
+# Maximum number of verified tokens remembered by requires_auth
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
+# Seconds a rejected token is answered from the rejection cache
+TOKEN_REJECTION_TTL = int(os.environ.get('TOKEN_REJECTION_TTL', 30))
+TOKEN_REJECTION_CACHE_SIZE = \
+    int(os.environ.get('TOKEN_REJECTION_CACHE_SIZE', 10000))
+# Record per-stage timings of requires_auth and send them as Server-Timing
+AUTH_TIMING = os.environ.get('AUTH_TIMING', 'true').lower() == 'true'
+# Name of the RS256 signature backend, the fastest available one if unset
+JWT_SIGNATURE_BACKEND = os.environ.get('JWT_SIGNATURE_BACKEND')
 
 ## AuthError Exception
 '''
@@ -20,6 +67,527 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+'''
+b64url_decode(segment)
+    decodes unpadded base64url, as used by JWT segments and JWK members
+'''
+def b64url_decode(segment):
+    if isinstance(segment, str):
+        segment = segment.encode('ascii')
+    return base64.urlsafe_b64decode(segment + b'=' * (-len(segment) % 4))
+
+
+## Signature Backends
+'''
+Signature backends
+    verify RS256 signatures against public keys built once per JWKS
+    key. Each backend exposes
+        load_key(rsa_key)  the JWK dict -> a reusable public key object
+        verify(public_key, signing_input, signature)  -> True / False
+'''
+class CryptographyBackend:
+    name = 'cryptography'
+
+    @staticmethod
+    def available():
+        return crypto_rsa is not None
+
+    def load_key(self, rsa_key):
+        return crypto_rsa.RSAPublicNumbers(
+            int.from_bytes(b64url_decode(rsa_key['e']), 'big'),
+            int.from_bytes(b64url_decode(rsa_key['n']), 'big')
+        ).public_key()
+
+    def verify(self, public_key, signing_input, signature):
+        try:
+            public_key.verify(signature, signing_input, padding.PKCS1v15(),
+                              hashes.SHA256())
+        except InvalidSignature:
+            return False
+        return True
+
+
+class PythonRSABackend:
+    name = 'rsa'
+
+    @staticmethod
+    def available():
+        return True
+
+    def load_key(self, rsa_key):
+        return rsa.PublicKey(
+            int.from_bytes(b64url_decode(rsa_key['n']), 'big'),
+            int.from_bytes(b64url_decode(rsa_key['e']), 'big')
+        )
+
+    def verify(self, public_key, signing_input, signature):
+        try:
+            # RS256 requires a SHA-256 DigestInfo, not any hash rsa accepts
+            return rsa.verify(signing_input, signature, public_key) == 'SHA-256'
+        except rsa.VerificationError:
+            return False
+
+
+class JoseBackend:
+    name = 'jose'
+
+    @staticmethod
+    def available():
+        return True
+
+    def load_key(self, rsa_key):
+        return jwk.construct(rsa_key, ALGORITHMS[0])
+
+    def verify(self, public_key, signing_input, signature):
+        try:
+            return public_key.verify(signing_input, signature)
+        except Exception:
+            return False
+
+
+# Fastest first
+SIGNATURE_BACKENDS = {
+    backend.name: backend
+    for backend in (CryptographyBackend, PythonRSABackend, JoseBackend)
+}
+
+
+'''
+get_signature_backend(name)
+    returns an instance of the named backend, or of the fastest one
+    installed when name is None
+'''
+def get_signature_backend(name=None):
+    if name is not None:
+        backend = SIGNATURE_BACKENDS.get(name)
+        if backend is None or not backend.available():
+            raise ValueError(f'signature backend {name} is not available')
+        return backend()
+    for backend in SIGNATURE_BACKENDS.values():
+        if backend.available():
+            return backend()
+
+
+signature_backend = get_signature_backend(JWT_SIGNATURE_BACKEND)
+
+
+## JWKS Cache
+'''
+KeepAliveClient
+    a minimal HTTP(S) client keeping a small pool of persistent
+    connections per host, so periodic JWKS refreshes reuse one TLS
+    session instead of opening a new connection every time
+'''
+class KeepAliveClient:
+    def __init__(self, timeout=JWKS_FETCH_TIMEOUT, max_idle=2):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, scheme, netloc):
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _checkout(self, scheme, netloc):
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+        return self._connect(scheme, netloc), False
+
+    def _checkin(self, scheme, netloc, connection):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    '''
+    get(url)
+        returns (status, headers, body); a request failing on a reused
+        connection (closed by the server while idle) is retried once on
+        a fresh one
+    '''
+    def get(self, url):
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        connection, reused = self._checkout(parts.scheme, parts.netloc)
+        while True:
+            try:
+                connection.request('GET', path,
+                                   headers={'Accept': 'application/json'})
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, ConnectionError):
+                connection.close()
+                if not reused:
+                    raise
+                connection = self._connect(parts.scheme, parts.netloc)
+                reused = False
+                continue
+            except Exception:
+                connection.close()
+                raise
+
+            if response.will_close:
+                connection.close()
+            else:
+                self._checkin(parts.scheme, parts.netloc, connection)
+            return response.status, response.headers, body
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+http_client = KeepAliveClient()
+
+
+'''
+fetch_jwks(url)
+    downloads the JWKS document and returns it together with the
+    max-age (in seconds) announced by its Cache-Control header, or None
+'''
+def fetch_jwks(url=JWKS_URL):
+    status, headers, body = http_client.get(url)
+    if status != 200:
+        raise IOError(f'JWKS request to {url} failed with HTTP {status}')
+    jwks = json.loads(body)
+    return jwks, parse_max_age(headers.get('Cache-Control'))
+
+
+'''
+parse_max_age(cache_control)
+    returns the max-age directive of a Cache-Control header value,
+    0 for no-cache / no-store, and None when the header says nothing
+'''
+def parse_max_age(cache_control):
+    if not cache_control:
+        return None
+
+    for directive in cache_control.split(','):
+        name, _, value = directive.strip().partition('=')
+        name = name.lower()
+        if name in ('no-cache', 'no-store'):
+            return 0
+        if name == 'max-age':
+            try:
+                return max(int(value.strip('" ')), 0)
+            except ValueError:
+                return None
+    return None
+
+
+'''
+JWKSCache
+    a process-wide cache of the Auth0 signing keys, indexed by kid.
+    The key set is re-fetched once it expires (after the Cache-Control
+    max-age, or `ttl` seconds by default). A token carrying a kid that is
+    not in the cache forces a refresh, at most once per
+    `min_refresh_interval` seconds, so key rotation is picked up without
+    letting forged kids trigger a download per request.
+    When a refresh fails the last good key set keeps being served for up
+    to `stale_if_error` seconds, and the next attempt is delayed by
+    `retry_interval` seconds.
+'''
+class JWKSCache:
+    def __init__(self, fetcher=fetch_jwks, ttl=JWKS_CACHE_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 retry_interval=JWKS_RETRY_INTERVAL,
+                 stale_if_error=JWKS_STALE_IF_ERROR,
+                 clock=time.monotonic):
+        self.fetcher = fetcher
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.retry_interval = retry_interval
+        self.stale_if_error = stale_if_error
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._keys = {}
+        self._signature_sizes = {}
+        self._public_keys = {}
+        self._expires_at = None
+        self._fetched_at = None
+        self._attempted_at = None
+        self.current_ttl = ttl
+        self.last_refresh_failed = False
+
+    '''
+    get_key(kid)
+        returns the RSA key matching kid, or None when the current
+        Auth0 key set does not contain it. Lookups in a fresh key set
+        do not take the lock; only the request that finds it expired
+        (or misses a kid) refreshes it, the others wait for the result.
+    '''
+    def get_key(self, kid):
+        if self._needs_refresh(kid, self.clock()):
+            with self._lock:
+                now = self.clock()
+                if self._needs_refresh(kid, now):
+                    self._refresh(now)
+        return self._keys.get(kid)
+
+    '''
+    has_key(kid)
+        tells whether kid is in the cached key set, without refreshing it
+    '''
+    def has_key(self, kid):
+        return kid in self._keys
+
+    '''
+    signature_size(kid)
+        length in bytes of the RS256 signatures made with key kid,
+        i.e. the size of its modulus
+    '''
+    def signature_size(self, kid):
+        return self._signature_sizes.get(kid)
+
+    '''
+    public_key(kid, backend)
+        the key kid loaded by the signature backend, built on first use
+        and kept until the key set is refreshed
+    '''
+    def public_key(self, kid, backend):
+        public_keys = self._public_keys
+        public_key = public_keys.get((backend.name, kid))
+        if public_key is None:
+            rsa_key = self._keys.get(kid)
+            if rsa_key is None:
+                return None
+            public_key = backend.load_key(rsa_key)
+            public_keys[(backend.name, kid)] = public_key
+        return public_key
+
+    def _needs_refresh(self, kid, now):
+        if self._expires_at is None or now >= self._expires_at:
+            return True
+        return kid not in self._keys and \
+            now - self._attempted_at >= self.min_refresh_interval
+
+    '''
+    expires_in()
+        seconds until the cached key set expires, None when nothing
+        has been fetched yet
+    '''
+    def expires_in(self):
+        if self._expires_at is None:
+            return None
+        return self._expires_at - self.clock()
+
+    '''
+    refresh()
+        unconditionally re-fetches the key set
+    '''
+    def refresh(self):
+        with self._lock:
+            self._refresh(self.clock())
+
+    '''
+    clear()
+        drops every cached key, the next lookup fetches the key set again
+    '''
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._signature_sizes = {}
+            self._public_keys = {}
+            self._expires_at = None
+            self._fetched_at = None
+            self._attempted_at = None
+
+    def _refresh(self, now):
+        self._attempted_at = now
+        started = time.perf_counter()
+        try:
+            jwks, max_age = self.fetcher()
+            keys = {}
+            signature_sizes = {}
+            for key in jwks['keys']:
+                keys[key['kid']] = {
+                    'kty': key['kty'],
+                    'kid': key['kid'],
+                    'use': key['use'],
+                    'n': key['n'],
+                    'e': key['e']
+                }
+                modulus = int.from_bytes(b64url_decode(key['n']), 'big')
+                signature_sizes[key['kid']] = (modulus.bit_length() + 7) // 8
+        except Exception:
+            self.last_refresh_failed = True
+            registry.counter('auth_jwks_refresh_failures_total',
+                             'Failed JWKS downloads').inc()
+            if self._keys and \
+                    now - self._fetched_at < self.stale_if_error:
+                # Keep serving the last good key set and retry later
+                self._expires_at = now + self.retry_interval
+                return
+            self._keys = {}
+            self._expires_at = now + self.retry_interval
+            raise AuthError({
+                'code': 'JWKS_Unavailable',
+                'description': 'Unable to fetch the token signing keys'
+            }, 503)
+        finally:
+            registry.histogram('auth_jwks_refresh_seconds',
+                               'JWKS download latency').observe(
+                                   time.perf_counter() - started)
+
+        ttl = self.ttl if max_age is None else max_age
+        self.current_ttl = ttl
+        self.last_refresh_failed = False
+        self._keys = keys
+        self._signature_sizes = signature_sizes
+        self._public_keys = {}
+        self._fetched_at = now
+        self._expires_at = now + ttl
+
+
+jwks_cache = JWKSCache()
+
+
+'''
+JWKSRefresher
+    a daemon thread refreshing the JWKS cache `refresh_ahead` seconds
+    (at most half its TTL) before it expires, so requests never wait
+    for a download
+'''
+class JWKSRefresher(threading.Thread):
+    def __init__(self, cache, refresh_ahead=JWKS_REFRESH_AHEAD,
+                 min_sleep=1.0):
+        super().__init__(name='jwks-refresher', daemon=True)
+        self.cache = cache
+        self.refresh_ahead = refresh_ahead
+        self.min_sleep = min_sleep
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            ahead = min(self.refresh_ahead, self.cache.current_ttl / 2)
+            expires_in = self.cache.expires_in()
+            if expires_in is None or expires_in <= ahead:
+                try:
+                    self.cache.refresh()
+                except AuthError:
+                    pass
+                if self.cache.last_refresh_failed:
+                    self._stopped.wait(self.cache.retry_interval)
+                    continue
+                ahead = min(self.refresh_ahead, self.cache.current_ttl / 2)
+                expires_in = self.cache.expires_in()
+            delay = max(expires_in - ahead, self.min_sleep)
+            self._stopped.wait(delay)
+
+    def stop(self):
+        self._stopped.set()
+
+
+_refresher = None
+
+
+'''
+start_jwks_refresher()
+    starts the background refresher of this process, if not running.
+    A refresher inherited through fork() is dead in the child and gets
+    replaced.
+'''
+def start_jwks_refresher(cache=None):
+    global _refresher
+    if _refresher is not None and _refresher.is_alive():
+        return _refresher
+    _refresher = JWKSRefresher(cache or jwks_cache)
+    _refresher.start()
+    return _refresher
+
+
+'''
+stop_jwks_refresher(wait)
+    stops the background refresher; with wait, returns once it is done,
+    so that no refresh holds the JWKS cache lock (before a fork())
+'''
+def stop_jwks_refresher(wait=False):
+    global _refresher
+    if _refresher is not None:
+        _refresher.stop()
+        if wait:
+            _refresher.join()
+        _refresher = None
+
+
+## Stage Timing
+'''
+StageTimer
+    splits the time spent authenticating a request into consecutive
+    stages: mark(stage) closes the stage that ran since the previous mark.
+    finish() records the stages in the `auth_<stage>_seconds` histograms
+    and keeps them on flask.g for the Server-Timing header.
+'''
+class StageTimer:
+    def __init__(self):
+        self.stages = []
+        self._last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stages.append((stage, now - self._last))
+        self._last = now
+
+    def finish(self):
+        total = 0.0
+        for stage, duration in self.stages:
+            registry.histogram(f'auth_{stage}_seconds',
+                               f'requires_auth {stage} stage latency'
+                               ).observe(duration)
+            total += duration
+        registry.histogram('auth_seconds',
+                           'requires_auth total latency').observe(total)
+        g.auth_timings = self.stages
+
+
+def _add_server_timing(response):
+    stages = g.get('auth_timings')
+    if stages:
+        response.headers.add('Server-Timing', ', '.join(
+            'auth-%s;dur=%.3f' % (stage, duration * 1000)
+            for stage, duration in stages))
+    return response
+
+
+'''
+setup_auth(app)
+    prefetches the token signing keys while the app is created and starts
+    their background refresh, according to the JWKS_PREFETCH and
+    JWKS_BACKGROUND_REFRESH settings. AUTH_TIMING turns the per-stage
+    timings of requires_auth (and their Server-Timing header) on or off.
+'''
+def setup_auth(app):
+    global AUTH_TIMING
+    app.config.setdefault('JWKS_PREFETCH', JWKS_PREFETCH)
+    app.config.setdefault('JWKS_BACKGROUND_REFRESH', JWKS_BACKGROUND_REFRESH)
+    app.config.setdefault('AUTH_TIMING', AUTH_TIMING)
+
+    AUTH_TIMING = app.config['AUTH_TIMING']
+    if AUTH_TIMING:
+        app.after_request(_add_server_timing)
+
+    if app.config['JWKS_PREFETCH']:
+        try:
+            jwks_cache.refresh()
+        except AuthError:
+            logger.warning('JWKS prefetch failed, keys will be fetched '
+                           'on first use')
+    if app.config['JWKS_BACKGROUND_REFRESH']:
+        start_jwks_refresher()
+
+
 ## Auth Header
 '''
 It should raise an AuthError if either header is missing or malformed,
@@ -78,43 +646,87 @@ def check_permissions(permission, payload):
     return True
 
 
+## Token Pre-validation
+_TOKEN_PATTERN = re.compile(r'^[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+$')
+
+'''
+prevalidate_token(token)
+    cheap structural checks run before any signature work: three
+    base64url segments, a JSON header naming an allowed alg and a kid,
+    and a signature as long as the modulus of the key it names.
+    Raises AuthError for malformed tokens, otherwise returns the header
+    and the matching RSA key (None when the kid is unknown)
+'''
+def prevalidate_token(token, timer=None):
+    malformed = AuthError({
+        'code': 'Invalid_Header',
+        'description': 'Authorization malformed'
+    }, 401)
+
+    if len(token) > 16384 or not _TOKEN_PATTERN.match(token):
+        raise malformed
+    header_segment, _, signature_segment = token.split('.')
+    if len(header_segment) % 4 == 1 or len(signature_segment) % 4 == 1:
+        raise malformed
+
+    try:
+        header = json.loads(b64url_decode(header_segment))
+    except (ValueError, binascii.Error):
+        raise malformed
+    if not isinstance(header, dict) or header.get('alg') not in ALGORITHMS:
+        raise malformed
+    kid = header.get('kid')
+    if not isinstance(kid, str):
+        raise malformed
+    if timer:
+        timer.mark('parse')
+
+    rsa_key = jwks_cache.get_key(kid)
+    if timer:
+        timer.mark('jwks')
+    if rsa_key is not None:
+        signature_size = jwks_cache.signature_size(kid)
+        if len(signature_segment) * 3 // 4 != signature_size:
+            raise malformed
+    return header, rsa_key
+
+
 '''
 It should take a JWT token as Input and then verify that
 it is an Auth0 token. After verification, it should decode
 the token payload, validate the claims and returns the 
 decoded token payload
 '''
-def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-    unverified_header = jwt.get_unverified_header(token)
+def verify_decode_jwt(token, timer=None):
+    unverified_header, rsa_key = prevalidate_token(token, timer)
     #pdb.set_trace()
-    rsa_key = {}
-    if 'kid' not in unverified_header:
-        raise AuthError({
-            'code': 'Invalid_Header',
-            'description': 'Authorization malformed'
-        }, 401)
-    
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
     
     if rsa_key:
         try:
+            # The signature is checked with the key object built once per
+            # kid; jose then only decodes the payload and validates claims
+            signing_input, _, signature = token.rpartition('.')
+            public_key = jwks_cache.public_key(unverified_header['kid'],
+                                               signature_backend)
+            if timer:
+                timer.mark('key')
+            if not signature_backend.verify(public_key,
+                                            signing_input.encode('ascii'),
+                                            b64url_decode(signature)):
+                raise jwt.JWTError('Signature verification failed.')
+            if timer:
+                timer.mark('verify')
+
             payload = jwt.decode(
                 token,
                 rsa_key,
                 algorithms=ALGORITHMS,
                 audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                issuer='https://' + AUTH0_DOMAIN + '/',
+                options={'verify_signature': False}
             )
+            if timer:
+                timer.mark('claims')
             return payload
         
         except jwt.ExpiredSignatureError:
@@ -134,14 +746,186 @@ def verify_decode_jwt(token):
             }, 400)
     
     raise AuthError({
-        'code': 'Invalid_Header',
+        'code': 'Unknown_Key',
         'description': 'Unable to find the appropriate key'
     }, 400)
 
+## Verified Token Cache
+def token_digest(token):
+    return hashlib.sha256(token.encode('utf-8')).digest()
+
+
+'''
+VerifiedTokenCache
+    a bounded LRU mapping the SHA-256 digest of already verified tokens
+    to their decoded payload, so a token reused by a client is only
+    signature-checked once. Entries are dropped at the token's exp, or as
+    soon as its signing key leaves the JWKS; tokens without exp are never
+    cached. Safe to share between threads.
+'''
+class VerifiedTokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, clock=time.time):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    '''
+    get(token)
+        returns the payload of a previously verified, unexpired token,
+        or None
+    '''
+    def get(self, token, digest=None):
+        digest = digest or token_digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                payload, expires_at, kid = entry
+                if self.clock() < expires_at and jwks_cache.has_key(kid):
+                    self._entries.move_to_end(digest)
+                    self.hits += 1
+                    registry.counter('auth_token_cache_hits_total',
+                                     'Tokens served from the verified '
+                                     'token cache').inc()
+                    return payload
+                del self._entries[digest]
+            self.misses += 1
+        registry.counter('auth_token_cache_misses_total',
+                         'Tokens not found in the verified token '
+                         'cache').inc()
+        return None
+
+    '''
+    put(token, payload)
+        remembers the payload of a token that has just been verified
+    '''
+    def put(self, token, payload, digest=None):
+        expires_at = payload.get('exp')
+        if not isinstance(expires_at, (int, float)) or self.maxsize <= 0:
+            return
+        kid = jwt.get_unverified_header(token).get('kid')
+        digest = digest or token_digest(token)
+        with self._lock:
+            self._entries[digest] = (payload, expires_at, kid)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+token_cache = VerifiedTokenCache()
+
+
+## Rejected Token Cache
+'''
+RejectedTokenCache
+    a short-lived, bounded map from the SHA-256 digest of rejected
+    tokens to the AuthError they produced, so a client replaying a bad
+    token is turned away without JWKS lookups or RSA work. Server-side
+    failures (5xx) and unknown kids, which a key rotation may fix, are
+    not remembered.
+'''
+class RejectedTokenCache:
+    def __init__(self, ttl=TOKEN_REJECTION_TTL,
+                 maxsize=TOKEN_REJECTION_CACHE_SIZE, clock=time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self.hits = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    '''
+    check(token)
+        raises the AuthError a token was rejected with, if it was
+        rejected less than `ttl` seconds ago
+    '''
+    def check(self, token, digest=None):
+        if not self._entries:
+            return
+        digest = digest or token_digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return
+            error, status_code, expires_at = entry
+            if self.clock() >= expires_at:
+                del self._entries[digest]
+                return
+            self.hits += 1
+        registry.counter('auth_token_rejection_cache_hits_total',
+                         'Tokens rejected from the rejection cache').inc()
+        raise AuthError(error, status_code)
+
+    '''
+    put(token, error)
+        remembers that token was rejected with error
+    '''
+    def put(self, token, error, digest=None):
+        if error.status_code >= 500 or self.ttl <= 0 or \
+                error.error.get('code') == 'Unknown_Key':
+            return
+        digest = digest or token_digest(token)
+        with self._lock:
+            self._entries[digest] = (error.error, error.status_code,
+                                     self.clock() + self.ttl)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+rejection_cache = RejectedTokenCache()
+
+
+'''
+authenticate_token(token)
+    returns the verified payload of token, answering from the verified
+    and rejected token caches when possible
+'''
+def authenticate_token(token, timer=None):
+    if not _TOKEN_PATTERN.match(token):
+        raise AuthError({
+            'code': 'Invalid_Header',
+            'description': 'Authorization malformed'
+        }, 401)
+
+    digest = token_digest(token)
+    payload = token_cache.get(token, digest)
+    if timer:
+        timer.mark('cache')
+    if payload is not None:
+        return payload
+
+    rejection_cache.check(token, digest)
+    try:
+        payload = verify_decode_jwt(token, timer)
+    except AuthError as error:
+        rejection_cache.put(token, error, digest)
+        raise
+    token_cache.put(token, payload, digest)
+    return payload
+
+
 '''
 It should take "permission (e.g. 'post:movie')" as Input, and will use the
     get_token_auth_header method to get the token
-    verify_decode_jwt method to decode the jwt
+    authenticate_token method to decode the jwt (through verify_decode_jwt
+    unless the token was seen recently)
     check_permissions method to validate claims and check the requested permission
     and then return the decorator which passes the decoded payload to the decorated method
 '''
@@ -150,11 +934,26 @@ def requires_auth(permission=''):
         @wraps(f)
         def wrapper(*args, **kwargs):
             #pdb.set_trace()
+            if AUTH_TIMING:
+                return timed_wrapper(*args, **kwargs)
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
+            payload = authenticate_token(token)
             
             check_permissions(permission, payload)
             return f(payload, *args, **kwargs)
 
+        def timed_wrapper(*args, **kwargs):
+            timer = StageTimer()
+            try:
+                token = get_token_auth_header()
+                timer.mark('header')
+                payload = authenticate_token(token, timer)
+
+                check_permissions(permission, payload)
+                timer.mark('permissions')
+            finally:
+                timer.finish()
+            return f(payload, *args, **kwargs)
+
         return wrapper
     return requires_auth_decorator
\ No newline at end of file
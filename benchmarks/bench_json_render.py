@@ -0,0 +1,70 @@
+'''
+Benchmark of the list pages rendered by Python (paginate, then jsonify)
+against the pages rendered by the database (DB_JSON_RENDER: json_agg /
+json_group_array, bytes passed into the response): CPU time of this
+process per request and wall time, with and without ?include=cast.
+
+On SQLite the database runs inside this process, so its CPU is counted
+too; on PostgreSQL (DATABASE_URL) only the CPU of the app is.
+
+    python benchmarks/bench_json_render.py --rows 100000 --limit 50 1000
+'''
+import argparse
+import time
+
+from catalog import APP, seed
+
+from models import db, movie_actors
+
+
+def seed_cast(movies, actors, per_movie=3):
+    with APP.app_context():
+        db.session.execute(movie_actors.insert(), [
+            {'movie_id': movie, 'actor_id': 1 + (movie * 7 + i) % actors}
+            for movie in range(1, movies + 1) for i in range(per_movie)
+        ])
+        db.session.commit()
+
+
+def measure(client, url, repeat):
+    client.get(url)
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    for _ in range(repeat):
+        response = client.get(url)
+        assert response.status_code == 200, response.status_code
+    return ((time.process_time() - cpu) / repeat,
+            (time.perf_counter() - wall) / repeat)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--limit', type=int, nargs='+', default=[50, 1000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    seed(movies=args.rows, actors=1000)
+    seed_cast(args.rows, 1000)
+    APP.config['MAX_PAGE_SIZE'] = max(args.limit)
+    client = APP.test_client()
+
+    print('%-26s %7s %14s %14s %14s %14s' % (
+        'page', 'limit', 'python cpu ms', 'db cpu ms', 'python wall ms',
+        'db wall ms'))
+    for query in ('', '&include=cast'):
+        for limit in args.limit:
+            url = '/movies?limit=%d%s' % (limit, query)
+            results = []
+            for render in (False, True):
+                APP.config['DB_JSON_RENDER'] = render
+                results.append(measure(client, url, args.repeat))
+            (python_cpu, python_wall), (db_cpu, db_wall) = results
+            print('%-26s %7d %14.2f %14.2f %14.2f %14.2f' % (
+                '/movies' + query.replace('&', '?'), limit,
+                python_cpu * 1000, db_cpu * 1000,
+                python_wall * 1000, db_wall * 1000))
+
+
+if __name__ == '__main__':
+    main()
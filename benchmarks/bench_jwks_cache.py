@@ -0,0 +1,62 @@
+'''
+Benchmark of auth.verify_decode_jwt with and without the JWKS cache.
+
+The key set is generated locally and served by an in-process fetcher, so
+no network is needed; --latency simulates the Auth0 round-trip that the
+uncached path pays on every request.
+
+    python benchmarks/bench_jwks_cache.py --requests 200 --latency 0.05
+'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from auth import JWKSCache, verify_decode_jwt  # noqa: E402
+import auth  # noqa: E402
+from jwt_testing import (  # noqa: E402
+    generate_rsa_key, make_jwks, mint_token, static_fetcher
+)
+
+
+def run(cache, token, requests):
+    auth.jwks_cache = cache
+    started = time.perf_counter()
+    for _ in range(requests):
+        verify_decode_jwt(token)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--keys', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='simulated JWKS download time in seconds')
+    args = parser.parse_args()
+
+    keys = [generate_rsa_key('key-%d' % i) for i in range(args.keys)]
+    private_pem, jwk = keys[-1]
+    token = mint_token(private_pem, jwk['kid'], permissions=['post:movies'])
+    jwks = make_jwks(keys)
+
+    uncached = static_fetcher(jwks, latency=args.latency)
+    cached = static_fetcher(jwks, latency=args.latency)
+    results = [
+        ('per-request fetch', uncached, run(JWKSCache(fetcher=uncached, ttl=0),
+                                            token, args.requests)),
+        ('cached', cached, run(JWKSCache(fetcher=cached), token,
+                               args.requests)),
+    ]
+
+    print('%-18s %10s %12s %8s' % ('mode', 'req/s', 'ms/req', 'fetches'))
+    for name, fetcher, elapsed in results:
+        print('%-18s %10.1f %12.3f %8d' % (
+            name, args.requests / elapsed, elapsed * 1000 / args.requests,
+            fetcher.calls))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+'''
+Benchmark of GET /movies: keyset pages versus the former full scan.
+
+"full scan" replays the handler used before pagination
+(Movie.query.all(), format() per row, one jsonify); "first page" and
+"deep page" are GET /movies?limit=N at the start and near the end of the
+table. Runs on a scratch SQLite database unless DATABASE_URL is set.
+
+    python benchmarks/bench_list_pagination.py --rows 10000 100000 1000000
+'''
+import argparse
+
+from catalog import APP, seed, timed
+from flask import jsonify
+
+from app import encode_cursor
+from models import Movie
+
+
+def full_scan():
+    with APP.test_request_context('/movies'):
+        movies = Movie.query.all()
+        jsonify({'success': True,
+                 'movies': [movie.format() for movie in movies]})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, nargs='+',
+                        default=[10000, 100000, 1000000])
+    parser.add_argument('--limit', type=int, default=50)
+    args = parser.parse_args()
+
+    client = APP.test_client()
+    print('%10s %14s %14s %14s' % ('rows', 'full scan ms', 'first page ms',
+                                   'deep page ms'))
+    for rows in args.rows:
+        seed(movies=rows)
+        deep = encode_cursor(rows - args.limit)
+        first_url = '/movies?limit=%d' % args.limit
+        deep_url = '/movies?limit=%d&after=%s' % (args.limit, deep)
+        assert client.get(deep_url).status_code == 200
+        print('%10d %14.2f %14.2f %14.2f' % (
+            rows,
+            timed(full_scan, repeat=3) * 1000,
+            timed(lambda: client.get(first_url)) * 1000,
+            timed(lambda: client.get(deep_url)) * 1000))
+
+
+if __name__ == '__main__':
+    main()
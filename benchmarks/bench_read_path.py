@@ -0,0 +1,43 @@
+'''
+Benchmark of the list endpoints' read path: rows per second turned into
+response dicts.
+
+"orm" is the former path (Query.all() then format() per instance);
+"core" is models.paginate, which selects the columns with a Core
+select() and builds dicts from the result rows, with all columns and
+with ?fields=id,title. Runs on a scratch SQLite database unless
+DATABASE_URL is set.
+
+    python benchmarks/bench_read_path.py --rows 100000
+'''
+import argparse
+
+from catalog import APP, seed, timed
+
+from models import Movie, paginate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=100000)
+    args = parser.parse_args()
+
+    seed(movies=args.rows)
+    paths = [
+        ('orm Query.all() + format()',
+         lambda: [movie.format() for movie in Movie.query.all()]),
+        ('core, all fields',
+         lambda: paginate(Movie, limit=args.rows)),
+        ('core, fields=id,title',
+         lambda: paginate(Movie, limit=args.rows, fields=['id', 'title'])),
+    ]
+
+    print('%-28s %14s' % ('path', 'rows/s'))
+    with APP.app_context():
+        for name, read in paths:
+            elapsed = timed(read, repeat=3)
+            print('%-28s %14.0f' % (name, args.rows / elapsed))
+
+
+if __name__ == '__main__':
+    main()
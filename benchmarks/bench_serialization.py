@@ -0,0 +1,75 @@
+'''
+Benchmark of the JSON serialization of rows: the ORM instances turned
+into dicts by format() and written by jsonify, against the rows written
+by the compiled RowEncoder with the standard library backend and with
+orjson (when installed), and packed as MessagePack. Reports the size of
+the output and the bytes produced per second of CPU for each number of
+rows.
+
+    python benchmarks/bench_serialization.py --rows 1000 100000
+'''
+import argparse
+import time
+from datetime import datetime, timedelta
+
+from catalog import APP
+
+from flask import jsonify
+from models import Movie
+import serialization
+from serialization import JSON_BACKENDS, get_encoder, get_json_backend, packb
+
+
+def make_rows(count):
+    epoch = datetime(1950, 1, 1)
+    return [{'id': i, 'title': 'Movie %d' % i,
+             'release_date': epoch + timedelta(days=i % 25000)}
+            for i in range(1, count + 1)]
+
+
+def jsonify_format(rows):
+    movies = [Movie(title=row['title'], release_date=row['release_date'])
+              for row in rows]
+    return jsonify({'success': True,
+                    'movies': [movie.format() for movie in movies]}).get_data()
+
+
+def encoder(backend):
+    def encode(rows):
+        serialization.backend = get_json_backend(backend)
+        return get_encoder(Movie).encode_rows(rows)
+    return encode
+
+
+def measure(encode, rows, repeat):
+    size = len(encode(rows))
+    cpu = time.process_time()
+    for _ in range(repeat):
+        encode(rows)
+    return size, size * repeat / (time.process_time() - cpu)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    variants = [('format + jsonify', jsonify_format),
+                ('encoder, json', encoder('json'))]
+    if JSON_BACKENDS['orjson'].available():
+        variants.append(('encoder, orjson', encoder('orjson')))
+    variants.append(('msgpack', packb))
+
+    print('%-18s %8s %12s %10s' % ('serializer', 'rows', 'bytes', 'MB/s'))
+    with APP.app_context():
+        for count in args.rows:
+            rows = make_rows(count)
+            for name, encode in variants:
+                size, rate = measure(encode, rows, args.repeat)
+                print('%-18s %8d %12d %10.1f' % (name, count, size,
+                                                 rate / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+'''
+Micro-benchmark of RS256 verification per signature backend.
+
+"jose.jwt.decode" is the path used before the pluggable backends: the
+JWK dict is turned into a key on every call. The other rows verify with
+a key object built once, as auth.verify_decode_jwt now does. Tokens are
+minted locally, no network is needed.
+
+    python benchmarks/bench_signature_backends.py --seconds 2
+'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from auth import (  # noqa: E402
+    ALGORITHMS, API_AUDIENCE, AUTH0_DOMAIN, SIGNATURE_BACKENDS,
+    b64url_decode
+)
+from jose import jwt  # noqa: E402
+from jwt_testing import generate_rsa_key, mint_token  # noqa: E402
+
+
+def per_second(verify, seconds):
+    count = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(20):
+            verify()
+        count += 20
+    return count / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--seconds', type=float, default=2.0)
+    parser.add_argument('--bits', type=int, default=2048)
+    args = parser.parse_args()
+
+    private_pem, rsa_key = generate_rsa_key('key-1', bits=args.bits)
+    token = mint_token(private_pem, 'key-1')
+    signing_input, _, signature = token.rpartition('.')
+    signing_input = signing_input.encode('ascii')
+    signature = b64url_decode(signature)
+
+    def legacy():
+        jwt.decode(token, rsa_key, algorithms=ALGORITHMS,
+                   audience=API_AUDIENCE,
+                   issuer='https://' + AUTH0_DOMAIN + '/')
+
+    results = [('jose.jwt.decode', per_second(legacy, args.seconds))]
+    for name, backend_class in SIGNATURE_BACKENDS.items():
+        if not backend_class.available():
+            print('%s: not installed, skipped' % name)
+            continue
+        backend = backend_class()
+        public_key = backend.load_key(rsa_key)
+        assert backend.verify(public_key, signing_input, signature)
+        results.append((name, per_second(
+            lambda: backend.verify(public_key, signing_input, signature),
+            args.seconds)))
+
+    baseline = results[0][1]
+    print('%-18s %14s %8s' % ('backend', 'verify/s', 'speedup'))
+    for name, rate in results:
+        print('%-18s %14.0f %7.1fx' % (name, rate, rate / baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+'''
+Benchmark of how fast invalid bearer tokens are rejected.
+
+"legacy" replays the verification path used before the rejection cache
+and structural pre-checks (header parsing with python-jose, JWKS lookup,
+then jose.jwt.decode); "current" is auth.authenticate_token as called by
+requires_auth. Keys are generated locally, no network is needed.
+
+    python benchmarks/bench_token_rejection.py --requests 2000
+'''
+import argparse
+import base64
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import auth  # noqa: E402
+from auth import (  # noqa: E402
+    ALGORITHMS, API_AUDIENCE, AUTH0_DOMAIN, authenticate_token
+)
+from jose import jwt  # noqa: E402
+from jwt_testing import (  # noqa: E402
+    generate_rsa_key, make_jwks, mint_token, static_fetcher
+)
+
+
+def legacy_verify(token):
+    unverified_header = jwt.get_unverified_header(token)
+    rsa_key = auth.jwks_cache.get_key(unverified_header['kid'])
+    return jwt.decode(token, rsa_key, algorithms=ALGORITHMS,
+                      audience=API_AUDIENCE,
+                      issuer='https://' + AUTH0_DOMAIN + '/')
+
+
+def rejections_per_second(verify, tokens):
+    started = time.perf_counter()
+    for token in tokens:
+        try:
+            verify(token)
+        except Exception:
+            pass
+        else:
+            raise AssertionError('token unexpectedly accepted')
+    return len(tokens) / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    key = generate_rsa_key('key-1')
+    attacker_key = generate_rsa_key('key-1')
+    auth.jwks_cache.fetcher = static_fetcher(make_jwks([key]))
+    auth.jwks_cache.refresh()
+
+    rng = random.Random(0)
+    valid = mint_token(key[0], 'key-1')
+    payload = valid.split('.', 1)[1]
+    hs256 = base64.urlsafe_b64encode(
+        b'{"alg":"HS256","kid":"key-1"}').rstrip(b'=').decode()
+    forged = mint_token(attacker_key[0], 'key-1')
+
+    scenarios = [
+        ('garbage (unique)', [
+            ''.join(rng.choice(string.ascii_letters + '.')
+                    for _ in range(200))
+            for _ in range(args.requests)]),
+        ('alg=HS256 (unique)', [
+            hs256 + '.' + payload[:-8] + '%08d' % i
+            for i in range(args.requests)]),
+        ('truncated signature', [valid[:-6]] * args.requests),
+        ('forged signature (replayed)', [forged] * args.requests),
+    ]
+
+    print('%-30s %14s %14s %8s' % ('scenario', 'legacy rej/s',
+                                    'current rej/s', 'speedup'))
+    for name, tokens in scenarios:
+        auth.rejection_cache.clear()
+        legacy = rejections_per_second(legacy_verify, tokens)
+        current = rejections_per_second(authenticate_token, tokens)
+        print('%-30s %14.0f %14.0f %7.1fx' % (name, legacy, current,
+                                              current / legacy))
+
+
+if __name__ == '__main__':
+    main()
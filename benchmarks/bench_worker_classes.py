@@ -0,0 +1,138 @@
+'''
+Load benchmark of one gunicorn worker, sync against gevent: requests
+per second and latency percentiles of GET /movies?limit=50 for a rising
+number of concurrent clients.
+
+The database of a deployment is remote, so every request of the
+benchmark first waits --latency seconds, the way it would on the
+network (time.sleep, which gevent makes cooperative like the sockets
+and psycopg2). A sync worker serves one request at a time, whatever the
+concurrency; a gevent worker overlaps the waits of its requests. Run
+against PostgreSQL (DATABASE_URL) to measure real database calls too.
+
+    python benchmarks/bench_worker_classes.py --concurrency 1 10 50 100
+'''
+import argparse
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from catalog import APP, seed
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+'''
+latency_app(environ, start_response)
+    the WSGI app served by the benchmarked workers
+'''
+def latency_app(environ, start_response):
+    time.sleep(float(os.environ['BENCH_LATENCY']))
+    return APP.wsgi_app(environ, start_response)
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def start_worker(worker_class, port, latency, connections):
+    # gunicorn.conf.py, read from the working directory, follows it too
+    env = dict(os.environ, BENCH_LATENCY=str(latency),
+               WORKER_CLASS=worker_class,
+               PYTHONPATH=os.pathsep.join(
+                   [BENCH_DIR, os.path.dirname(BENCH_DIR)] +
+                   [path for path in sys.path if path]))
+    server = subprocess.Popen([
+        sys.executable, '-m', 'gunicorn', '--workers', '1',
+        '--worker-class', worker_class,
+        '--worker-connections', str(connections),
+        '--bind', f'127.0.0.1:{port}', '--log-level', 'warning',
+        'bench_worker_classes:latency_app'], env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            request(port, '/movies?limit=1')
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f'{worker_class} worker did not start')
+
+
+def request(port, path):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        response.read()
+        assert response.status == 200, response.status
+    finally:
+        connection.close()
+
+
+def load(port, concurrency, duration):
+    latencies = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client():
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            request(port, '/movies?limit=50')
+            with lock:
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return (len(latencies) / elapsed,
+            latencies[len(latencies) // 2],
+            latencies[int(len(latencies) * 0.99)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, 10, 50, 100])
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--worker-connections', type=int, default=1000)
+    args = parser.parse_args()
+
+    seed(movies=1000, actors=100)
+    worker_classes = ['sync']
+    try:
+        import gevent  # noqa: F401
+        worker_classes.append('gevent')
+    except ImportError:
+        print('gevent is not installed, only measuring sync workers')
+
+    print('%-8s %11s %10s %10s %10s' % (
+        'worker', 'concurrency', 'req/s', 'p50 ms', 'p99 ms'))
+    for worker_class in worker_classes:
+        port = free_port()
+        server = start_worker(worker_class, port, args.latency,
+                              args.worker_connections)
+        try:
+            for concurrency in args.concurrency:
+                rate, p50, p99 = load(port, concurrency, args.duration)
+                print('%-8s %11d %10.1f %10.1f %10.1f' % (
+                    worker_class, concurrency, rate, p50 * 1000, p99 * 1000))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+'''
+Shared setup of the catalog benchmarks: points the app at a scratch
+SQLite database (unless DATABASE_URL is already set), turns the response
+cache off and fills the movies and actors tables with synthetic rows.
+'''
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+if 'DATABASE_URL' not in os.environ:
+    _scratch = tempfile.NamedTemporaryFile(prefix='catalog-bench-',
+                                           suffix='.db', delete=False)
+    os.environ['DATABASE_URL'] = 'sqlite:///' + _scratch.name
+os.environ.setdefault('JWKS_PREFETCH', 'false')
+os.environ.setdefault('JWKS_BACKGROUND_REFRESH', 'false')
+# Measure the endpoints, not the response cache in front of them
+os.environ.setdefault('RESPONSE_CACHE', 'false')
+
+from app import APP  # noqa: E402
+from models import db, Movie, Actor  # noqa: E402
+
+
+def seed(movies=0, actors=0, batch_size=10000):
+    '''Replace the catalog with `movies` movies and `actors` actors'''
+    with APP.app_context():
+        db.create_all()
+        Movie.query.delete()
+        Actor.query.delete()
+        epoch = datetime(1950, 1, 1)
+        for start in range(1, movies + 1, batch_size):
+            db.session.execute(Movie.__table__.insert(), [
+                {'id': i, 'title': 'Movie %d' % i,
+                 'release_date': epoch + timedelta(days=i % 25000)}
+                for i in range(start, min(start + batch_size, movies + 1))
+            ])
+        for start in range(1, actors + 1, batch_size):
+            db.session.execute(Actor.__table__.insert(), [
+                {'id': i, 'name': 'Actor %d' % i, 'age': 18 + i % 70,
+                 'gender': 'Female' if i % 2 else 'Male'}
+                for i in range(start, min(start + batch_size, actors + 1))
+            ])
+        db.session.commit()
+
+
+def timed(function, repeat=5):
+    '''Best wall time of `repeat` calls of function, in seconds'''
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
@@ -0,0 +1,262 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import registry
+from models import get_change_stamp, on_write
+
+'''
+Row cache
+    a per-process LRU of the formatted rows served by the single and
+    multi-get endpoints. Each row is tagged with the change stamp its
+    table had when it was read, and served only while the table is
+    still at that stamp. The stamp lives in the database, so a write
+    committed by any process retires the rows cached by all of them;
+    it is read again at most every ROW_CACHE_STAMP_TTL seconds, which
+    bounds how long a write of another process can go unnoticed, and
+    right after a write of this process. A row read while a write
+    commits is tagged with the stamp read before it, which the write
+    has already replaced, so it is never served.
+'''
+
+# Rows kept by the row cache, 0 disables it
+ROW_CACHE_SIZE = int(os.environ.get('ROW_CACHE_SIZE', 10000))
+# Seconds a change stamp read from the database is trusted for
+ROW_CACHE_STAMP_TTL = float(os.environ.get('ROW_CACHE_STAMP_TTL', 1))
+
+
+'''
+RowCache
+    LRU of row dicts by model and primary key. Take the change stamp of
+    the table from stamp() before querying the database, and hand it to
+    get() and put()
+    EXAMPLE
+        stamp = row_cache.stamp(Movie)
+        row = row_cache.get(Movie, id, stamp)
+        if row is None:
+            row = load(id)
+            row_cache.put(Movie, id, row, stamp)
+'''
+class RowCache:
+    def __init__(self, maxsize=ROW_CACHE_SIZE, stamp_ttl=ROW_CACHE_STAMP_TTL,
+                 clock=time.monotonic):
+        self.maxsize = maxsize
+        self.stamp_ttl = stamp_ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # table -> (stamp, read at); and the writes seen per table
+        self._stamps = {}
+        self._writes = {}
+        self._lock = threading.Lock()
+
+    '''
+    stamp(model)
+        the change stamp of the table of model, read from the database
+        when the one kept is older than stamp_ttl or predates a write of
+        this process; needs an application context
+    '''
+    def stamp(self, model):
+        table = model.__tablename__
+        now = self.clock()
+        with self._lock:
+            kept = self._stamps.get(table)
+            writes = self._writes.get(table, 0)
+        if kept is not None and now - kept[1] < self.stamp_ttl:
+            return kept[0]
+        stamp = get_change_stamp(model)
+        with self._lock:
+            # Not kept when a write committed while it was read
+            if self._writes.get(table, 0) == writes:
+                self._stamps[table] = (stamp, now)
+        return stamp
+
+    '''
+    get(model, id, stamp)
+        returns the row of model with that id cached while its table was
+        at stamp, or None
+    '''
+    def get(self, model, id, stamp):
+        key = (model.__tablename__, id)
+        row = None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == stamp:
+                row = entry[1]
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if row is not None:
+            registry.counter('row_cache_hits_total',
+                             'Rows served from the row cache').inc()
+        else:
+            registry.counter('row_cache_misses_total',
+                             'Rows not found in the row cache').inc()
+        return row
+
+    '''
+    put(model, id, row, stamp)
+        remembers a row read from the database once the change stamp of
+        its table was read as stamp
+    '''
+    def put(self, model, id, row, stamp):
+        if self.maxsize <= 0:
+            return
+        key = (model.__tablename__, id)
+        with self._lock:
+            self._entries[key] = (stamp, row)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    '''
+    invalidate(model, ids)
+        write listener: forgets the change stamp of the table of model,
+        and the cached rows with these ids to make room sooner
+    '''
+    def invalidate(self, model, ids):
+        table = model.__tablename__
+        with self._lock:
+            self._stamps.pop(table, None)
+            self._writes[table] = self._writes.get(table, 0) + 1
+            for id in ids:
+                self._entries.pop((table, id), None)
+
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._stamps.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+row_cache = RowCache()
+on_write(row_cache.invalidate)
+registry.gauge('row_cache_hit_ratio',
+               'Share of row lookups served from the row cache',
+               row_cache.hit_ratio)
+
+
+'''
+Response cache
+    a per-process LRU of the encoded bodies of the public list endpoints,
+    keyed by route and normalized query string and tagged with the
+    version of the table they were read from. Every committed write to a
+    table bumps its version, which retires the bodies built from it.
+'''
+
+# Total size in bytes of the bodies kept by the response cache
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE',
+                                         32 * 1024 * 1024))
+
+
+'''
+ResponseCache
+    LRU of (body, mimetype, encoding) entries, bounded by the total size
+    of the bodies; a body larger than an eighth of the cache is not
+    kept. encoding is the content coding the body is stored in (None
+    when it is not compressed). Read
+    the version with version() before building a response and hand it
+    to put(), which drops the body when the table changed in the meantime
+    EXAMPLE
+        version = response_cache.version(Movie)
+        cached = response_cache.get(Movie, key)
+        if cached is None:
+            body = build()
+            response_cache.put(Movie, key, body, 'application/json', version)
+'''
+class ResponseCache:
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def version(self, model):
+        return self._versions.get(model.__tablename__, 0)
+
+    '''
+    get(model, key)
+        returns the (body, mimetype, encoding) cached under key for the
+        current version of the table of model, or None
+    '''
+    def get(self, model, key):
+        table = model.__tablename__
+        with self._lock:
+            entry_key = (table, self._versions.get(table, 0), key)
+            entry = self._entries.get(entry_key)
+            if entry is not None:
+                self._entries.move_to_end(entry_key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if entry is not None:
+            registry.counter('response_cache_hits_total',
+                             'Responses served from the response '
+                             'cache').inc()
+        else:
+            registry.counter('response_cache_misses_total',
+                             'Responses not found in the response '
+                             'cache').inc()
+        return entry
+
+    '''
+    put(model, key, body, mimetype, version, encoding)
+        remembers a body built while the table of model was at version
+    '''
+    def put(self, model, key, body, mimetype, version, encoding=None):
+        if len(body) > self.maxsize // 8:
+            return
+        table = model.__tablename__
+        with self._lock:
+            if self._versions.get(table, 0) != version:
+                return
+            entry_key = (table, version, key)
+            previous = self._entries.pop(entry_key, None)
+            if previous is not None:
+                self.size -= len(previous[0])
+            self._entries[entry_key] = (body, mimetype, encoding)
+            self.size += len(body)
+            while self.size > self.maxsize:
+                _, (evicted, *_) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    '''
+    invalidate(model, ids)
+        bumps the version of the table of model and drops its bodies
+    '''
+    def invalidate(self, model, ids=()):
+        table = model.__tablename__
+        with self._lock:
+            self._versions[table] = self._versions.get(table, 0) + 1
+            for entry_key in [entry_key for entry_key in self._entries
+                              if entry_key[0] == table]:
+                self.size -= len(self._entries.pop(entry_key)[0])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+            self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+response_cache = ResponseCache()
+on_write(response_cache.invalidate)
@@ -0,0 +1,197 @@
+import os
+import time
+import zlib
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header, parse_options_header
+
+from metrics import registry
+
+'''
+Response compression
+    gzip or deflate encoding of the responses, for the clients accepting
+    it, by a WSGI middleware wrapped around the app: bodies smaller than
+    COMPRESSION_MIN_SIZE and media types that do not compress (or must
+    not be buffered, like event streams) are sent as they are, streamed
+    bodies are compressed as they are produced. Endpoints may encode
+    their body themselves (the response cache keeps bodies compressed);
+    the middleware leaves those alone. The bytes in and out and the CPU
+    time spent compressing are reported in the metrics.
+'''
+
+# Compress the responses of the clients accepting it
+COMPRESSION = os.environ.get('COMPRESSION', 'true').lower() == 'true'
+# Smallest body, in bytes, worth compressing
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+# zlib compression level, from 1 (fastest) to 9 (smallest)
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', 6))
+
+# Preferred first
+ENCODINGS = ('gzip', 'deflate')
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/msgpack',
+                          'application/x-msgpack', 'application/vnd.msgpack',
+                          'application/x-ndjson', 'text/plain', 'text/html')
+
+# zlib window bits of each encoding: gzip wrapper, zlib wrapper
+_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+def _record(size_in, size_out, cpu):
+    registry.counter('compression_bytes_in_total',
+                     'Bytes of response bodies compressed').inc(size_in)
+    registry.counter('compression_bytes_out_total',
+                     'Bytes sent for the compressed bodies').inc(size_out)
+    registry.histogram('compression_cpu_seconds',
+                       'CPU time spent compressing a response body'
+                       ).observe(cpu)
+
+
+def compression_ratio():
+    size_in = registry.counter('compression_bytes_in_total').value
+    size_out = registry.counter('compression_bytes_out_total').value
+    return size_in / size_out if size_out else None
+
+
+registry.gauge('compression_ratio',
+               'Bytes of the compressed bodies per byte sent',
+               compression_ratio)
+
+
+'''
+negotiate_encoding(accept_encoding)
+    the content coding to answer an Accept-Encoding header with, or None
+    to send the body as it is
+'''
+def negotiate_encoding(accept_encoding):
+    if not accept_encoding:
+        return None
+    return parse_accept_header(accept_encoding).best_match(ENCODINGS)
+
+
+'''
+accepts_encoding(accept_encoding, encoding)
+    whether an Accept-Encoding header allows the content coding
+'''
+def accepts_encoding(accept_encoding, encoding):
+    if not accept_encoding:
+        return False
+    return parse_accept_header(accept_encoding).quality(encoding) > 0
+
+
+'''
+compress(body, encoding, level) / decompress(body, encoding)
+    the body encoded with (gzip or deflate) / decoded from encoding;
+    compress reports the bytes and CPU time in the metrics
+'''
+def compress(body, encoding, level=COMPRESSION_LEVEL):
+    cpu = time.thread_time()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _WBITS[encoding])
+    compressed = compressor.compress(body) + compressor.flush()
+    _record(len(body), len(compressed), time.thread_time() - cpu)
+    return compressed
+
+
+def decompress(body, encoding):
+    return zlib.decompress(body, _WBITS[encoding])
+
+
+def _compress_stream(chunks, encoding, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _WBITS[encoding])
+    size_in = size_out = 0
+    cpu = 0.0
+    try:
+        for chunk in chunks:
+            start = time.thread_time()
+            compressed = compressor.compress(chunk)
+            cpu += time.thread_time() - start
+            size_in += len(chunk)
+            size_out += len(compressed)
+            if compressed:
+                yield compressed
+        start = time.thread_time()
+        compressed = compressor.flush()
+        cpu += time.thread_time() - start
+        size_out += len(compressed)
+        yield compressed
+        _record(size_in, size_out, cpu)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+'''
+CompressionMiddleware(app, min_size, level)
+    WSGI middleware compressing the responses of app. The ETag of a
+    compressed response is made weak, since the bytes sent differ from
+    those of the same response unencoded.
+    EXAMPLE
+        app.wsgi_app = CompressionMiddleware(app.wsgi_app)
+'''
+class CompressionMiddleware:
+    def __init__(self, app, min_size=COMPRESSION_MIN_SIZE,
+                 level=COMPRESSION_LEVEL):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+
+    def __call__(self, environ, start_response):
+        encoding = negotiate_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+        response = {}
+
+        def capture_start_response(status, headers, exc_info=None):
+            response.update(status=status, headers=Headers(headers),
+                            exc_info=exc_info)
+            # Nothing is written before the body is inspected
+            return _write_not_supported
+
+        chunks = self.app(environ, capture_start_response)
+        status = response['status']
+        headers = response['headers']
+
+        def start():
+            start_response(status, headers.to_wsgi_list(),
+                           response['exc_info'])
+
+        if not self._compressible(status, headers):
+            start()
+            return chunks
+        vary = headers.get('Vary')
+        headers['Vary'] = vary + ', Accept-Encoding' if vary \
+            else 'Accept-Encoding'
+        length = headers.get('Content-Length', type=int)
+        if (encoding is None or environ['REQUEST_METHOD'] == 'HEAD' or
+                (length is not None and length < self.min_size)):
+            start()
+            return chunks
+
+        if length is not None:
+            try:
+                body = compress(b''.join(chunks), encoding, self.level)
+            finally:
+                if hasattr(chunks, 'close'):
+                    chunks.close()
+            headers['Content-Length'] = str(len(body))
+            chunks = [body]
+        else:
+            headers.pop('Content-Length', None)
+            chunks = _compress_stream(chunks, encoding, self.level)
+
+        headers['Content-Encoding'] = encoding
+        etag = headers.get('ETag')
+        if etag is not None and not etag.startswith('W/'):
+            headers['ETag'] = 'W/' + etag
+        start()
+        return chunks
+
+    def _compressible(self, status, headers):
+        if status[:3] in ('204', '206', '304') or 'Content-Encoding' in headers:
+            return False
+        if 'no-transform' in headers.get('Cache-Control', ''):
+            return False
+        mimetype, _ = parse_options_header(headers.get('Content-Type', ''))
+        return mimetype in COMPRESSIBLE_MIMETYPES
+
+
+def _write_not_supported(data):
+    raise RuntimeError('write() is not supported behind the compression '
+                       'middleware')
@@ -0,0 +1,116 @@
+import logging
+import threading
+
+try:
+    from gevent import monkey
+    from gevent.socket import wait_read, wait_write
+except ImportError:  # only needed by gevent workers
+    monkey = wait_read = wait_write = None
+
+try:
+    from greenlet import getcurrent
+except ImportError:
+    getcurrent = None
+
+try:
+    import psycopg2
+    import psycopg2.extensions
+except ImportError:  # only needed with PostgreSQL
+    psycopg2 = None
+
+logger = logging.getLogger(__name__)
+
+'''
+Cooperative workers
+    support for serving the app from gevent workers (gunicorn
+    --worker-class gevent): every request runs in a greenlet, and a
+    greenlet waiting on the network lets the others run, so one worker
+    process serves many requests at once. gevent patches the standard
+    library when the worker starts; psycopg2, a C extension, is made to
+    wait through gevent as well, and the database session of
+    Flask-SQLAlchemy is scoped to the greenlet.
+
+    gevent must patch the standard library before the app is imported,
+    or the locks of the caches created at import time are plain thread
+    locks: a greenlet holding one while it waits on I/O (the JWKS cache
+    downloading the keys) would block every other greenlet of the
+    worker trying to take it. setup_cooperative() refuses to start then.
+'''
+
+
+'''
+cooperative()
+    whether gevent has patched the standard library of this process
+'''
+def cooperative():
+    return monkey is not None and monkey.is_module_patched('socket')
+
+
+'''
+session_scope()
+    the identity the database session is scoped to: the current
+    greenlet, which is the current thread when greenlets are not used
+'''
+def session_scope():
+    if getcurrent is not None:
+        return getcurrent()
+    return threading.get_ident()
+
+
+'''
+gevent_wait_callback(conn, timeout)
+    psycopg2 wait callback polling the connection and waiting for its
+    socket through the gevent hub, so that a query in progress lets the
+    other greenlets run
+'''
+def gevent_wait_callback(conn, timeout=None):
+    extensions = psycopg2.extensions
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            return
+        if state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(
+                f'bad result from poll: {state!r}')
+
+
+'''
+patch_psycopg2()
+    installs gevent_wait_callback; connections opened afterwards are
+    cooperative. Returns False when psycopg2 is not installed
+'''
+def patch_psycopg2():
+    if psycopg2 is None:
+        return False
+    psycopg2.extensions.set_wait_callback(gevent_wait_callback)
+    return True
+
+
+'''
+setup_cooperative(app, shared)
+    prepares the app for a gevent worker when the COOPERATIVE setting
+    (on when gevent has patched the process) says so: psycopg2 is
+    patched before any connection is opened, and every object of
+    `shared` must hold a lock created after the patching
+'''
+def setup_cooperative(app, shared=()):
+    app.config.setdefault('COOPERATIVE', cooperative())
+    if not app.config['COOPERATIVE']:
+        return
+    if not patch_psycopg2():
+        logger.warning('psycopg2 is not installed, database calls will '
+                       'not yield to other greenlets')
+
+    lock_type = type(threading.Lock())
+    unpatched = [type(item).__name__ for item in shared
+                 if type(item._lock) is not lock_type]
+    if unpatched:
+        raise RuntimeError(
+            'created before gevent patched threading: '
+            + ', '.join(unpatched) + '. Patch first (gunicorn '
+            '--worker-class gevent, or gevent.monkey.patch_all() before '
+            'importing the app)')
@@ -0,0 +1,229 @@
+import logging
+import os
+import threading
+from collections import deque
+
+from metrics import registry
+from models import db, on_write, changes_since, latest_change_position
+from serialization import dumps
+
+logger = logging.getLogger(__name__)
+
+'''
+Change events
+    pushes the changes of the change feed to Server-Sent Events
+    subscribers. One broadcaster per worker process reads the feed and
+    fans each change out to the subscribers of that process: writes
+    committed here wake it at once, writes of other processes are picked
+    up every SSE_POLL_INTERVAL seconds. Every subscriber has a bounded
+    buffer; one that falls behind is sent a reset and dropped, to resync
+    from /changes.
+
+    Each subscriber holds its connection open, so the stream should be
+    served by cooperative (gevent) workers, not by sync ones.
+'''
+
+# Seconds between two reads of the change feed when nothing is written
+# in this process
+SSE_POLL_INTERVAL = float(os.environ.get('SSE_POLL_INTERVAL', 2))
+# Seconds of silence after which a comment line is sent to subscribers
+SSE_HEARTBEAT_INTERVAL = float(os.environ.get('SSE_HEARTBEAT_INTERVAL', 15))
+# Changes buffered per subscriber before it is dropped
+SSE_BUFFER_SIZE = int(os.environ.get('SSE_BUFFER_SIZE', 1000))
+# Read the change feed from a background thread (greenlet under gevent)
+SSE_BACKGROUND = os.environ.get('SSE_BACKGROUND', 'true').lower() == 'true'
+
+# Handed to a subscriber that fell behind instead of the next change
+RESET = object()
+
+
+'''
+encode_change(change)
+    the JSON text of a change, encoded once and sent to every subscriber
+'''
+def encode_change(change):
+    return dumps(change)
+
+
+'''
+Subscription
+    the buffer of changes waiting to be sent to one subscriber, as
+    (position, op, data) tuples; changes at or before `start`, the end
+    of the feed when it subscribed, are not for it
+'''
+class Subscription:
+    def __init__(self, maxsize=SSE_BUFFER_SIZE, start=None):
+        self.maxsize = maxsize
+        self.start = start
+        self.overflowed = False
+        self._events = deque()
+        self._ready = threading.Condition()
+
+    def put(self, event):
+        if self.start is not None and event[0] <= self.start:
+            return
+        with self._ready:
+            if self.overflowed:
+                return
+            if len(self._events) >= self.maxsize:
+                self.overflowed = True
+                self._events.clear()
+            else:
+                self._events.append(event)
+            self._ready.notify()
+
+    def reset(self):
+        with self._ready:
+            self.overflowed = True
+            self._events.clear()
+            self._ready.notify()
+
+    '''
+    get(timeout)
+        the next change, RESET once the buffer overflowed, or None when
+        nothing came within timeout seconds
+    '''
+    def get(self, timeout=None):
+        with self._ready:
+            if not self._events and not self.overflowed:
+                self._ready.wait(timeout)
+            if self.overflowed:
+                return RESET
+            if self._events:
+                return self._events.popleft()
+            return None
+
+    def __len__(self):
+        return len(self._events)
+
+
+'''
+ChangeBroadcaster
+    reads the change feed from the position it reached and puts every
+    new change in the buffer of every subscription. It only reads while
+    there are subscribers; the first one makes it start from the end of
+    the feed as it was when subscribing (which needs an application
+    context), so that nothing committed after is missed.
+        subscription = broadcaster.subscribe()
+        try:
+            event = subscription.get(timeout=15)
+        finally:
+            broadcaster.unsubscribe(subscription)
+'''
+class ChangeBroadcaster:
+    def __init__(self, poll_interval=SSE_POLL_INTERVAL,
+                 buffer_size=SSE_BUFFER_SIZE, background=SSE_BACKGROUND,
+                 batch_size=500):
+        self.app = None
+        self.poll_interval = poll_interval
+        self.buffer_size = buffer_size
+        self.background = background
+        self.batch_size = batch_size
+        self.position = None
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def subscribe(self):
+        start = latest_change_position()
+        subscription = Subscription(self.buffer_size, start)
+        with self._lock:
+            if self.position is None:
+                self.position = start
+            self._subscriptions.add(subscription)
+        registry.counter('sse_connections_total',
+                         'Change stream subscriptions opened').inc()
+        if self.background:
+            self._start()
+            self._wake.set()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def subscriber_count(self):
+        return len(self._subscriptions)
+
+    '''
+    notify(model, ids)
+        write listener: wakes the broadcaster to read the feed now
+    '''
+    def notify(self, model=None, ids=()):
+        self._wake.set()
+
+    '''
+    poll()
+        reads the changes committed since the last poll and publishes
+        them; needs an application context
+    '''
+    def poll(self):
+        with self._lock:
+            if not self._subscriptions:
+                self.position = None
+                return 0
+        try:
+            published = 0
+            more = True
+            while more:
+                changes, position, more = changes_since(
+                    self.position, self.batch_size, positions=True)
+                for change in changes:
+                    self.publish(change.pop('position'), change)
+                self.position = position
+                published += len(changes)
+            return published
+        finally:
+            db.session.remove()
+
+    def publish(self, position, change):
+        event = (position, change['op'], encode_change(change))
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription.put(event)
+            if subscription.overflowed:
+                self.unsubscribe(subscription)
+                registry.counter('sse_dropped_total',
+                                 'Change stream subscribers dropped for '
+                                 'falling behind').inc()
+        registry.counter('sse_events_total',
+                         'Changes published to the change '
+                         'stream').inc()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='change-broadcaster',
+                                            daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                with self.app.app_context():
+                    self.poll()
+            except Exception:
+                logger.exception('reading the change feed failed')
+
+
+broadcaster = ChangeBroadcaster()
+on_write(broadcaster.notify)
+registry.gauge('sse_subscribers', 'Open change stream subscriptions',
+               broadcaster.subscriber_count)
+
+
+'''
+setup_events(app)
+    binds the broadcaster to the application whose database it reads
+'''
+def setup_events(app):
+    app.config.setdefault('SSE_HEARTBEAT_INTERVAL', SSE_HEARTBEAT_INTERVAL)
+    app.config.setdefault('SSE_BACKGROUND', SSE_BACKGROUND)
+    broadcaster.app = app
+    broadcaster.background = app.config['SSE_BACKGROUND']
@@ -0,0 +1,200 @@
+import math
+import os
+
+'''
+gunicorn settings
+    read by `gunicorn -c gunicorn.conf.py app:APP` (the Procfile). The
+    workers are gevent ones unless WORKER_CLASS says otherwise, since
+    every /stream/changes subscriber holds a request open. Their number
+    follows the CPUs this process may use, unless WEB_CONCURRENCY says
+    otherwise; WEB_THREADS threads per worker turn sync workers into
+    gthread ones.
+
+    The app is preloaded: the master imports it once and the workers
+    share its code and import-time state copy-on-write instead of each
+    importing it again. Whatever the master opened must then not be
+    used by two processes: the master closes its database connections
+    and stops its JWKS refresher before forking, each worker drops the
+    connections it inherited, restarts its own refresher and warms its
+    connection pool and caches before accepting requests.
+'''
+
+# Worker class: gevent, which the change stream needs, or sync/gthread
+WORKER_CLASS = os.environ.get('WORKER_CLASS', 'gevent')
+# Import the app in the master and fork the workers from it
+PRELOAD_APP = os.environ.get('PRELOAD_APP', 'true').lower() == 'true'
+# Open the connections and fill the caches of a worker before it serves
+WARM_UP = os.environ.get('WARM_UP', 'true').lower() == 'true'
+# Pages requested by the warm-up, comma separated
+WARM_UP_PATHS = os.environ.get('WARM_UP_PATHS', '/movies,/actors')
+
+
+'''
+available_cpus()
+    the CPUs this process may run on: those of its affinity mask, fewer
+    when a cgroup CPU quota (a container limit) allows less
+'''
+def available_cpus():
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not on Linux
+        cpus = os.cpu_count() or 1
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return cpus
+
+
+def _cgroup_cpu_quota():
+    # cgroup v2: "<quota> <period>", v1: two files
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as limits:
+            quota, period = limits.read().split()
+    except (OSError, ValueError):
+        try:
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as limits:
+                quota = limits.read().strip()
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as limits:
+                period = limits.read().strip()
+        except OSError:
+            return None
+    if quota in ('max', '-1'):
+        return None
+    try:
+        return int(quota) / int(period)
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+'''
+default_workers(worker_class, cpus)
+    a sync worker serves one request at a time, so two per CPU (and one
+    more) keep the CPUs busy while others wait on the database; a gevent
+    worker overlaps its requests by itself and needs one per CPU
+'''
+def default_workers(worker_class, cpus):
+    if worker_class == 'gevent':
+        return cpus
+    return 2 * cpus + 1
+
+
+worker_class = WORKER_CLASS
+workers = int(os.environ.get('WEB_CONCURRENCY') or
+              default_workers(WORKER_CLASS, available_cpus()))
+threads = int(os.environ.get('WEB_THREADS', 1))
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 1000))
+preload_app = PRELOAD_APP
+
+if WORKER_CLASS == 'gevent' and PRELOAD_APP:
+    # The workers patch the standard library when they start, after the
+    # preloaded app created its locks: patch the master first
+    from gevent import monkey
+    monkey.patch_all()
+
+
+def _preloaded_app():
+    from app import APP
+    return APP
+
+
+'''
+when_ready(server)
+    in the master, once the app is preloaded and before the first fork:
+    no connection or refresh of the master is handed down to the workers.
+    post_fork relies on it: its dispose() closes what the pool holds
+'''
+def when_ready(server):
+    if not server.cfg.preload_app:
+        return
+    from auth import http_client, stop_jwks_refresher
+    from models import db
+
+    app = _preloaded_app()
+    stop_jwks_refresher(wait=True)
+    http_client.close()
+    with app.app_context():
+        db.engine.dispose()
+
+
+'''
+post_fork(server, worker)
+    in a new worker: starts it on a fresh connection pool and without
+    keep-alive sockets, and restarts the JWKS refresher, whose thread was
+    not forked. dispose() (SQLAlchemy 1.4.18, without close=False) closes
+    the pooled connections, which would end those of the master too, so
+    it is only safe because when_ready emptied the pool before the fork
+'''
+def post_fork(server, worker):
+    if not server.cfg.preload_app:
+        return
+    from auth import http_client, start_jwks_refresher
+    from models import db
+
+    app = _preloaded_app()
+    with app.app_context():
+        db.engine.dispose()
+    http_client.close()
+    if app.config['JWKS_BACKGROUND_REFRESH']:
+        start_jwks_refresher()
+
+
+'''
+post_worker_init(worker)
+    warms the worker up before it accepts requests: opens the
+    connections it will use, fetches the JWKS if the master had not, and
+    requests WARM_UP_PATHS to fill the caches and compile the encoders
+'''
+def post_worker_init(worker):
+    if WARM_UP:
+        warm_up(_preloaded_app(), _pool_connections(worker.cfg), worker.log)
+
+
+def _pool_connections(cfg):
+    if cfg.worker_class_str in ('gevent', 'eventlet'):
+        return cfg.worker_connections
+    return cfg.threads
+
+
+'''
+warm_up(app, connections, log)
+    opens up to `connections` database connections at once (no more than
+    the pool keeps) and returns them to the pool, then warms the caches
+'''
+def warm_up(app, connections, log):
+    from sqlalchemy import text
+    from sqlalchemy.pool import QueuePool
+
+    from auth import AuthError, jwks_cache
+    from models import db
+
+    with app.app_context():
+        pool = db.engine.pool
+        if isinstance(pool, QueuePool):
+            connections = min(connections, pool.size())
+        opened = []
+        try:
+            for _ in range(max(1, connections)):
+                opened.append(db.engine.connect())
+                opened[-1].execute(text('SELECT 1'))
+        except Exception:
+            log.exception('Warm-up could not connect to the database')
+        finally:
+            for connection in opened:
+                connection.close()
+
+    if app.config['JWKS_PREFETCH']:
+        expires_in = jwks_cache.expires_in()
+        if expires_in is None or expires_in <= 0:
+            try:
+                jwks_cache.refresh()
+            except AuthError:
+                log.warning('Warm-up could not fetch the JWKS')
+
+    client = app.test_client()
+    for path in filter(None, WARM_UP_PATHS.split(',')):
+        response = client.get(path.strip(),
+                              headers={'Accept-Encoding': 'gzip'})
+        if response.status_code >= 500:
+            log.warning('Warm-up request %s failed: %s', path,
+                        response.status)
+    log.info('Worker warmed up: %d database connections', len(opened))
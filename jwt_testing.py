@@ -0,0 +1,156 @@
+import base64
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import rsa
+from jose import jwt
+
+from auth import ALGORITHMS, API_AUDIENCE, AUTH0_DOMAIN
+
+'''
+Helpers for tests and benchmarks
+    generate a local RSA key set and mint Auth0-shaped access tokens
+    signed with it, so the auth code can be exercised without network
+'''
+
+
+def _b64url_uint(value):
+    raw = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+'''
+generate_rsa_key(kid)
+    returns a (private_pem, jwk) pair where jwk is the public key
+    formatted the way it appears in the Auth0 JWKS document
+'''
+def generate_rsa_key(kid, bits=2048):
+    public_key, private_key = rsa.newkeys(bits)
+    private_pem = private_key.save_pkcs1().decode('ascii')
+    jwk = {
+        'kty': 'RSA',
+        'kid': kid,
+        'use': 'sig',
+        'alg': ALGORITHMS[0],
+        'n': _b64url_uint(public_key.n),
+        'e': _b64url_uint(public_key.e)
+    }
+    return private_pem, jwk
+
+
+'''
+make_jwks(keys)
+    builds a JWKS document from the (private_pem, jwk) pairs
+'''
+def make_jwks(keys):
+    return {'keys': [jwk for _, jwk in keys]}
+
+
+'''
+mint_token(private_pem, kid)
+    returns an RS256 access token carrying the given permissions,
+    the API audience and the Auth0 issuer
+'''
+def mint_token(private_pem, kid, permissions=(), expires_in=3600, **claims):
+    now = int(time.time())
+    payload = {
+        'iss': 'https://' + AUTH0_DOMAIN + '/',
+        'sub': 'auth0|local-test',
+        'aud': API_AUDIENCE,
+        'iat': now,
+        'exp': now + expires_in,
+        'permissions': list(permissions)
+    }
+    payload.update(claims)
+    return jwt.encode(payload, private_pem, algorithm=ALGORITHMS[0],
+                      headers={'kid': kid})
+
+
+'''
+static_fetcher(jwks)
+    returns a JWKS fetcher serving the given document, counting its calls
+    in fetcher.calls; the document is serialized once and parsed on every
+    call, like a real download
+'''
+def static_fetcher(jwks, max_age=None, latency=0):
+    body = json.dumps(jwks).encode('utf-8')
+
+    def fetcher():
+        fetcher.calls += 1
+        if latency:
+            time.sleep(latency)
+        return json.loads(body), max_age
+
+    fetcher.calls = 0
+    return fetcher
+
+
+class _JWKSHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.stand_in.connections += 1
+
+    def do_GET(self):
+        stand_in = self.server.stand_in
+        stand_in.requests += 1
+        if stand_in.fail:
+            body = b'{"error": "unavailable"}'
+            self.send_response(503)
+        else:
+            body = json.dumps(stand_in.jwks).encode('utf-8')
+            self.send_response(200)
+            if stand_in.max_age is not None:
+                self.send_header('Cache-Control',
+                                 'public, max-age=%d' % stand_in.max_age)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+'''
+JWKSServer
+    a local stand-in for the Auth0 JWKS endpoint, served over keep-alive
+    HTTP/1.1 from a background thread. Set `fail` to make it answer 503,
+    `requests` and `connections` count what it received.
+        with JWKSServer(make_jwks(keys)) as server:
+            fetch_jwks(server.url)
+'''
+class JWKSServer:
+    def __init__(self, jwks, max_age=None):
+        self.jwks = jwks
+        self.max_age = max_age
+        self.fail = False
+        self.requests = 0
+        self.connections = 0
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), _JWKSHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.stand_in = self
+        self._thread = threading.Thread(target=self._httpd.serve_forever,
+                                        daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address
+        return 'http://%s:%d/.well-known/jwks.json' % (host, port)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
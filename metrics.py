@@ -0,0 +1,155 @@
+import bisect
+import threading
+
+'''
+In-process metrics
+    counters and histograms shared by the modules of the app and
+    reported by the /metrics endpoint. Every worker process keeps its
+    own registry.
+'''
+
+# Upper bounds (in seconds) of the default latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+'''
+Counter
+    a monotonically increasing value
+'''
+class Counter:
+    def __init__(self, name, description=''):
+        self.name = name
+        self.description = description
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def snapshot(self):
+        return self._value
+
+
+'''
+Gauge
+    a value computed by a function when the metrics are read
+'''
+class Gauge:
+    def __init__(self, name, description='', function=None):
+        self.name = name
+        self.description = description
+        self.function = function
+
+    @property
+    def value(self):
+        return self.function() if self.function is not None else None
+
+    def snapshot(self):
+        return self.value
+
+
+'''
+Histogram
+    counts observations into cumulative buckets and keeps their sum,
+    minimum and maximum
+'''
+class Histogram:
+    def __init__(self, name, description='', buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._min = None
+        self._max = None
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._count += 1
+            self._sum += value
+            if self._min is None or value < self._min:
+                self._min = value
+            if self._max is None or value > self._max:
+                self._max = value
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def sum(self):
+        return self._sum
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self._counts)
+            snapshot = {
+                'count': self._count,
+                'sum': self._sum,
+                'min': self._min,
+                'max': self._max
+            }
+        buckets = {}
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        buckets['+Inf'] = cumulative + counts[-1]
+        snapshot['buckets'] = buckets
+        return snapshot
+
+
+'''
+MetricsRegistry
+    creates metrics on first use and snapshots all of them at once
+'''
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, description, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(name)
+                if metric is None:
+                    metric = cls(name, description, **kwargs)
+                    self._metrics[name] = metric
+        if not isinstance(metric, cls):
+            raise TypeError(f'metric {name} is not a {cls.__name__}')
+        return metric
+
+    def counter(self, name, description=''):
+        return self._get_or_create(Counter, name, description)
+
+    def gauge(self, name, description='', function=None):
+        gauge = self._get_or_create(Gauge, name, description,
+                                    function=function)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, description='', buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, description,
+                                   buckets=buckets)
+
+    def snapshot(self):
+        return {name: metric.snapshot()
+                for name, metric in sorted(self._metrics.items())}
+
+
+registry = MetricsRegistry()
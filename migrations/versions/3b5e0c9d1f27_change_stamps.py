@@ -0,0 +1,28 @@
+"""change stamps
+
+Revision ID: 3b5e0c9d1f27
+Revises: 14f33a8e2114
+Create Date: 2026-10-17 09:12:40.118523
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b5e0c9d1f27'
+down_revision = '14f33a8e2114'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('change_stamps',
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('table_name')
+    )
+
+
+def downgrade():
+    op.drop_table('change_stamps')
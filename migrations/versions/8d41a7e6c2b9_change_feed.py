@@ -0,0 +1,51 @@
+"""change feed
+
+Revision ID: 8d41a7e6c2b9
+Revises: 3b5e0c9d1f27
+Create Date: 2026-10-17 11:40:03.561208
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d41a7e6c2b9'
+down_revision = '3b5e0c9d1f27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('movies', sa.Column('change_seq', sa.BigInteger(), nullable=True))
+    op.add_column('movies', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    op.create_index(op.f('ix_movies_change_seq'), 'movies', ['change_seq'], unique=False)
+    op.add_column('actors', sa.Column('change_seq', sa.BigInteger(), nullable=True))
+    op.add_column('actors', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    op.create_index(op.f('ix_actors_change_seq'), 'actors', ['change_seq'], unique=False)
+    op.create_table('tombstones',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('row_id', sa.Integer(), nullable=False),
+    sa.Column('change_seq', sa.BigInteger(), nullable=False),
+    sa.Column('deleted_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_tombstones_change_seq'), 'tombstones', ['change_seq'], unique=False)
+
+    # The rows already there make up the first change
+    op.execute("INSERT INTO change_stamps (table_name, version) VALUES ('*', 1)")
+    op.execute("UPDATE movies SET change_seq = 1, updated_at = CURRENT_TIMESTAMP")
+    op.execute("UPDATE actors SET change_seq = 1, updated_at = CURRENT_TIMESTAMP")
+
+
+def downgrade():
+    op.execute("DELETE FROM change_stamps WHERE table_name = '*'")
+    op.drop_index(op.f('ix_tombstones_change_seq'), table_name='tombstones')
+    op.drop_table('tombstones')
+    op.drop_index(op.f('ix_actors_change_seq'), table_name='actors')
+    op.drop_column('actors', 'updated_at')
+    op.drop_column('actors', 'change_seq')
+    op.drop_index(op.f('ix_movies_change_seq'), table_name='movies')
+    op.drop_column('movies', 'updated_at')
+    op.drop_column('movies', 'change_seq')
@@ -0,0 +1,32 @@
+"""movie actors
+
+Revision ID: c6f2d8a94e13
+Revises: 8d41a7e6c2b9
+Create Date: 2026-10-17 14:05:51.227340
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c6f2d8a94e13'
+down_revision = '8d41a7e6c2b9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('movie_actors',
+    sa.Column('movie_id', sa.Integer(), nullable=False),
+    sa.Column('actor_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['actor_id'], ['actors.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['movie_id'], ['movies.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+    )
+    op.create_index(op.f('ix_movie_actors_actor_id'), 'movie_actors', ['actor_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_movie_actors_actor_id'), table_name='movie_actors')
+    op.drop_table('movie_actors')
@@ -1,13 +1,21 @@
+import io
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+import time
+from datetime import datetime
+from dateutil import parser as date_parser
+from sqlalchemy import Column, String, Integer, Text, create_engine, event, select, literal, literal_column, or_, tuple_, func, cast, case, exists
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError
 from flask_sqlalchemy import SQLAlchemy
 import json
+from cooperative import session_scope
 
 database_path = os.environ['DATABASE_URL']
 if database_path.startswith("postgres://"):
   database_path = database_path.replace("postgres://", "postgresql://", 1)
 
-db = SQLAlchemy()
+# One session per greenlet under gevent workers, per thread otherwise
+db = SQLAlchemy(session_options={'scopefunc': session_scope})
 
 '''
 setup_db(app)
@@ -18,13 +26,643 @@ def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     db.app = app
     db.init_app(app)
+    if db.engine.dialect.name == 'sqlite':
+        # Cast entries go with their movie or actor, as on PostgreSQL
+        event.listen(db.engine, 'connect', _enable_foreign_keys)
+        db.engine.dispose()
     db.create_all()
 
 
+def _enable_foreign_keys(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.close()
+
+
+'''
+Write notifications
+    every committed write to a model is reported to the listeners
+    registered with on_write, as listener(model, ids) where ids is the
+    set of primary keys written (rows inserted without their key being
+    known are not listed). Writes made through the ORM are recorded at
+    flush; statements executed directly record theirs with record_write,
+    passing deleted=True for deletes. Listeners run after the commit;
+    writes rolled back are dropped.
+'''
+_write_listeners = []
+
+
+def on_write(listener):
+    _write_listeners.append(listener)
+    return listener
+
+
+def record_write(model, ids=(), deleted=False, session=None):
+    info = (session or db.session).info
+    info.setdefault('pending_writes', {}).setdefault(model, set()).update(ids)
+    if deleted:
+        info.setdefault('pending_deletes', {}) \
+            .setdefault(model, set()).update(ids)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _record_orm_writes(session, flush_context):
+    for instance in (*session.new, *session.dirty):
+        if isinstance(instance, db.Model):
+            record_write(type(instance), [instance.id], session=session)
+    for instance in session.deleted:
+        if isinstance(instance, db.Model):
+            record_write(type(instance), [instance.id], deleted=True,
+                         session=session)
+
+
+@event.listens_for(db.session, 'before_commit')
+def _stamp_writes(session):
+    # ORM writes are only recorded once flushed
+    session.flush()
+    pending = session.info.get('pending_writes')
+    if not pending:
+        return
+    seq = next_change_seq(session)
+    deletes = session.info.get('pending_deletes', {})
+    for model, ids in pending.items():
+        bump_change_stamp(model, session)
+        stamp_rows(model, ids - deletes.get(model, set()), seq, session)
+    for model, ids in deletes.items():
+        add_tombstones(model, ids, seq, session)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _notify_writes(session):
+    session.info.pop('pending_deletes', None)
+    pending = session.info.pop('pending_writes', None)
+    if not pending:
+        return
+    for model, ids in pending.items():
+        for listener in _write_listeners:
+            listener(model, ids)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_writes(session):
+    session.info.pop('pending_writes', None)
+    session.info.pop('pending_deletes', None)
+
+
+def _upsert_stamp(name, initial):
+    table = ChangeStamp.__table__
+    dialect = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+    statement = dialect.insert(table).values(table_name=name, version=initial)
+    return statement.on_conflict_do_update(
+        index_elements=[table.c.table_name],
+        set_={'version': table.c.version + 1}
+    ).execution_options(bookkeeping=True)
+
+
+'''
+Change stamps
+    one row per table in change_stamps holding a version that every
+    committing write to the table bumps, in the same transaction. It
+    changes whenever the content of the table does, so reading it (a
+    primary key lookup) tells whether anything derived from the table
+    is still fresh, across all the processes sharing the database. A
+    table gets its row, starting at the current time in milliseconds
+    so that a recreated database does not repeat old versions, on its
+    first write.
+'''
+def bump_change_stamp(model, session=None):
+    session = session or db.session
+    session.execute(_upsert_stamp(model.__tablename__,
+                                  int(time.time() * 1000)))
+
+
+'''
+get_change_stamp(model) / get_change_stamps(models)
+    the current version of the table of model, 0 before its first write;
+    get_change_stamps reads those of several tables in one query
+'''
+def get_change_stamp(model):
+    return get_change_stamps([model])[0]
+
+
+def get_change_stamps(models):
+    table = ChangeStamp.__table__
+    names = [model.__tablename__ for model in models]
+    versions = dict(db.session.execute(
+        select(table.c.table_name, table.c.version)
+        .where(table.c.table_name.in_(names))
+        .execution_options(bookkeeping=True)).all())
+    return [versions.get(name, 0) for name in names]
+
+
+'''
+Change feed
+    every committing transaction that writes to the catalog takes the
+    next change sequence number from the CHANGE_SEQ row of change_stamps
+    and stamps it, with the time, on the change_seq and updated_at
+    columns of the rows it wrote; deleted rows leave a tombstone
+    carrying it instead. Taking the number locks the row until the
+    commit, so sequence numbers become visible in increasing order and
+    a reader that has seen one has seen every smaller one.
+    changes_since() pages through the result.
+'''
+CHANGE_SEQ = '*'
+
+# Columns maintained for the change feed, left out of the resources
+BOOKKEEPING_COLUMNS = ('change_seq', 'updated_at')
+
+
+def next_change_seq(session=None):
+    session = session or db.session
+    table = ChangeStamp.__table__
+    statement = _upsert_stamp(CHANGE_SEQ, 1)
+    if db.engine.dialect.full_returning:
+        return session.execute(statement.returning(table.c.version)).scalar()
+    session.execute(statement)
+    return session.execute(
+        select(table.c.version).where(table.c.table_name == CHANGE_SEQ)
+        .execution_options(bookkeeping=True)).scalar()
+
+
+'''
+stamp_rows(model, ids, seq)
+    stamps seq on the rows of model with these ids and on those inserted
+    without being listed, which are the only ones without a change_seq
+'''
+def stamp_rows(model, ids, seq, session=None):
+    session = session or db.session
+    table = model.__table__
+    changed = table.c.change_seq.is_(None)
+    if ids:
+        changed = or_(changed, table.c.id.in_(list(ids)))
+    session.execute(table.update().where(changed)
+                    .values(change_seq=seq, updated_at=datetime.utcnow())
+                    .execution_options(bookkeeping=True))
+
+
+def add_tombstones(model, ids, seq, session=None):
+    if not ids:
+        return
+    session = session or db.session
+    deleted_at = datetime.utcnow()
+    session.execute(Tombstone.__table__.insert().execution_options(
+        bookkeeping=True), [
+        {'table_name': model.__tablename__, 'row_id': id,
+         'change_seq': seq, 'deleted_at': deleted_at}
+        for id in sorted(ids)
+    ])
+
+
+'''
+changes_since(after, limit)
+    up to `limit` changes to movies and actors made after the position
+    `after`, a (change_seq, source, id) triple, in that order, together
+    with the position to resume after (`after` itself when there is no
+    change) and whether more changes follow.
+    Each source (movies, actors, tombstones) is read with one range scan
+    of its change_seq index, so the cost follows the number of changes,
+    not the size of the tables. The scans stop at the last sequence
+    number committed before the first of them: each statement may see
+    the database as it is when it starts (READ COMMITTED), and a
+    transaction committing between two scans must not show up in some
+    sources and not in others, or the position would move past the
+    part of it read before the commit. A change is a dict with seq, table, id,
+    op ('upsert' or 'delete'), updated_at and, for upserts, the row;
+    with positions, also its own position.
+    EXAMPLE
+        changes, position, more = changes_since((120, 0, 0), limit=100)
+'''
+def changes_since(after=None, limit=100, positions=False):
+    seq, source, last_id = after or (0, 0, 0)
+    committed = _committed_change_seq()
+    changes = []
+    for index, (model, table) in enumerate(_change_sources()):
+        if index < source:
+            position = table.c.change_seq > seq
+        elif index == source:
+            position = tuple_(table.c.change_seq, table.c.id) > \
+                tuple_(seq, last_id)
+        else:
+            position = table.c.change_seq >= seq
+        statement = select(table) \
+            .where(position, table.c.change_seq <= committed) \
+            .order_by(table.c.change_seq, table.c.id).limit(limit + 1)
+        for row in db.session.execute(statement):
+            changes.append(_format_change(index, model, row._mapping))
+
+    changes.sort(key=lambda change: change['_position'])
+    more = len(changes) > limit
+    changes = changes[:limit]
+    position = changes[-1]['_position'] if changes else (seq, source, last_id)
+    for change in changes:
+        change_position = change.pop('_position')
+        if positions:
+            change['position'] = change_position
+    return changes, position, more
+
+
+'''
+latest_change_position()
+    the change feed position after every change committed so far
+'''
+def latest_change_position():
+    return (_committed_change_seq(), len(_change_sources()), 0)
+
+
+def _committed_change_seq():
+    table = ChangeStamp.__table__
+    return db.session.execute(
+        select(table.c.version).where(table.c.table_name == CHANGE_SEQ)
+        .execution_options(bookkeeping=True)).scalar() or 0
+
+
+def _change_sources():
+    return [(Movie, Movie.__table__), (Actor, Actor.__table__),
+            (Tombstone, Tombstone.__table__)]
+
+
+def _format_change(index, model, row):
+    position = (row['change_seq'], index, row['id'])
+    if model is Tombstone:
+        return {'_position': position, 'seq': row['change_seq'],
+                'table': row['table_name'], 'id': row['row_id'],
+                'op': 'delete', 'updated_at': row['deleted_at']}
+    return {'_position': position, 'seq': row['change_seq'],
+            'table': model.__tablename__, 'id': row['id'], 'op': 'upsert',
+            'updated_at': row['updated_at'],
+            'row': {column.name: row[column.name]
+                    for column in select_columns(model)}}
+
+
+'''
+select_columns(model, fields)
+    the table columns of model named in fields, in that order, or all
+    of them but the change feed bookkeeping columns when fields is None;
+    raises ValueError on an unknown name
+'''
+def select_columns(model, fields=None):
+    columns = model.__table__.columns
+    if fields is None:
+        return [column for column in columns
+                if column.name not in BOOKKEEPING_COLUMNS]
+    unknown = [field for field in fields
+               if field not in columns or field in BOOKKEEPING_COLUMNS]
+    if unknown:
+        raise ValueError('unknown fields: ' + ', '.join(unknown))
+    return [columns[field] for field in fields]
+
+
+'''
+paginate(model, after, limit, fields)
+    keyset pagination: returns up to `limit` rows of model whose primary
+    key is greater than `after`, in primary key order, together with the
+    key to resume after (None on the last page). Served by a range scan
+    of the primary key index, so the cost does not grow with the position
+    of the page. Only the columns named in fields are selected and rows
+    come back as plain dicts, without ORM instances.
+    EXAMPLE
+        movies, next_after = paginate(Movie, after=120, limit=50,
+                                      fields=['id', 'title'])
+'''
+def paginate(model, after=None, limit=50, fields=None):
+    columns = select_columns(model, fields)
+    table = model.__table__
+    statement = select(*columns, table.c.id.label('_key')) \
+        .order_by(table.c.id).limit(limit + 1)
+    if after is not None:
+        statement = statement.where(table.c.id > after)
+
+    result = db.session.execute(statement).all()
+    names = [column.name for column in columns]
+    rows = [dict(zip(names, row)) for row in result[:limit]]
+    next_after = result[limit - 1]._key if len(result) > limit else None
+    return rows, next_after
+
+
+'''
+get_rows(model, ids, fields)
+    the rows of model whose primary key is in ids, fetched in a single
+    SELECT ... WHERE id IN (...), as a dict of row dicts by id; ids
+    with no row are left out
+    EXAMPLE
+        movies = get_rows(Movie, [1, 2, 3])
+'''
+def get_rows(model, ids, fields=None):
+    if not ids:
+        return {}
+    columns = select_columns(model, fields)
+    table = model.__table__
+    statement = select(*columns, table.c.id.label('_key')) \
+        .where(table.c.id.in_(list(ids)))
+    names = [column.name for column in columns]
+    return {row._key: dict(zip(names, row))
+            for row in db.session.execute(statement)}
+
+
+'''
+stream_all(model, batch_size, fields)
+    iterates over every row of model in primary key order, as dicts of
+    the columns named in fields, through a server-side cursor buffering
+    at most `batch_size` rows at a time
+'''
+def stream_all(model, batch_size=1000, fields=None):
+    columns = select_columns(model, fields)
+    names = [column.name for column in columns]
+    statement = select(*columns).order_by(model.__table__.c.id) \
+        .execution_options(stream_results=True, max_row_buffer=batch_size)
+    for row in db.session.execute(statement):
+        yield dict(zip(names, row))
+
+
+'''
+load_related(model, ids, fields)
+    the cast of the movies with these ids, or the movies of the actors
+    with these ids: a dict of lists of row dicts by id, every id
+    present, read in a single SELECT ... JOIN movie_actors WHERE id IN
+    (...) whatever the number of ids, the way selectinload batches a
+    relationship. Related rows come in primary key order
+    EXAMPLE
+        cast = load_related(Movie, [1, 2, 3])
+'''
+def load_related(model, ids, fields=None):
+    related, own_key, related_key = _cast_sides(model)
+    columns = select_columns(related, fields)
+    statement = select(own_key.label('_owner'), *columns) \
+        .join_from(movie_actors, related.__table__,
+                   related_key == related.__table__.c.id) \
+        .where(own_key.in_(list(ids))) \
+        .order_by(own_key, related.__table__.c.id)
+    names = [column.name for column in columns]
+    loaded = {id: [] for id in ids}
+    for row in db.session.execute(statement):
+        loaded[row._owner].append(dict(zip(names, row[1:])))
+    return loaded
+
+
+def _cast_sides(model):
+    if model is Movie:
+        return Actor, movie_actors.c.movie_id, movie_actors.c.actor_id
+    return Movie, movie_actors.c.actor_id, movie_actors.c.movie_id
+
+
+'''
+render_page(model, after, limit, fields, include)
+    the page paginate() would return, rendered to JSON by the database:
+    one statement builds the JSON array of the rows (json_agg and
+    json_build_object on PostgreSQL, json_group_array and json_object on
+    SQLite), with the cast of every row under include, and hands it back
+    as text with the number of rows and the key to resume after (None
+    on the last page). Python does no work per row. Dates are written
+    as ISO-8601, the way the app encodes them.
+    EXAMPLE
+        movies_json, count, next_after = render_page(Movie, limit=50,
+                                                     include=True)
+'''
+def render_page(model, after=None, limit=50, fields=None, include=False):
+    table = model.__table__
+    json_object = _json_object(model, fields, include)
+    page = select(table.c.id.label('_key'), json_object.label('_json')) \
+        .order_by(table.c.id).limit(limit)
+    if after is not None:
+        page = page.where(table.c.id > after)
+    page = page.cte('page')
+
+    last_key = select(func.max(page.c._key)).scalar_subquery()
+    statement = select(_json_array(page.c._json, page.c._key),
+                       func.count(page.c._key),
+                       last_key,
+                       exists().where(table.c.id > last_key))
+    rows_json, count, last, more = db.session.execute(statement).one()
+    return rows_json, count, last if more else None
+
+
+def _postgresql():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def _json_object(model, fields, include):
+    pairs = []
+    for column in select_columns(model, fields):
+        pairs += [literal(column.name), _json_value(column)]
+    if include:
+        related, own_key, related_key = _cast_sides(model)
+        related_table = related.__table__
+        cast_json = select(_json_array(
+            _json_object(related, None, False), related_table.c.id)) \
+            .join_from(movie_actors, related_table,
+                       related_key == related_table.c.id) \
+            .where(own_key == model.__table__.c.id) \
+            .scalar_subquery()
+        if not _postgresql():
+            # Keep it JSON rather than a string holding JSON
+            cast_json = func.json(cast_json)
+        key = 'actors' if model is Movie else 'movies'
+        pairs += [literal(key), cast_json]
+    if _postgresql():
+        return func.json_build_object(*pairs)
+    return func.json_object(*pairs)
+
+
+def _json_array(json_object, order_key):
+    if _postgresql():
+        return func.coalesce(
+            cast(func.json_agg(postgresql.aggregate_order_by(
+                json_object, order_key)), Text),
+            '[]')
+    # Rows come in the order of the subquery
+    return func.coalesce(func.json_group_array(func.json(json_object)), '[]')
+
+
+# ISO-8601 dates, as written by datetime.isoformat(): microseconds
+# only when there are some
+def _json_value(column):
+    if not isinstance(column.type, db.DateTime):
+        return column
+    if _postgresql():
+        seconds = func.to_char(column, 'YYYY-MM-DD"T"HH24:MI:SS')
+        microseconds = func.to_char(column, 'US')
+    else:
+        # Stored as text, YYYY-MM-DD HH:MM:SS.ffffff
+        seconds = func.strftime('%Y-%m-%dT%H:%M:%S', column)
+        microseconds = func.substr(column, 21, 6)
+    return seconds + case(
+        (microseconds.notin_(['', '000000']), '.' + microseconds),
+        else_='')
+
+
+'''
+bulk_insert(model, rows)
+    inserts rows (dicts of column values) in a single statement: COPY on
+    PostgreSQL, a multi-row INSERT elsewhere. Does not commit.
+'''
+def bulk_insert(model, rows):
+    if not rows:
+        return
+    table = model.__table__
+    if db.engine.dialect.name == 'postgresql':
+        names = list(rows[0].keys())
+        buffer = _copy_csv(rows, names)
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert(
+            'COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (
+                table.name, ', '.join(names)),
+            buffer)
+    else:
+        db.session.execute(table.insert(), rows)
+    record_write(model)
+
+
+'''
+_copy_csv(rows, names)
+    the rows as COPY CSV input: every value quoted, None left as an
+    unquoted empty field, which is the only one COPY reads as NULL (a
+    quoted empty field is an empty string)
+'''
+def _copy_csv(rows, names):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write(','.join(_copy_value(row[name]) for name in names))
+        buffer.write('\n')
+    buffer.seek(0)
+    return buffer
+
+
+def _copy_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return '"%s"' % str(value).replace('"', '""')
+
+
+'''
+insert_batch(model, batch)
+    inserts a batch of (index, row) pairs with bulk_insert and commits.
+    When the batch is refused (e.g. a duplicate title) the rows are
+    retried one at a time; returns the (index, error) pairs of the rows
+    that could not be inserted
+'''
+def insert_batch(model, batch):
+    try:
+        bulk_insert(model, [row for _, row in batch])
+        db.session.commit()
+        return []
+    except Exception:
+        db.session.rollback()
+
+    failures = []
+    table = model.__table__
+    for index, row in batch:
+        try:
+            db.session.execute(table.insert(), row)
+            record_write(model)
+            db.session.commit()
+        except SQLAlchemyError as error:
+            db.session.rollback()
+            failures.append((index, error.__class__.__name__))
+    return failures
+
+
+'''
+upsert_batch(model, batch)
+    like insert_batch, for (index, row) pairs going through model.upsert;
+    returns the (index, error) pairs of the failed rows and the number
+    of rows that updated an existing one
+'''
+def upsert_batch(model, batch):
+    try:
+        stored = model.upsert([row for _, row in batch])
+        db.session.commit()
+        # Rows repeating a title of the same batch count as updates
+        return [], len(batch) - sum(1 for row in stored.values()
+                                    if row['created'])
+    except Exception:
+        db.session.rollback()
+
+    failures = []
+    updated = 0
+    for index, row in batch:
+        try:
+            stored = model.upsert([row])
+            db.session.commit()
+            updated += sum(1 for row in stored.values() if not row['created'])
+        except SQLAlchemyError as error:
+            db.session.rollback()
+            failures.append((index, error.__class__.__name__))
+    return failures, updated
+
+
+'''
+update_row(model, id, values)
+    applies values to the row of model with primary key id, in a single
+    UPDATE ... WHERE id = :id AND (<any column IS DISTINCT FROM its new
+    value>) RETURNING statement where the database supports RETURNING
+    (an UPDATE and a SELECT otherwise). Commits only when the row
+    changed; when it already held these values nothing is written and
+    the row is read back instead. Returns (row, modified) with the row
+    as a dict, or (None, False) when no row has that id
+'''
+def update_row(model, id, values):
+    table = model.__table__
+    columns = table.c
+    returned = select_columns(model)
+    changed = or_(*[columns[name].is_distinct_from(value)
+                    for name, value in values.items()])
+    statement = table.update().where(columns.id == id, changed).values(**values)
+    if db.engine.dialect.full_returning:
+        row = db.session.execute(statement.returning(*returned)).first()
+    else:
+        row = None
+        if db.session.execute(statement).rowcount:
+            row = db.session.execute(
+                select(*returned).where(columns.id == id)).first()
+    if row is not None:
+        record_write(model, [id])
+        db.session.commit()
+        return dict(row._mapping), True
+    # Nothing was written: end the transaction without a commit and tell
+    # an unchanged row apart from a missing one
+    db.session.rollback()
+    row = db.session.execute(select(*returned).where(columns.id == id)).first()
+    db.session.rollback()
+    return (None if row is None else dict(row._mapping)), False
+
+
+'''
+delete_row(model, id)
+    deletes the row of model with primary key id and commits, in a
+    single DELETE statement; returns False when no row has that id
+'''
+def delete_row(model, id):
+    table = model.__table__
+    result = db.session.execute(table.delete().where(table.c.id == id))
+    if result.rowcount == 0:
+        db.session.rollback()
+        return False
+    record_write(model, [id], deleted=True)
+    db.session.commit()
+    return True
+
+
 #----------------------------------------------------------------------------#
 # Models
 #----------------------------------------------------------------------------#
 
+'''
+movie_actors
+    the cast of the movies: which actors play in which movie
+'''
+movie_actors = db.Table(
+    'movie_actors',
+    db.Column('movie_id', db.Integer,
+              db.ForeignKey('movies.id', ondelete='CASCADE'),
+              primary_key=True),
+    db.Column('actor_id', db.Integer,
+              db.ForeignKey('actors.id', ondelete='CASCADE'),
+              primary_key=True, index=True)
+)
+
+
 '''
 Movie
     a persistent movie entity, extends the base SQLAlchemy Model
@@ -38,12 +676,100 @@ class Movie(db.Model):
     title = db.Column(db.String, nullable=False, unique=True)
     # Release Date
     release_date = db.Column(db.DateTime, nullable=False)
+    # Change feed sequence number and time of the last write
+    change_seq = db.Column(db.BigInteger, index=True)
+    updated_at = db.Column(db.DateTime)
+    # Cast; load it for many movies at once with selectinload or
+    # load_related, not one movie at a time
+    actors = db.relationship('Actor', secondary=movie_actors,
+                             back_populates='movies', passive_deletes=True,
+                             order_by='Actor.id')
 
 
     def __init__(self, title, release_date):
         self.title = title
         self.release_date = release_date
 
+    '''
+    parse(body, partial=False)
+        validates a JSON object describing a movie and returns its column
+        values, raising ValueError when it is not acceptable. With partial
+        only the fields present are validated and returned, at least one
+        of them is required
+        EXAMPLE
+            Movie.parse({'title': 'Raees', 'release_date': '10-Jan-2020'})
+            Movie.parse({'title': 'Raees'}, partial=True)
+    '''
+    @staticmethod
+    def parse(body, partial=False):
+        if not isinstance(body, dict):
+            raise ValueError('a movie must be a JSON object')
+        values = {}
+        if not partial or 'title' in body:
+            title = body.get('title')
+            if not isinstance(title, str) or not title.strip():
+                raise ValueError('title is required')
+            values['title'] = title
+        if not partial or 'release_date' in body:
+            release_date = body.get('release_date')
+            if not isinstance(release_date, str):
+                raise ValueError('release_date is required')
+            try:
+                values['release_date'] = date_parser.parse(release_date)
+            except (ValueError, OverflowError):
+                raise ValueError('release_date is not a date')
+        if not values:
+            raise ValueError('nothing to update')
+        return values
+
+    '''
+    upsert(rows)
+        creates movies, or updates the release date of those whose title
+        already exists, in one statement on PostgreSQL:
+        INSERT ... ON CONFLICT (title) DO UPDATE ... RETURNING. SQLite gets
+        the equivalent INSERT ... ON CONFLICT DO NOTHING followed, for
+        existing titles only, by an UPDATE. Returns the stored rows by
+        title, each with a `created` flag. Does not commit.
+        EXAMPLE
+            stored = Movie.upsert([Movie.parse(body)])
+    '''
+    @staticmethod
+    def upsert(rows):
+        table = Movie.__table__
+        # One statement may only touch a title once: the last row wins
+        rows = list({row['title']: row for row in rows}.values())
+
+        if db.engine.dialect.name == 'postgresql':
+            statement = postgresql.insert(table).values(rows)
+            statement = statement.on_conflict_do_update(
+                index_elements=[table.c.title],
+                set_={'release_date': statement.excluded.release_date}
+            ).returning(*select_columns(Movie),
+                        literal_column('xmax = 0').label('created'))
+            stored = {row.title: dict(row._mapping)
+                      for row in db.session.execute(statement)}
+            record_write(Movie, [row['id'] for row in stored.values()])
+            return stored
+
+        stored = {}
+        for row in rows:
+            result = db.session.execute(
+                sqlite.insert(table).values(row).on_conflict_do_nothing(
+                    index_elements=[table.c.title]))
+            if result.rowcount == 1:
+                movie_id = result.inserted_primary_key[0]
+            else:
+                db.session.execute(
+                    table.update().where(table.c.title == row['title'])
+                    .values(release_date=row['release_date']))
+                movie_id = db.session.execute(
+                    select(table.c.id).where(table.c.title == row['title'])
+                ).scalar()
+            stored[row['title']] = dict(row, id=movie_id,
+                                        created=result.rowcount == 1)
+        record_write(Movie, [row['id'] for row in stored.values()])
+        return stored
+
 
     '''
     insert()
@@ -85,6 +811,65 @@ class Movie(db.Model):
     def update(self):
         db.session.commit()
 
+    '''
+    update_by_id(id, values)
+        updates the given columns of the movie with the given id in one
+        statement, without loading it first, committing only when they
+        changed; returns (row, modified), with row None when there is no
+        such movie
+        EXAMPLE
+            movie, modified = Movie.update_by_id(id, {'title': 'The Prestige'})
+    '''
+    @classmethod
+    def update_by_id(cls, id, values):
+        return update_row(cls, id, values)
+
+    '''
+    delete_by_id(id)
+        deletes the movie with the given id in one statement, without
+        loading it first, and commits; returns False when there is no
+        such movie
+        EXAMPLE
+            deleted = Movie.delete_by_id(id)
+    '''
+    @classmethod
+    def delete_by_id(cls, id):
+        return delete_row(cls, id)
+
+    '''
+    set_cast(id, actor_ids)
+        replaces the cast of the movie with the given id and commits;
+        returns False when there is no such movie. An unknown actor id
+        raises IntegrityError
+        EXAMPLE
+            Movie.set_cast(id, [3, 7])
+    '''
+    @staticmethod
+    def set_cast(id, actor_ids):
+        movies = Movie.__table__
+        if db.session.execute(
+                select(movies.c.id).where(movies.c.id == id)).first() is None:
+            db.session.rollback()
+            return False
+        actor_ids = set(actor_ids)
+        cast = movie_actors.c
+        previous = set(db.session.execute(
+            select(cast.actor_id).where(cast.movie_id == id)).scalars())
+        db.session.execute(movie_actors.delete().where(
+            cast.movie_id == id, cast.actor_id.notin_(actor_ids)))
+        added = actor_ids - previous
+        if added:
+            db.session.execute(movie_actors.insert(), [
+                {'movie_id': id, 'actor_id': actor_id}
+                for actor_id in sorted(added)])
+        # Both sides show the cast: the movie and the actors joining or
+        # leaving it changed
+        record_write(Movie, [id])
+        if previous != actor_ids:
+            record_write(Actor, previous ^ actor_ids)
+        db.session.commit()
+        return True
+
     def format(self):
         return {
             'id': self.id,
@@ -112,6 +897,14 @@ class Actor(db.Model):
     age = db.Column(db.Integer)
     # String Gender
     gender = db.Column(db.String(6))
+    # Change feed sequence number and time of the last write
+    change_seq = db.Column(db.BigInteger, index=True)
+    updated_at = db.Column(db.DateTime)
+    # Movies played in; load them for many actors at once with
+    # selectinload or load_related, not one actor at a time
+    movies = db.relationship('Movie', secondary=movie_actors,
+                             back_populates='actors', passive_deletes=True,
+                             order_by='Movie.id')
 
 
     def __init__(self, name, age, gender):
@@ -119,6 +912,42 @@ class Actor(db.Model):
         self.age = age
         self.gender = gender
 
+    '''
+    parse(body, partial=False)
+        validates a JSON object describing an actor and returns its column
+        values, raising ValueError when it is not acceptable. With partial
+        only the fields present are validated and returned, at least one
+        of them is required
+        EXAMPLE
+            Actor.parse({'name': 'Salman Khan', 'age': 51, 'gender': 'Male'})
+            Actor.parse({'age': 52}, partial=True)
+    '''
+    @staticmethod
+    def parse(body, partial=False):
+        if not isinstance(body, dict):
+            raise ValueError('an actor must be a JSON object')
+        values = {}
+        if not partial or 'name' in body:
+            name = body.get('name')
+            if not isinstance(name, str) or not name.strip():
+                raise ValueError('name is required')
+            values['name'] = name
+        if not partial or 'age' in body:
+            age = body.get('age')
+            if age is not None and (not isinstance(age, int) or
+                                    isinstance(age, bool) or age < 0):
+                raise ValueError('age must be a positive integer')
+            values['age'] = age
+        if not partial or 'gender' in body:
+            gender = body.get('gender')
+            if gender is not None and (not isinstance(gender, str) or
+                                       len(gender) > 6):
+                raise ValueError('gender must be a string of at most 6 characters')
+            values['gender'] = gender
+        if not values:
+            raise ValueError('nothing to update')
+        return values
+
 
     '''
     insert()
@@ -159,6 +988,31 @@ class Actor(db.Model):
     def update(self):
         db.session.commit()
 
+    '''
+    update_by_id(id, values)
+        updates the given columns of the actor with the given id in one
+        statement, without loading it first, committing only when they
+        changed; returns (row, modified), with row None when there is no
+        such actor
+        EXAMPLE
+            actor, modified = Actor.update_by_id(id, {'name': 'Robert Angier'})
+    '''
+    @classmethod
+    def update_by_id(cls, id, values):
+        return update_row(cls, id, values)
+
+    '''
+    delete_by_id(id)
+        deletes the actor with the given id in one statement, without
+        loading it first, and commits; returns False when there is no
+        such actor
+        EXAMPLE
+            deleted = Actor.delete_by_id(id)
+    '''
+    @classmethod
+    def delete_by_id(cls, id):
+        return delete_row(cls, id)
+
     def format(self):
         return {
             'id': self.id,
@@ -168,4 +1022,36 @@ class Actor(db.Model):
             }
 
     def __repr__(self):
-        return json.dumps(self.format())
\ No newline at end of file
+        return json.dumps(self.format())
+
+
+
+'''
+ChangeStamp
+    the version of a table, see bump_change_stamp
+'''
+class ChangeStamp(db.Model):
+    __tablename__ = 'change_stamps'
+
+    # Name of the table, primary key
+    table_name = db.Column(db.String, primary_key=True)
+    # Bumped by every committed write to the table
+    version = db.Column(db.BigInteger, nullable=False)
+
+
+
+'''
+Tombstone
+    a deleted movie or actor, kept for the change feed
+'''
+class Tombstone(db.Model):
+    __tablename__ = 'tombstones'
+
+    # Autoincrementing, unique primary key
+    id = db.Column(db.Integer, primary_key=True)
+    # Table and primary key of the deleted row
+    table_name = db.Column(db.String, nullable=False)
+    row_id = db.Column(db.Integer, nullable=False)
+    # Change feed sequence number and time of the delete
+    change_seq = db.Column(db.BigInteger, nullable=False, index=True)
+    deleted_at = db.Column(db.DateTime, nullable=False)
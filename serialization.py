@@ -0,0 +1,467 @@
+import json
+import os
+import struct
+from datetime import date, datetime
+
+from flask import Response, request
+from sqlalchemy import DateTime, Integer, String
+
+from models import select_columns
+
+try:
+    import orjson
+except ImportError:  # optional native backend
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # optional native MessagePack codec
+    msgpack = None
+
+'''
+Serialization
+    the bodies of every endpoint. Rows are written by an encoder
+    compiled once per model and field list from the column metadata,
+    instead of being formatted and handed to jsonify one by one. Dates
+    are written as ISO-8601. The JSON backend is orjson when installed,
+    the standard library otherwise, or the one named by JSON_BACKEND.
+
+    Clients preferring MessagePack in their Accept header get the same
+    payloads in that format instead, from the msgpack package when
+    installed or from the codec of this module.
+'''
+
+# Name of the JSON backend to use, the fastest installed one when unset
+JSON_BACKEND = os.environ.get('JSON_BACKEND')
+
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+## JSON backends
+'''
+OrjsonBackend / StdlibBackend
+    dumps(value) returns the compact JSON of value as UTF-8 bytes,
+    loads(data) parses str or bytes. `native` backends write rows
+    faster than a compiled RowEncoder does and are handed them as is.
+'''
+class OrjsonBackend:
+    name = 'orjson'
+    native = True
+
+    @staticmethod
+    def available():
+        return orjson is not None
+
+    def dumps(self, value):
+        return orjson.dumps(value, default=_default)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class StdlibBackend:
+    name = 'json'
+    native = False
+
+    @staticmethod
+    def available():
+        return True
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(ensure_ascii=False,
+                                         separators=(',', ':'),
+                                         default=_default)
+
+    def dumps(self, value):
+        return self._encoder.encode(value).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+# Fastest first
+JSON_BACKENDS = {
+    backend.name: backend
+    for backend in (OrjsonBackend, StdlibBackend)
+}
+
+
+'''
+get_json_backend(name)
+    returns an instance of the named backend, or of the fastest one
+    installed when name is None
+'''
+def get_json_backend(name=None):
+    if name is not None:
+        backend = JSON_BACKENDS.get(name)
+        if backend is None or not backend.available():
+            raise ValueError(f'JSON backend {name} is not available')
+        return backend()
+    for backend in JSON_BACKENDS.values():
+        if backend.available():
+            return backend()
+
+
+backend = get_json_backend(JSON_BACKEND)
+
+
+def dumps(value):
+    return backend.dumps(value)
+
+
+def loads(data):
+    return backend.loads(data)
+
+
+## Row encoders
+def _encode_number(value):
+    return 'null' if value is None else str(value)
+
+
+def _encode_string(value, encode=json.encoder.encode_basestring):
+    return 'null' if value is None else encode(value)
+
+
+def _encode_datetime(value):
+    return 'null' if value is None else '"%s"' % value.isoformat()
+
+
+def _encode_value(value):
+    return backend.dumps(value).decode('utf-8')
+
+
+def _column_encoder(column):
+    if isinstance(column.type, DateTime):
+        return _encode_datetime
+    if isinstance(column.type, String):
+        return _encode_string
+    if isinstance(column.type, Integer):
+        return _encode_number
+    return _encode_value
+
+
+'''
+RowEncoder(model, fields, related)
+    writes row dicts holding the columns of model named in fields (all
+    of them when None), in that order, plus the list of related rows
+    under the key of `related` = (key, encoder) when given. The keys are
+    escaped once and every column gets the function writing its type,
+    so a row costs one string formatting. Native backends are handed the
+    rows instead.
+    EXAMPLE
+        encoder = RowEncoder(Movie, ['id', 'title'])
+        encoder.encode_rows([{'id': 1, 'title': 'Raees'}])
+'''
+class RowEncoder:
+    def __init__(self, model, fields=None, related=None):
+        columns = select_columns(model, fields)
+        self.names = [column.name for column in columns]
+        self._columns = [(column.name, _column_encoder(column))
+                         for column in columns]
+        if related is not None:
+            key, encoder = related
+            self._columns.append((key, encoder._encode_list))
+        self._template = '{%s}' % ','.join(
+            json.dumps(name) + ':%s' for name, _ in self._columns)
+
+    def _encode_row(self, row):
+        return self._template % tuple(
+            encode(row[name]) for name, encode in self._columns)
+
+    def _encode_list(self, rows):
+        return '[%s]' % ','.join(map(self._encode_row, rows))
+
+    '''
+    encode_row(row) / encode_rows(rows)
+        the JSON bytes of one row / of a list of rows
+    '''
+    def encode_row(self, row):
+        if backend.native:
+            return backend.dumps(row)
+        return self._encode_row(row).encode('utf-8')
+
+    def encode_rows(self, rows):
+        if backend.native:
+            return backend.dumps(rows)
+        return self._encode_list(rows).encode('utf-8')
+
+    '''
+    encode_items(rows)
+        the rows joined by commas, without the brackets, to be sent as
+        part of a longer array
+    '''
+    def encode_items(self, rows):
+        if backend.native:
+            return backend.dumps(rows)[1:-1]
+        return ','.join(map(self._encode_row, rows)).encode('utf-8')
+
+
+_encoders = {}
+
+
+'''
+get_encoder(model, fields, related)
+    the RowEncoder of model for these fields, with the rows of the
+    related model (all of their columns) under the key of
+    related = (key, related_model); compiled on first use
+'''
+def get_encoder(model, fields=None, related=None):
+    cache_key = (model, None if fields is None else tuple(fields), related)
+    encoder = _encoders.get(cache_key)
+    if encoder is None:
+        if related is not None:
+            key, related_model = related
+            related = (key, get_encoder(related_model))
+        encoder = RowEncoder(model, fields, related)
+        _encoders[cache_key] = encoder
+    return encoder
+
+
+## MessagePack
+_pack_struct = {
+    fmt: struct.Struct('>B' + fmt).pack for fmt in 'BHIQbhiqd'
+}
+
+
+def _pack_int(value, parts):
+    if 0 <= value < 0x80:
+        parts.append(_FIXINTS[value])
+    elif -32 <= value < 0:
+        parts.append(_FIXINTS[value + 0x100])
+    elif value > 0:
+        if value <= 0xff:
+            parts.append(_pack_struct['B'](0xcc, value))
+        elif value <= 0xffff:
+            parts.append(_pack_struct['H'](0xcd, value))
+        elif value <= 0xffffffff:
+            parts.append(_pack_struct['I'](0xce, value))
+        else:
+            parts.append(_pack_struct['Q'](0xcf, value))
+    elif value >= -0x80:
+        parts.append(_pack_struct['b'](0xd0, value))
+    elif value >= -0x8000:
+        parts.append(_pack_struct['h'](0xd1, value))
+    elif value >= -0x80000000:
+        parts.append(_pack_struct['i'](0xd2, value))
+    else:
+        parts.append(_pack_struct['q'](0xd3, value))
+
+
+def _pack_header(size, fix, fix_limit, codes, parts):
+    if size < fix_limit:
+        parts.append(_FIXINTS[fix | size])
+    elif size <= 0xff and codes[0] is not None:
+        parts.append(_pack_struct['B'](codes[0], size))
+    elif size <= 0xffff:
+        parts.append(_pack_struct['H'](codes[1], size))
+    else:
+        parts.append(_pack_struct['I'](codes[2], size))
+
+
+def _pack_str(value, parts):
+    data = value.encode('utf-8')
+    _pack_header(len(data), 0xa0, 32, (0xd9, 0xda, 0xdb), parts)
+    parts.append(data)
+
+
+def _pack_bin(value, parts):
+    _pack_header(len(value), 0, 0, (0xc4, 0xc5, 0xc6), parts)
+    parts.append(bytes(value))
+
+
+def _pack_float(value, parts):
+    parts.append(_pack_struct['d'](0xcb, value))
+
+
+def _pack_list(value, parts):
+    _pack_header(len(value), 0x90, 16, (None, 0xdc, 0xdd), parts)
+    for item in value:
+        _pack(item, parts)
+
+
+def _pack_dict(value, parts):
+    _pack_header(len(value), 0x80, 16, (None, 0xde, 0xdf), parts)
+    for key, item in value.items():
+        _pack(key, parts)
+        _pack(item, parts)
+
+
+def _pack_constant(value, parts):
+    parts.append(_CONSTANTS[value])
+
+
+_FIXINTS = [bytes((byte,)) for byte in range(0x100)]
+_CONSTANTS = {None: b'\xc0', False: b'\xc2', True: b'\xc3'}
+_PACKERS = {
+    type(None): _pack_constant, bool: _pack_constant, int: _pack_int,
+    float: _pack_float, str: _pack_str, bytes: _pack_bin,
+    bytearray: _pack_bin, list: _pack_list, tuple: _pack_list,
+    dict: _pack_dict
+}
+
+
+def _pack(value, parts):
+    packer = _PACKERS.get(type(value))
+    if packer is not None:
+        return packer(value, parts)
+    for cls, packer in _PACKERS.items():
+        if isinstance(value, cls):
+            return packer(value, parts)
+    _pack(_default(value), parts)
+
+
+_unpack_struct = {
+    fmt: struct.Struct('>' + fmt).unpack_from for fmt in 'BHIQbhiqfd'
+}
+# Type byte: (struct format of the value or of its size, kind)
+_UNPACKERS = {
+    0xc4: ('B', 'bin'), 0xc5: ('H', 'bin'), 0xc6: ('I', 'bin'),
+    0xca: ('f', 'value'), 0xcb: ('d', 'value'),
+    0xcc: ('B', 'value'), 0xcd: ('H', 'value'), 0xce: ('I', 'value'),
+    0xcf: ('Q', 'value'), 0xd0: ('b', 'value'), 0xd1: ('h', 'value'),
+    0xd2: ('i', 'value'), 0xd3: ('q', 'value'),
+    0xd9: ('B', 'str'), 0xda: ('H', 'str'), 0xdb: ('I', 'str'),
+    0xdc: ('H', 'array'), 0xdd: ('I', 'array'),
+    0xde: ('H', 'map'), 0xdf: ('I', 'map')
+}
+_SIZES = {'B': 1, 'H': 2, 'I': 4, 'Q': 8, 'b': 1, 'h': 2, 'i': 4, 'q': 8,
+          'f': 4, 'd': 8}
+
+
+def _unpack(data, position):
+    byte = data[position]
+    position += 1
+    if byte < 0x80:
+        return byte, position
+    if byte >= 0xe0:
+        return byte - 0x100, position
+    if byte < 0x90:
+        kind, size = 'map', byte & 0x0f
+    elif byte < 0xa0:
+        kind, size = 'array', byte & 0x0f
+    elif byte < 0xc0:
+        kind, size = 'str', byte & 0x1f
+    elif byte in (0xc0, 0xc2, 0xc3):
+        return (None, None, False, True)[byte - 0xc0], position
+    elif byte in _UNPACKERS:
+        fmt, kind = _UNPACKERS[byte]
+        size, = _unpack_struct[fmt](data, position)
+        position += _SIZES[fmt]
+        if kind == 'value':
+            return size, position
+    else:
+        raise ValueError('unsupported MessagePack type 0x%02x' % byte)
+
+    if kind == 'str' or kind == 'bin':
+        end = position + size
+        if end > len(data):
+            raise ValueError('truncated MessagePack data')
+        value = bytes(data[position:end])
+        return (value.decode('utf-8') if kind == 'str' else value), end
+    if kind == 'array':
+        items = []
+        for _ in range(size):
+            item, position = _unpack(data, position)
+            items.append(item)
+        return items, position
+    items = {}
+    for _ in range(size):
+        key, position = _unpack(data, position)
+        items[key], position = _unpack(data, position)
+    return items, position
+
+
+'''
+packb(value) / unpackb(data)
+    the MessagePack bytes of value / the value of MessagePack bytes;
+    dates are packed as ISO-8601 strings, like in JSON. unpackb raises
+    ValueError on malformed data
+'''
+def packb(value):
+    if msgpack is not None:
+        return msgpack.packb(value, default=_default, use_bin_type=True)
+    parts = []
+    _pack(value, parts)
+    return b''.join(parts)
+
+
+def unpackb(data):
+    if msgpack is not None:
+        return msgpack.unpackb(data, raw=False)
+    try:
+        value, end = _unpack(memoryview(data), 0)
+    except (IndexError, struct.error) as error:
+        raise ValueError('truncated MessagePack data') from error
+    if end != len(data):
+        raise ValueError('extra data after MessagePack value')
+    return value
+
+
+## Responses
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack',
+                     'application/vnd.msgpack')
+# JSON first: it is sent unless the Accept header prefers MessagePack
+RESPONSE_MIMETYPES = (JSON_MIMETYPE,) + MSGPACK_MIMETYPES
+
+
+'''
+response_mimetype()
+    the media type the response to the current request is sent in,
+    negotiated from its Accept header
+'''
+def response_mimetype():
+    return request.accept_mimetypes.best_match(RESPONSE_MIMETYPES,
+                                               JSON_MIMETYPE)
+
+
+def _response(body, status, mimetype):
+    response = Response(body, status=status, mimetype=mimetype)
+    response.vary.add('Accept')
+    return response
+
+
+'''
+api_response(payload, status)
+    a response carrying payload in the negotiated format
+'''
+def api_response(payload, status=200):
+    mimetype = response_mimetype()
+    if mimetype != JSON_MIMETYPE:
+        return _response(packb(payload), status, mimetype)
+    return _response(backend.dumps(payload) + b'\n', status, mimetype)
+
+
+'''
+rows_response(key, rows, encode, **payload)
+    a successful response carrying rows (a row or a list of them) under
+    `key`, then the other members of payload, in the negotiated format.
+    encode is the RowEncoder method writing the rows as JSON
+    EXAMPLE
+        rows_response('movies', rows, encoder.encode_rows,
+                      next_cursor=None)
+'''
+def rows_response(key, rows, encode, **payload):
+    mimetype = response_mimetype()
+    if mimetype != JSON_MIMETYPE:
+        return _response(packb(dict({'success': True, key: rows}, **payload)),
+                         200, mimetype)
+    return json_rows_response(key, encode(rows), **payload)
+
+
+'''
+json_rows_response(key, rows_json, **payload)
+    a successful JSON response carrying JSON already encoded (by a
+    RowEncoder or by the database) under `key`, then the other members
+    of payload
+'''
+def json_rows_response(key, rows_json, **payload):
+    body = [b'{"success":true,', backend.dumps(key), b':', rows_json]
+    for name, value in payload.items():
+        body += [b',', backend.dumps(name), b':', backend.dumps(value)]
+    body.append(b'}\n')
+    return _response(b''.join(body), 200, JSON_MIMETYPE)
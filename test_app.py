@@ -1,11 +1,54 @@
+import gzip
+import importlib.util
 import os
+import threading
+import time
+import tracemalloc
+import types
 import unittest
+import unittest.mock
+import warnings
 import json
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.orm import selectinload
 
 # from flaskr import create_app
-from app import create_app
-from models import setup_db, Movie, Actor
+from app import create_app, APP, encode_cursor
+from models import setup_db, db, Movie, Actor, ChangeStamp, Tombstone, movie_actors, get_change_stamp, bump_change_stamp, record_write, changes_since
+import auth
+from auth import jwks_cache, fetch_jwks, token_cache, http_client
+from cache import RowCache, row_cache, response_cache
+from compression import CompressionMiddleware
+import cooperative
+import models
+from metrics import registry
+from events import broadcaster, Subscription, RESET
+from jwt_testing import generate_rsa_key, make_jwks, mint_token, static_fetcher
+import serialization
+from serialization import JSON_BACKENDS, get_json_backend, get_encoder, packb, unpackb
+
+
+GUNICORN_CONF = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'gunicorn.conf.py')
+
+
+def load_gunicorn_conf(**environ):
+    """Import gunicorn.conf.py as gunicorn would, under extra environment"""
+    spec = importlib.util.spec_from_file_location('gunicorn_conf',
+                                                  GUNICORN_CONF)
+    conf = importlib.util.module_from_spec(spec)
+    with unittest.mock.patch.dict(os.environ, environ):
+        spec.loader.exec_module(conf)
+    return conf
+
+
+def setUpModule():
+    global SIGNING_KEY
+    SIGNING_KEY = generate_rsa_key('test-key', bits=1024)
 
 
 class CastingAgencyTestCase(unittest.TestCase):
@@ -57,7 +100,7 @@ class CastingAgencyTestCase(unittest.TestCase):
     
 
     def test_404_sent_requesting_individual_movie(self):
-        res = self.client().get('/movies/2')
+        res = self.client().get('/movies/10000')
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
@@ -75,7 +118,7 @@ class CastingAgencyTestCase(unittest.TestCase):
     
 
     def test_404_sent_requesting_individual_actor(self):
-        res = self.client().get('/actors/1')
+        res = self.client().get('/actors/10000')
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
@@ -95,13 +138,13 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(movie, None)
     
 
-    def test_422_sent_if_movie_does_not_exist(self):
+    def test_404_sent_if_movie_does_not_exist(self):
         res = self.client().delete('/movies/210')
         data = json.loads(res.data)
 
-        self.assertEqual(res.status_code, 422)
+        self.assertEqual(res.status_code, 404)
         self.assertEqual(data['success'], False)
-        self.assertEqual(data['message'], 'Unprocessable')
+        self.assertEqual(data['message'], 'Resource Not Found')
     
 
     def test_delete_actor(self):
@@ -116,13 +159,13 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(actor, None)
     
 
-    def test_422_sent_if_actor_does_not_exist(self):
+    def test_404_sent_if_actor_does_not_exist(self):
         res = self.client().delete('/actors/121')
         data = json.loads(res.data)
 
-        self.assertEqual(res.status_code, 422)
+        self.assertEqual(res.status_code, 404)
         self.assertEqual(data['success'], False)
-        self.assertEqual(data['message'], 'Unprocessable')
+        self.assertEqual(data['message'], 'Resource Not Found')
 
     
     def test_create_new_movie(self):
@@ -189,6 +232,1867 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
 
 
+
+class CatalogTestCase(unittest.TestCase):
+    """Base class for test cases running against a freshly seeded catalog"""
+
+    movie_count = 0
+    actor_count = 0
+
+    def setUp(self):
+        self.app = APP
+        self.client = self.app.test_client
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+        Movie.query.delete()
+        Actor.query.delete()
+        ChangeStamp.query.delete()
+        Tombstone.query.delete()
+        if self.movie_count:
+            db.session.execute(Movie.__table__.insert(), [
+                {'id': i, 'title': f'Movie {i}',
+                 'release_date': datetime(2000 + i % 20, 1, 1)}
+                for i in range(1, self.movie_count + 1)
+            ])
+        if self.actor_count:
+            db.session.execute(Actor.__table__.insert(), [
+                {'id': i, 'name': f'Actor {i}', 'age': 20 + i % 50,
+                 'gender': 'Female' if i % 2 else 'Male'}
+                for i in range(1, self.actor_count + 1)
+            ])
+        db.session.commit()
+        row_cache.clear()
+        response_cache.clear()
+        jwks_cache.clear()
+        jwks_cache.fetcher = static_fetcher(make_jwks([SIGNING_KEY]))
+
+    def tearDown(self):
+        jwks_cache.clear()
+        jwks_cache.fetcher = fetch_jwks
+        db.session.remove()
+        self.context.pop()
+
+    def auth_headers(self, *permissions):
+        token = mint_token(SIGNING_KEY[0], 'test-key', permissions=permissions)
+        return {'Authorization': 'Bearer ' + token}
+
+    @contextmanager
+    def count_queries(self, include_bookkeeping=False):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters,
+                                  context, executemany):
+            # Statements keeping change stamps and the change feed
+            # up to date, or reading a change stamp, are left out
+            if (include_bookkeeping or
+                    not context.execution_options.get('bookkeeping')):
+                statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+
+
+class PaginationTestCase(CatalogTestCase):
+    """This class represents the keyset pagination test case"""
+
+    movie_count = 25
+    actor_count = 3
+
+    def test_first_page(self):
+        res = self.client().get('/movies?limit=10')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([m['id'] for m in data['movies']], list(range(1, 11)))
+        self.assertTrue(data['next_cursor'])
+
+    def test_walk_all_pages(self):
+        ids = []
+        url = '/movies?limit=10'
+        while url:
+            data = json.loads(self.client().get(url).data)
+            ids += [m['id'] for m in data['movies']]
+            url = data['next_cursor'] and \
+                '/movies?limit=10&after=' + data['next_cursor']
+
+        self.assertEqual(ids, list(range(1, 26)))
+
+    def test_last_page_has_no_cursor(self):
+        data = json.loads(self.client().get('/actors?limit=3').data)
+
+        self.assertEqual(len(data['actors']), 3)
+        self.assertIsNone(data['next_cursor'])
+
+    def test_page_size_clamped_to_maximum(self):
+        self.app.config['MAX_PAGE_SIZE'] = 5
+        try:
+            data = json.loads(self.client().get('/movies?limit=1000').data)
+        finally:
+            self.app.config['MAX_PAGE_SIZE'] = 200
+
+        self.assertEqual(len(data['movies']), 5)
+
+    def test_400_sent_for_invalid_page_arguments(self):
+        self.assertEqual(self.client().get('/movies?limit=0').status_code, 400)
+        self.assertEqual(self.client().get('/movies?limit=x').status_code, 400)
+        self.assertEqual(
+            self.client().get('/movies?after=not-a-cursor').status_code, 400)
+
+    def test_404_sent_for_empty_table(self):
+        Movie.query.delete()
+        db.session.commit()
+
+        self.assertEqual(self.client().get('/movies').status_code, 404)
+
+
+
+class FieldProjectionTestCase(CatalogTestCase):
+    """This class represents the ?fields= column projection test case"""
+
+    movie_count = 3
+    actor_count = 3
+
+    def test_page_with_selected_fields(self):
+        data = json.loads(self.client().get('/movies?fields=id,title').data)
+
+        self.assertEqual(data['movies'][0], {'id': 1, 'title': 'Movie 1'})
+
+    def test_fields_without_id_still_paginate(self):
+        data = json.loads(
+            self.client().get('/actors?fields=name&limit=2').data)
+
+        self.assertEqual(data['actors'], [{'name': 'Actor 1'},
+                                          {'name': 'Actor 2'}])
+        data = json.loads(self.client().get(
+            '/actors?fields=name&limit=2&after=' + data['next_cursor']).data)
+        self.assertEqual(data['actors'], [{'name': 'Actor 3'}])
+
+    def test_rows_match_format(self):
+        data = json.loads(self.client().get('/actors?limit=1').data)
+
+        self.assertEqual(data['actors'][0],
+                         json.loads(json.dumps(Actor.query.get(1).format())))
+
+    def test_stream_with_selected_fields(self):
+        data = json.loads(
+            self.client().get('/actors?stream=true&fields=id,age').data)
+
+        self.assertEqual(data['actors'][2], {'id': 3, 'age': 23})
+
+    def test_400_sent_for_unknown_field(self):
+        res = self.client().get('/movies?fields=id,budget')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['message'], 'Bad Request')
+        self.assertEqual(
+            self.client().get('/movies?stream=true&fields=x').status_code, 400)
+
+
+class BulkCreateTestCase(CatalogTestCase):
+    """This class represents the bulk create endpoints test case"""
+
+    movie_count = 1
+
+    def setUp(self):
+        super().setUp()
+        self.app.config['BULK_BATCH_SIZE'] = 2
+
+    def tearDown(self):
+        self.app.config['BULK_BATCH_SIZE'] = 1000
+        super().tearDown()
+
+    def test_bulk_create_actors_from_json_array(self):
+        res = self.client().post('/actors/bulk', json=[
+            {'name': 'Actor A', 'age': 30, 'gender': 'Female'},
+            {'name': 'Actor B'},
+            {'name': 'Actor C', 'age': 41, 'gender': 'Male'}
+        ], headers=self.auth_headers('post:actors'))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors'], {'received': 3, 'created': 3,
+                                          'failed': []})
+        self.assertEqual(Actor.query.count(), 3)
+
+    def test_bulk_create_movies_from_ndjson(self):
+        body = '\n'.join([
+            json.dumps({'title': 'Raees', 'release_date': '10-Jan-2020'}),
+            json.dumps({'title': 'Movie 1', 'release_date': '2001-01-01'}),
+            '{not json',
+            json.dumps({'release_date': '2001-01-01'}),
+            json.dumps({'title': 'Don', 'release_date': '2006-10-20'}),
+            ''
+        ])
+        res = self.client().post('/movies/bulk', data=body,
+                                 content_type='application/x-ndjson',
+                                 headers=self.auth_headers('post:movies'))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movies']['received'], 5)
+        self.assertEqual(data['movies']['created'], 2)
+        # 'Movie 1' already exists, then a parse and a validation error
+        self.assertEqual([f['index'] for f in data['movies']['failed']],
+                         [1, 2, 3])
+        self.assertEqual(
+            sorted(m.title for m in Movie.query.all()),
+            ['Don', 'Movie 1', 'Raees'])
+
+    def test_single_actor_validated_like_bulk(self):
+        headers = self.auth_headers('post:actors')
+        for body in ({'name': 'Actor A', 'age': 'old'},
+                     {'name': 'Actor A', 'gender': 'Unspecified'}):
+            res = self.client().post('/actors', json=body, headers=headers)
+            self.assertEqual(res.status_code, 400)
+        res = self.client().post('/actors', data='not json',
+                                 headers=headers)
+        self.assertEqual(res.status_code, 400)
+
+        res = self.client().post('/actors', json={'name': 'Actor A'},
+                                 headers=headers)
+        self.assertEqual(json.loads(res.data)['actors']['name'], 'Actor A')
+        self.assertEqual(Actor.query.count(), 1)
+
+    def test_copy_input_writes_none_as_null(self):
+        buffer = models._copy_csv([
+            {'name': 'Actor "A"', 'age': None, 'gender': ''},
+            {'name': 'Actor B', 'age': 30, 'gender': None}
+        ], ['name', 'age', 'gender'])
+
+        # COPY reads only an unquoted empty field as NULL
+        self.assertEqual(buffer.read(),
+                         '"Actor ""A""",,""\n"Actor B","30",\n')
+
+    def test_400_sent_for_bulk_body_that_is_not_an_array(self):
+        res = self.client().post('/actors/bulk', json={'name': 'Actor A'},
+                                 headers=self.auth_headers('post:actors'))
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_bulk_create_requires_permission(self):
+        res = self.client().post('/movies/bulk', json=[],
+                                 headers=self.auth_headers('post:actors'))
+
+        self.assertEqual(res.status_code, 403)
+
+
+class UpsertTestCase(CatalogTestCase):
+    """This class represents the movie upsert test case"""
+
+    movie_count = 2
+
+    def post_movie(self, title, release_date, query='?upsert=true'):
+        return self.client().post('/movies' + query, json={
+            'title': title, 'release_date': release_date
+        }, headers=self.auth_headers('post:movies'))
+
+    def test_upsert_creates_new_movie(self):
+        res = self.post_movie('Raees', '2017-01-25')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], True)
+        self.assertEqual(data['movies']['title'], 'Raees')
+        self.assertEqual(Movie.query.get(data['movies']['id']).title, 'Raees')
+
+    def test_upsert_updates_existing_title(self):
+        res = self.post_movie('Movie 1', '2020-03-23')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], False)
+        self.assertEqual(data['movies']['id'], 1)
+        self.assertEqual(Movie.query.get(1).release_date,
+                         datetime(2020, 3, 23))
+        self.assertEqual(Movie.query.count(), 2)
+
+    def test_422_sent_for_duplicate_title_without_upsert(self):
+        res = self.post_movie('Movie 1', '2020-03-23', query='')
+
+        self.assertEqual(res.status_code, 422)
+
+    def test_create_movie_without_upsert(self):
+        res = self.post_movie('Raees', '10-Jan-2020', query='')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movies']['title'], 'Raees')
+
+    def test_bulk_upsert(self):
+        res = self.client().post('/movies/bulk?upsert=true', json=[
+            {'title': 'Movie 1', 'release_date': '2021-01-01'},
+            {'title': 'Don', 'release_date': '2006-10-20'},
+            {'title': 'Movie 2', 'release_date': '2022-01-01'}
+        ], headers=self.auth_headers('post:movies'))
+        data = json.loads(res.data)
+
+        self.assertEqual(data['movies'], {'received': 3, 'created': 1,
+                                          'updated': 2, 'failed': []})
+        self.assertEqual(Movie.query.get(2).release_date, datetime(2022, 1, 1))
+
+    def test_400_sent_for_actor_upsert(self):
+        res = self.client().post('/actors/bulk?upsert=true',
+                                 json=[{'name': 'Actor A'}],
+                                 headers=self.auth_headers('post:actors'))
+
+        self.assertEqual(res.status_code, 400)
+
+
+class RowCacheTestCase(CatalogTestCase):
+    """This class represents the single and multi-get endpoints test case"""
+
+    movie_count = 5
+    actor_count = 5
+
+    def setUp(self):
+        super().setUp()
+        # Change stamps are read again once the clock moves past the TTL
+        self.now = 0.0
+        row_cache.clock = lambda: self.now
+
+    def tearDown(self):
+        row_cache.clock = time.monotonic
+        super().tearDown()
+
+    def test_get_movie(self):
+        res = self.client().get('/movies/2')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movies']['title'], 'Movie 2')
+
+    def test_404_sent_requesting_missing_actor(self):
+        res = self.client().get('/actors/99')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['message'], 'Resource Not Found')
+
+    def test_get_actor_fields(self):
+        res = self.client().get('/actors/3?fields=id,name')
+        data = json.loads(res.data)
+
+        self.assertEqual(data['actors'], {'id': 3, 'name': 'Actor 3'})
+
+    def test_multi_get_in_one_query(self):
+        with self.count_queries(include_bookkeeping=True) as statements:
+            res = self.client().get('/movies?ids=4,1,99,4')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['id'] for movie in data['movies']], [4, 1])
+        self.assertEqual(data['missing'], [99])
+        # The change stamp of the table, then the rows
+        self.assertEqual(len(statements), 2)
+        self.assertIn('change_stamps', statements[0])
+        self.assertIn(' IN ', statements[1])
+
+    def test_repeated_reads_are_served_from_cache(self):
+        self.client().get('/actors?ids=1,2,3')
+        self.client().get('/actors/3')
+        with self.count_queries(include_bookkeeping=True) as statements:
+            res = self.client().get('/actors?ids=1,2')
+            self.client().get('/actors/3')
+            self.client().get('/actors/3')
+
+        self.assertEqual(len(json.loads(res.data)['actors']), 2)
+        # Only the change stamp the multi-get reads for its ETag
+        self.assertEqual(len(statements), 1)
+        self.assertIn('change_stamps', statements[0])
+        self.assertEqual(row_cache.hits, 5)
+
+    def test_change_stamp_read_again_after_ttl(self):
+        self.client().get('/actors/1')
+        self.now += row_cache.stamp_ttl
+        with self.count_queries(include_bookkeeping=True) as statements:
+            self.client().get('/actors/1')
+            self.client().get('/actors/1')
+
+        self.assertEqual(len(statements), 1)
+        self.assertIn('change_stamps', statements[0])
+        self.assertEqual(row_cache.hits, 2)
+
+    def test_only_misses_are_queried(self):
+        self.client().get('/movies/1')
+        with self.count_queries(include_bookkeeping=True) as statements:
+            self.client().get('/movies?ids=1,2')
+
+        # The change stamp for the ETag, then movie 2
+        self.assertEqual(len(statements), 2)
+        self.assertIn(' IN ', statements[1])
+
+    def test_update_invalidates_cached_row(self):
+        self.client().get('/actors/1')
+        self.client().patch('/actors/1', json={'age': 70},
+                            headers=self.auth_headers('patch:actors'))
+        res = self.client().get('/actors/1')
+
+        self.assertEqual(json.loads(res.data)['actors']['age'], 70)
+
+    def test_orm_update_invalidates_cached_row(self):
+        self.client().get('/movies/1')
+        movie = Movie.query.get(1)
+        movie.title = 'The Prestige'
+        movie.update()
+        res = self.client().get('/movies/1')
+
+        self.assertEqual(json.loads(res.data)['movies']['title'],
+                         'The Prestige')
+
+    def test_delete_invalidates_cached_row(self):
+        self.client().get('/movies/5')
+        self.client().delete('/movies/5',
+                             headers=self.auth_headers('delete:movies'))
+        res = self.client().get('/movies/5')
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_rolled_back_write_keeps_cached_row(self):
+        self.client().get('/movies/1')
+        movie = Movie.query.get(1)
+        movie.title = 'Draft'
+        db.session.flush()
+        db.session.rollback()
+
+        self.assertIsNotNone(row_cache.get(Movie, 1, get_change_stamp(Movie)))
+
+    def test_row_read_before_a_write_is_not_cached(self):
+        stamp = get_change_stamp(Actor)
+        record_write(Actor, [2])
+        db.session.commit()
+        row_cache.put(Actor, 1, {'id': 1, 'name': 'Stale'}, stamp)
+
+        self.assertIsNone(row_cache.get(Actor, 1, get_change_stamp(Actor)))
+
+    def test_write_of_another_process_retires_cached_row(self):
+        self.client().get('/actors/1')
+        # Committed elsewhere: only the change stamp in the database moves
+        db.session.execute(Actor.__table__.update()
+                           .where(Actor.__table__.c.id == 1).values(age=77))
+        bump_change_stamp(Actor)
+        db.session.commit()
+        res = self.client().get('/actors/1')
+        self.assertEqual(json.loads(res.data)['actors']['age'], 21)
+
+        self.now += row_cache.stamp_ttl
+        res = self.client().get('/actors/1')
+        self.assertEqual(json.loads(res.data)['actors']['age'], 77)
+        # The multi-get reads the stamp for its ETag, never a stale one
+        res = self.client().get('/actors?ids=1')
+        self.assertEqual(json.loads(res.data)['actors'][0]['age'], 77)
+
+    def test_stamp_read_across_a_write_is_not_kept(self):
+        def write_while_reading(*args, **kwargs):
+            stamp = get_change_stamp(Movie)
+            row_cache.invalidate(Movie, [1])
+            return stamp
+
+        with unittest.mock.patch('cache.get_change_stamp',
+                                 write_while_reading):
+            row_cache.stamp(Movie)
+        with self.count_queries(include_bookkeeping=True) as statements:
+            row_cache.stamp(Movie)
+
+        self.assertEqual(len(statements), 1)
+
+    def test_cache_bounded_by_rows_not_writes(self):
+        cache = RowCache(maxsize=2)
+        for id in range(1, 5):
+            cache.put(Movie, id, {'id': id}, 0)
+            cache.invalidate(Movie, [id])
+            cache.put(Movie, id, {'id': id}, 1)
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(Movie, 1, 1))
+        self.assertEqual(cache.get(Movie, 4, 1), {'id': 4})
+        self.assertIsNone(cache.get(Movie, 4, 2))
+
+    def test_400_sent_for_invalid_ids(self):
+        for ids in ('1,x', ',', ','.join(str(i) for i in range(1, 500))):
+            res = self.client().get('/movies?ids=' + ids)
+            self.assertEqual(res.status_code, 400)
+
+    def test_hit_ratio_reported_in_metrics(self):
+        self.client().get('/movies/1')
+        self.client().get('/movies/1')
+        res = self.client().get('/metrics')
+        metrics = json.loads(res.data)['metrics']
+
+        self.assertEqual(metrics['row_cache_hit_ratio'], 0.5)
+
+
+class ResponseCacheTestCase(CatalogTestCase):
+    """This class represents the list endpoints response cache test case"""
+
+    movie_count = 3
+    actor_count = 3
+
+    def test_repeated_list_is_served_from_cache(self):
+        first = self.client().get('/movies?limit=2&fields=id,title')
+        with self.count_queries() as statements:
+            second = self.client().get('/movies?fields=id,title&limit=2')
+
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second.mimetype, 'application/json')
+        self.assertEqual(statements, [])
+
+    def test_write_invalidates_only_its_table(self):
+        self.client().get('/movies')
+        self.client().get('/actors')
+        self.client().post('/movies', json={
+            'title': 'New Movie', 'release_date': '10-Jan-2020'
+        }, headers=self.auth_headers('post:movies'))
+        movies = self.client().get('/movies')
+        actors = self.client().get('/actors')
+
+        self.assertEqual(movies.headers['X-Cache'], 'MISS')
+        self.assertEqual(len(json.loads(movies.data)['movies']), 4)
+        self.assertEqual(actors.headers['X-Cache'], 'HIT')
+
+    def test_core_writes_invalidate(self):
+        self.client().get('/actors')
+        self.client().patch('/actors/1', json={'age': 70},
+                            headers=self.auth_headers('patch:actors'))
+        res = self.client().get('/actors')
+
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(json.loads(res.data)['actors'][0]['age'], 70)
+
+    def test_errors_are_not_cached(self):
+        self.client().get('/movies?limit=x')
+        res = self.client().get('/movies?limit=x')
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(len(response_cache), 0)
+
+    def test_streams_are_not_cached(self):
+        res = self.client().get('/movies?stream=true')
+
+        self.assertNotIn('X-Cache', res.headers)
+        self.assertEqual(len(response_cache), 0)
+
+    def test_cache_size_is_bounded(self):
+        cache = type(response_cache)(maxsize=800)
+        for index in range(10):
+            cache.put(Movie, str(index), b'x' * 100, 'application/json', 0)
+
+        self.assertEqual(cache.size, 800)
+        self.assertIsNone(cache.get(Movie, '0'))
+        self.assertIsNotNone(cache.get(Movie, '9'))
+
+    def test_cache_can_be_disabled(self):
+        self.app.config['RESPONSE_CACHE'] = False
+        try:
+            self.client().get('/movies')
+            res = self.client().get('/movies')
+        finally:
+            self.app.config['RESPONSE_CACHE'] = True
+
+        self.assertNotIn('X-Cache', res.headers)
+        self.assertEqual(len(response_cache), 0)
+
+
+class ConditionalGetTestCase(CatalogTestCase):
+    """This class represents the ETag / If-None-Match test case"""
+
+    movie_count = 3
+    actor_count = 3
+
+    def test_matching_etag_answers_304_with_one_lookup(self):
+        etag = self.client().get('/movies').headers['ETag']
+        with self.count_queries(include_bookkeeping=True) as statements:
+            res = self.client().get('/movies',
+                                    headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertEqual(len(statements), 1)
+        self.assertIn('change_stamps', statements[0])
+
+    def test_write_changes_etag(self):
+        etag = self.client().get('/actors').headers['ETag']
+        self.client().patch('/actors/1', json={'age': 70},
+                            headers=self.auth_headers('patch:actors'))
+        res = self.client().get('/actors', headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.assertEqual(json.loads(res.data)['actors'][0]['age'], 70)
+
+    def test_write_to_other_table_keeps_etag(self):
+        etag = self.client().get('/actors').headers['ETag']
+        self.client().delete('/movies/1',
+                             headers=self.auth_headers('delete:movies'))
+        res = self.client().get('/actors', headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+
+    def test_orm_write_bumps_stamp(self):
+        Movie(title='New Movie', release_date=datetime(2020, 1, 1)).insert()
+        stamp = get_change_stamp(Movie)
+        movie = Movie.query.get(1)
+        movie.title = 'The Prestige'
+        movie.update()
+
+        self.assertGreater(stamp, 0)
+        self.assertEqual(get_change_stamp(Movie), stamp + 1)
+
+    def test_rolled_back_write_keeps_stamp(self):
+        stamp = get_change_stamp(Movie)
+        db.session.execute(Movie.__table__.update()
+                           .where(Movie.__table__.c.id == 1)
+                           .values(title='Draft'))
+        record_write(Movie, [1])
+        db.session.rollback()
+
+        self.assertEqual(get_change_stamp(Movie), stamp)
+
+    def test_stamp_bumped_by_another_process_bypasses_cache(self):
+        first = self.client().get('/movies')
+        db.session.execute(Movie.__table__.update()
+                           .where(Movie.__table__.c.id == 1)
+                           .values(title='Elsewhere'))
+        bump_change_stamp(Movie)
+        db.session.commit()
+        res = self.client().get('/movies')
+
+        self.assertNotEqual(res.headers['ETag'], first.headers['ETag'])
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(json.loads(res.data)['movies'][0]['title'],
+                         'Elsewhere')
+
+    def test_cached_response_carries_etag(self):
+        first = self.client().get('/movies?limit=2')
+        res = self.client().get('/movies?limit=2')
+
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+        self.assertEqual(res.headers['ETag'], first.headers['ETag'])
+
+
+class ChangeFeedTestCase(CatalogTestCase):
+    """This class represents the /changes feed test case"""
+
+    movie_count = 3
+    actor_count = 2
+
+    def setUp(self):
+        super().setUp()
+        # The seeded rows make up the first change
+        record_write(Movie)
+        record_write(Actor)
+        db.session.commit()
+        self.cursor = self.get_changes()['next_cursor']
+
+    def get_changes(self, since=None, limit=None):
+        args = {}
+        if since is not None:
+            args['since'] = since
+        if limit is not None:
+            args['limit'] = limit
+        res = self.client().get('/changes', query_string=args)
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)
+
+    def test_feed_starts_with_every_row(self):
+        data = self.get_changes()
+
+        self.assertEqual([(change['table'], change['id'])
+                          for change in data['changes']],
+                         [('movies', 1), ('movies', 2), ('movies', 3),
+                          ('actors', 1), ('actors', 2)])
+        self.assertEqual(len({change['seq'] for change in data['changes']}), 1)
+        self.assertEqual(data['changes'][3]['row'],
+                         {'id': 1, 'name': 'Actor 1', 'age': 21,
+                          'gender': 'Female'})
+        self.assertFalse(data['has_more'])
+
+    def test_pages_split_a_transaction_without_loss(self):
+        seen = []
+        cursor = None
+        while True:
+            data = self.get_changes(since=cursor, limit=2)
+            seen += [(change['table'], change['id'])
+                     for change in data['changes']]
+            cursor = data['next_cursor']
+            if not data['has_more']:
+                break
+
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(len(set(seen)), 5)
+
+    def test_only_changes_since_cursor_are_returned(self):
+        self.client().patch('/actors/2', json={'age': 40},
+                            headers=self.auth_headers('patch:actors'))
+        self.client().post('/movies', json={
+            'title': 'New Movie', 'release_date': '10-Jan-2020'
+        }, headers=self.auth_headers('post:movies'))
+        with self.count_queries() as statements:
+            data = self.get_changes(since=self.cursor)
+
+        self.assertEqual([(change['table'], change['id'], change['op'])
+                          for change in data['changes']],
+                         [('actors', 2, 'upsert'), ('movies', 4, 'upsert')])
+        self.assertLess(data['changes'][0]['seq'], data['changes'][1]['seq'])
+        self.assertEqual(data['changes'][0]['row']['age'], 40)
+        self.assertIsNotNone(data['changes'][0]['updated_at'])
+        self.assertEqual(len(statements), 3)
+
+    def test_deletes_leave_tombstones(self):
+        self.client().delete('/movies/2',
+                             headers=self.auth_headers('delete:movies'))
+        movie = Movie.query.get(3)
+        movie.delete()
+        data = self.get_changes(since=self.cursor)
+
+        self.assertEqual([(change['table'], change['id'], change['op'])
+                          for change in data['changes']],
+                         [('movies', 2, 'delete'), ('movies', 3, 'delete')])
+        self.assertNotIn('row', data['changes'][0])
+
+    def test_bulk_and_upsert_writes_are_in_the_feed(self):
+        self.client().post('/movies/bulk', json=[
+            {'title': 'Bulk 1', 'release_date': '10-Jan-2020'},
+            {'title': 'Bulk 2', 'release_date': '10-Jan-2020'}
+        ], headers=self.auth_headers('post:movies'))
+        self.client().post('/movies?upsert=true', json={
+            'title': 'Movie 1', 'release_date': '10-Jan-2021'
+        }, headers=self.auth_headers('post:movies'))
+        data = self.get_changes(since=self.cursor)
+
+        self.assertEqual([change['row']['title']
+                          for change in data['changes']],
+                         ['Bulk 1', 'Bulk 2', 'Movie 1'])
+
+    def test_no_op_patch_is_not_in_the_feed(self):
+        self.client().patch('/actors/1', json={'age': 21},
+                            headers=self.auth_headers('patch:actors'))
+        data = self.get_changes(since=self.cursor)
+
+        self.assertEqual(data['changes'], [])
+        self.assertEqual(data['next_cursor'], self.cursor)
+
+    def test_bookkeeping_columns_are_not_exposed(self):
+        res = self.client().get('/movies')
+        self.assertEqual(set(json.loads(res.data)['movies'][0]),
+                         {'id', 'title', 'release_date'})
+
+        res = self.client().get('/movies?fields=id,change_seq')
+        self.assertEqual(res.status_code, 400)
+
+    def test_commit_between_source_reads_is_not_split(self):
+        # A transaction writing a movie and an actor commits once the
+        # movies have been read, before the actors are
+        def commit_cast_change(conn, cursor, statement, *args):
+            if 'FROM actors' not in statement or committed:
+                return
+            committed.append(True)
+            with db.engine.begin() as other:
+                other.exec_driver_sql(
+                    "UPDATE change_stamps SET version = version + 1 "
+                    "WHERE table_name = '*'")
+                seq = other.exec_driver_sql(
+                    "SELECT version FROM change_stamps "
+                    "WHERE table_name = '*'").scalar()
+                for table in ('movies', 'actors'):
+                    other.exec_driver_sql(
+                        f'UPDATE {table} SET change_seq = ? WHERE id = 1',
+                        (seq,))
+
+        committed = []
+        _, position, _ = changes_since()
+        event.listen(db.engine, 'before_cursor_execute', commit_cast_change)
+        try:
+            first, position, _ = changes_since(position)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute',
+                         commit_cast_change)
+        second, _, _ = changes_since(position)
+
+        self.assertEqual(committed, [True])
+        self.assertEqual([(change['table'], change['id'])
+                          for change in first + second],
+                         [('movies', 1), ('actors', 1)])
+
+    def test_400_sent_for_invalid_cursor(self):
+        for cursor in ('x', encode_cursor(5)):
+            res = self.client().get('/changes', query_string={'since': cursor})
+            self.assertEqual(res.status_code, 400)
+
+
+class ChangeStreamTestCase(CatalogTestCase):
+    """This class represents the /stream/changes Server-Sent Events test case"""
+
+    movie_count = 2
+    actor_count = 2
+
+    def setUp(self):
+        super().setUp()
+        record_write(Movie)
+        record_write(Actor)
+        db.session.commit()
+        # The broadcaster is driven by hand, without its thread
+        broadcaster.background = False
+        self.app.config['COOPERATIVE'] = True
+        self.app.config['SSE_HEARTBEAT_INTERVAL'] = 0.05
+        self.streams = []
+
+    def tearDown(self):
+        for stream in self.streams:
+            stream.close()
+        broadcaster.position = None
+        broadcaster.buffer_size = 1000
+        self.app.config['SSE_HEARTBEAT_INTERVAL'] = 15
+        self.app.config['COOPERATIVE'] = False
+        super().tearDown()
+
+    def open_stream(self, headers=None):
+        res = self.client().get('/stream/changes', headers=headers,
+                                buffered=False)
+        self.streams.append(res)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/event-stream')
+        chunks = iter(res.response)
+        self.assertEqual(next(chunks), b'retry: 3000\n\n')
+        return res, chunks
+
+    def parse_event(self, chunk):
+        fields = dict(line.split(': ', 1)
+                      for line in chunk.decode().strip().split('\n'))
+        fields['data'] = json.loads(fields['data'])
+        return fields
+
+    def test_writes_are_pushed_to_subscribers(self):
+        _, first = self.open_stream()
+        _, second = self.open_stream()
+        broadcaster.poll()
+        self.client().patch('/actors/1', json={'age': 60},
+                            headers=self.auth_headers('patch:actors'))
+        self.client().delete('/movies/2',
+                             headers=self.auth_headers('delete:movies'))
+
+        self.assertEqual(broadcaster.poll(), 2)
+        for chunks in (first, second):
+            update = self.parse_event(next(chunks))
+            delete = self.parse_event(next(chunks))
+            self.assertEqual(update['event'], 'upsert')
+            self.assertEqual(update['data']['row']['age'], 60)
+            self.assertEqual(delete['event'], 'delete')
+            self.assertEqual(delete['data']['id'], 2)
+
+    def test_change_committed_before_first_poll_is_pushed(self):
+        _, chunks = self.open_stream()
+        self.client().patch('/actors/2', json={'age': 63},
+                            headers=self.auth_headers('patch:actors'))
+
+        self.assertEqual(broadcaster.poll(), 1)
+        self.assertEqual(self.parse_event(next(chunks))['data']['id'], 2)
+
+    def test_changes_before_subscribing_are_not_pushed(self):
+        _, first = self.open_stream()
+        self.client().patch('/actors/1', json={'age': 64},
+                            headers=self.auth_headers('patch:actors'))
+        _, second = self.open_stream()
+        broadcaster.poll()
+
+        self.assertEqual(self.parse_event(next(first))['data']['id'], 1)
+        self.assertEqual(next(second), b': heartbeat\n\n')
+
+    def test_heartbeat_sent_when_idle(self):
+        _, chunks = self.open_stream()
+
+        self.assertEqual(next(chunks), b': heartbeat\n\n')
+
+    def test_disconnect_removes_subscriber(self):
+        res, chunks = self.open_stream()
+        self.assertEqual(broadcaster.subscriber_count(), 1)
+
+        res.close()
+
+        self.assertEqual(broadcaster.subscriber_count(), 0)
+
+    def test_close_before_first_event_removes_subscriber(self):
+        # The body is closed by the server without being iterated
+        with self.app.test_request_context('/stream/changes'):
+            res = self.app.view_functions['stream_changes']()
+        self.assertEqual(broadcaster.subscriber_count(), 1)
+
+        res.close()
+
+        self.assertEqual(broadcaster.subscriber_count(), 0)
+
+    def test_503_sent_outside_cooperative_workers(self):
+        self.app.config['COOPERATIVE'] = False
+        res = self.client().get('/stream/changes')
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(json.loads(res.data)['message'],
+                         'Service Unavailable')
+        self.assertEqual(broadcaster.subscriber_count(), 0)
+
+    def test_slow_subscriber_is_reset(self):
+        broadcaster.buffer_size = 1
+        _, chunks = self.open_stream()
+        broadcaster.poll()
+        for id in (1, 2):
+            self.client().patch(f'/actors/{id}', json={'age': 30},
+                                headers=self.auth_headers('patch:actors'))
+        broadcaster.poll()
+
+        event = self.parse_event(next(chunks))
+        self.assertEqual(event['event'], 'reset')
+        self.assertIsNone(event['data']['since'])
+        self.assertEqual(broadcaster.subscriber_count(), 0)
+        with self.assertRaises(StopIteration):
+            next(chunks)
+
+    def test_reconnect_replays_missed_changes(self):
+        _, chunks = self.open_stream()
+        broadcaster.poll()
+        self.client().patch('/actors/1', json={'age': 61},
+                            headers=self.auth_headers('patch:actors'))
+        broadcaster.poll()
+        last_id = self.parse_event(next(chunks))['id']
+        self.client().patch('/actors/2', json={'age': 62},
+                            headers=self.auth_headers('patch:actors'))
+
+        _, chunks = self.open_stream(headers={'Last-Event-ID': last_id})
+        replayed = self.parse_event(next(chunks))
+        broadcaster.poll()
+
+        self.assertEqual(replayed['data']['id'], 2)
+        self.assertEqual(next(chunks), b': heartbeat\n\n')
+
+    def test_400_sent_for_invalid_last_event_id(self):
+        res = self.client().get('/stream/changes',
+                                headers={'Last-Event-ID': 'x'})
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_subscription_buffer_is_bounded(self):
+        subscription = Subscription(maxsize=2)
+        for index in range(3):
+            subscription.put(((index, 0, 0), 'upsert', b'{}'))
+
+        self.assertEqual(len(subscription), 0)
+        self.assertIs(subscription.get(timeout=0), RESET)
+
+
+class CastTestCase(CatalogTestCase):
+    """This class represents the movie cast test case"""
+
+    movie_count = 20
+    actor_count = 4
+
+    def setUp(self):
+        super().setUp()
+        db.session.execute(movie_actors.insert(), [
+            {'movie_id': 1, 'actor_id': 1}, {'movie_id': 1, 'actor_id': 2},
+            {'movie_id': 2, 'actor_id': 2}, {'movie_id': 4, 'actor_id': 3}
+        ])
+        db.session.commit()
+
+    def test_page_with_cast_takes_two_queries(self):
+        with self.count_queries() as statements:
+            res = self.client().get('/movies?include=cast&limit=20')
+        movies = json.loads(res.data)['movies']
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(movies), 20)
+        self.assertEqual([actor['id'] for actor in movies[0]['actors']],
+                         [1, 2])
+        self.assertEqual(movies[0]['actors'][0],
+                         {'id': 1, 'name': 'Actor 1', 'age': 21,
+                          'gender': 'Female'})
+        self.assertEqual(movies[2]['actors'], [])
+        self.assertEqual(len(statements), 2)
+
+    def test_query_count_does_not_grow_with_page_size(self):
+        for limit in (2, 20):
+            with self.count_queries() as statements:
+                self.client().get(f'/movies?include=cast&limit={limit}')
+            self.assertEqual(len(statements), 2)
+
+    def test_actors_with_their_movies(self):
+        res = self.client().get('/actors?include=cast')
+        actors = json.loads(res.data)['actors']
+
+        self.assertEqual([[movie['id'] for movie in actor['movies']]
+                          for actor in actors], [[1], [1, 2], [4], []])
+
+    def test_cast_with_fields(self):
+        res = self.client().get('/movies?include=cast&fields=title&limit=1')
+        movie = json.loads(res.data)['movies'][0]
+
+        self.assertEqual(set(movie), {'title', 'actors'})
+        self.assertEqual(len(movie['actors']), 2)
+
+    def test_multi_and_single_get_with_cast(self):
+        res = self.client().get('/movies?ids=2,1&include=cast&fields=id')
+        movies = json.loads(res.data)['movies']
+        self.assertEqual(movies, [
+            {'id': 2, 'actors': [{'id': 2, 'name': 'Actor 2', 'age': 22,
+                                  'gender': 'Male'}]},
+            {'id': 1, 'actors': movies[1]['actors']}
+        ])
+
+        res = self.client().get('/actors/3?include=cast')
+        self.assertEqual(json.loads(res.data)['actors']['movies'][0]['id'], 4)
+        # The cached row is not modified
+        self.assertNotIn('movies', row_cache.get(Actor, 3,
+                                                  get_change_stamp(Actor)))
+
+    def test_get_movie_actors(self):
+        res = self.client().get('/movies/1/actors?fields=name')
+
+        self.assertEqual(json.loads(res.data)['actors'],
+                         [{'name': 'Actor 1'}, {'name': 'Actor 2'}])
+
+    def test_get_actor_movies(self):
+        res = self.client().get('/actors/2/movies')
+
+        self.assertEqual([movie['title']
+                          for movie in json.loads(res.data)['movies']],
+                         ['Movie 1', 'Movie 2'])
+
+    def test_404_sent_for_cast_of_missing_movie(self):
+        res = self.client().get('/movies/99/actors')
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_set_movie_actors(self):
+        res = self.client().put('/movies/1/actors', json={'actors': [2, 4]},
+                                headers=self.auth_headers('patch:movies'))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['id'] for actor in
+                          json.loads(res.data)['actors']], [2, 4])
+        res = self.client().get('/actors/1/movies')
+        self.assertEqual(json.loads(res.data)['movies'], [])
+
+    def test_set_movie_actors_errors(self):
+        headers = self.auth_headers('patch:movies')
+        res = self.client().put('/movies/1/actors', json={'actors': [99]},
+                                headers=headers)
+        self.assertEqual(res.status_code, 422)
+        res = self.client().put('/movies/99/actors', json={'actors': [1]},
+                                headers=headers)
+        self.assertEqual(res.status_code, 404)
+        res = self.client().put('/movies/1/actors', json={'actors': ['1']},
+                                headers=headers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_actor_change_refreshes_movies_with_cast(self):
+        first = self.client().get('/movies?include=cast')
+        self.client().patch('/actors/1', json={'name': 'Renamed'},
+                            headers=self.auth_headers('patch:actors'))
+        res = self.client().get('/movies?include=cast', headers={
+            'If-None-Match': first.headers['ETag']})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['movies'][0]['actors'][0]['name'],
+                         'Renamed')
+
+    def test_deleting_actor_removes_it_from_casts(self):
+        self.client().delete('/actors/2',
+                             headers=self.auth_headers('delete:actors'))
+        res = self.client().get('/movies/1/actors')
+
+        self.assertEqual([actor['id'] for actor in
+                          json.loads(res.data)['actors']], [1])
+
+    def test_orm_relationships_load_in_batches(self):
+        with self.count_queries() as statements:
+            movies = Movie.query.options(selectinload(Movie.actors)).all()
+            casts = {movie.id: [actor.id for actor in movie.actors]
+                     for movie in movies}
+
+        self.assertEqual(casts[1], [1, 2])
+        self.assertEqual(len(statements), 2)
+
+    def test_400_sent_for_invalid_include(self):
+        for query in ('include=crew', 'include=cast&stream=true'):
+            res = self.client().get('/movies?' + query)
+            self.assertEqual(res.status_code, 400)
+
+
+class DatabaseJsonRenderTestCase(CatalogTestCase):
+    """This class represents the database-rendered list pages test case"""
+
+    movie_count = 7
+    actor_count = 3
+
+    def setUp(self):
+        super().setUp()
+        db.session.execute(movie_actors.insert(), [
+            {'movie_id': 1, 'actor_id': 3}, {'movie_id': 1, 'actor_id': 1},
+            {'movie_id': 5, 'actor_id': 2}
+        ])
+        db.session.execute(Actor.__table__.update()
+                           .where(Actor.__table__.c.id == 2)
+                           .values(age=None, gender=None))
+        db.session.commit()
+        self.app.config['RESPONSE_CACHE'] = False
+
+    def tearDown(self):
+        self.app.config['RESPONSE_CACHE'] = True
+        self.app.config['DB_JSON_RENDER'] = False
+        super().tearDown()
+
+    def get(self, url, render):
+        self.app.config['DB_JSON_RENDER'] = render
+        res = self.client().get(url)
+        return res.status_code, json.loads(res.data)
+
+    def test_same_responses_as_python_rendering(self):
+        cursor = encode_cursor(3)
+        for url in ('/movies', '/actors', '/movies?limit=3',
+                    f'/movies?limit=3&after={cursor}',
+                    '/movies?fields=release_date,title',
+                    '/movies?include=cast&limit=5',
+                    '/movies?include=cast&fields=title',
+                    '/actors?include=cast&fields=id,name',
+                    f'/actors?after={cursor}'):
+            self.assertEqual(self.get(url, True), self.get(url, False), url)
+
+    def test_rows_rendered_in_one_query(self):
+        self.app.config['DB_JSON_RENDER'] = True
+        with self.count_queries() as statements:
+            res = self.client().get('/movies?include=cast')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/json')
+        self.assertEqual(len(statements), 1)
+
+    def test_404_sent_for_empty_table(self):
+        Movie.query.delete()
+        db.session.commit()
+
+        self.assertEqual(self.get('/movies', True)[0], 404)
+
+    def test_microseconds_rendered_like_python(self):
+        db.session.execute(Movie.__table__.update()
+                           .where(Movie.__table__.c.id == 2)
+                           .values(release_date=datetime(2021, 3, 4, 5, 6, 7,
+                                                         8900)))
+        db.session.commit()
+
+        for url in ('/movies', '/actors?include=cast'):
+            self.assertEqual(self.get(url, True), self.get(url, False), url)
+
+
+class SerializationTestCase(CatalogTestCase):
+    """This class represents the JSON serialization layer test case"""
+
+    movie_count = 3
+    actor_count = 2
+
+    def setUp(self):
+        super().setUp()
+        db.session.execute(movie_actors.insert(), [
+            {'movie_id': 1, 'actor_id': 2}, {'movie_id': 1, 'actor_id': 1}
+        ])
+        db.session.commit()
+        self.app.config['RESPONSE_CACHE'] = False
+        self.backend = serialization.backend
+
+    def tearDown(self):
+        serialization.backend = self.backend
+        self.app.config['RESPONSE_CACHE'] = True
+        super().tearDown()
+
+    def get_with(self, backend, url):
+        serialization.backend = get_json_backend(backend)
+        res = self.client().get(url)
+        return res.status_code, json.loads(res.data)
+
+    def test_dates_sent_as_iso_8601(self):
+        data = json.loads(self.client().get('/movies/1').data)
+
+        self.assertEqual(data['movies']['release_date'], '2001-01-01T00:00:00')
+
+    def test_backends_send_the_same_responses(self):
+        if not JSON_BACKENDS['orjson'].available():
+            self.skipTest('orjson is not installed')
+        for url in ('/movies', '/movies?fields=release_date,title',
+                    '/movies?include=cast', '/movies?include=cast&fields=title',
+                    '/movies?stream=true', '/movies?ids=3,1,9',
+                    '/actors/2?include=cast', '/movies/1/actors',
+                    '/actors/7', '/changes'):
+            self.assertEqual(self.get_with('json', url),
+                             self.get_with('orjson', url), url)
+
+    def test_encoder_writes_every_column_type(self):
+        serialization.backend = get_json_backend('json')
+        rows = [
+            {'id': 1, 'title': 'Quote " and \\ and é\n',
+             'release_date': datetime(2021, 3, 4, 5, 6, 7, 8900)},
+            {'id': 2, 'title': 'Plain', 'release_date': None}
+        ]
+        encoded = get_encoder(Movie).encode_rows(rows)
+
+        self.assertEqual(json.loads(encoded), [
+            dict(rows[0], release_date='2021-03-04T05:06:07.008900'),
+            rows[1]
+        ])
+        self.assertEqual(json.loads(b'[%s]' % get_encoder(Movie)
+                                    .encode_items(rows)),
+                         json.loads(encoded))
+
+    def test_error_responses(self):
+        for backend in JSON_BACKENDS:
+            if JSON_BACKENDS[backend].available():
+                self.assertEqual(self.get_with(backend, '/movies/99'), (404, {
+                    'success': False,
+                    'error': 404,
+                    'message': 'Resource Not Found'
+                }))
+
+    def test_unknown_backend_rejected(self):
+        with self.assertRaises(ValueError):
+            get_json_backend('simplejson')
+
+
+class MessagePackTestCase(CatalogTestCase):
+    """This class represents the MessagePack responses test case"""
+
+    movie_count = 3
+    actor_count = 2
+    msgpack = {'Accept': 'application/msgpack'}
+
+    def setUp(self):
+        super().setUp()
+        db.session.execute(movie_actors.insert(), [
+            {'movie_id': 1, 'actor_id': 2}, {'movie_id': 2, 'actor_id': 1}
+        ])
+        db.session.commit()
+
+    def request(self, method, url, *permissions, **kwargs):
+        headers = dict(self.msgpack, **self.auth_headers(*permissions))
+        res = self.client().open(url, method=method, headers=headers,
+                                 **kwargs)
+        self.assertEqual(res.mimetype, 'application/msgpack', url)
+        return res.status_code, unpackb(res.data)
+
+    def test_values_round_trip(self):
+        values = [
+            None, True, False, 0, 127, 128, 255, 256, 65535, 65536,
+            2 ** 32, 2 ** 64 - 1, -1, -32, -33, -128, -129, -32768, -32769,
+            -2 ** 31 - 1, -2 ** 63, 1.5, -0.25, '', 'é' * 15, 'x' * 31,
+            'x' * 32, 'x' * 256, 'x' * 65536, b'\x00\xff', b'x' * 300,
+            list(range(15)), list(range(16)), list(range(70000)),
+            {str(i): i for i in range(15)}, {str(i): i for i in range(16)},
+            {'nested': [{'a': [1, {'b': None}]}]}
+        ]
+        for value in values:
+            self.assertEqual(unpackb(packb(value)), value)
+        self.assertEqual(unpackb(packb(datetime(2021, 3, 4, 5, 6, 7))),
+                         '2021-03-04T05:06:07')
+
+    def test_standard_encoding(self):
+        self.assertEqual(packb({'a': [1, -1, None]}),
+                         b'\x81\xa1a\x93\x01\xff\xc0')
+        self.assertEqual(packb(-33), b'\xd0\xdf')
+        self.assertEqual(packb(1.5), b'\xcb?\xf8\x00\x00\x00\x00\x00\x00')
+
+    def test_malformed_data_rejected(self):
+        for data in (b'\x92\x01', b'\xa3ab', b'\x01\x02', b'\xc1'):
+            with self.assertRaises(ValueError):
+                unpackb(data)
+
+    def test_read_endpoints_send_the_json_payload(self):
+        for url in ('/movies', '/actors?limit=1', '/movies?include=cast',
+                    '/actors?fields=name', '/movies?ids=3,1,9',
+                    '/movies/1', '/actors/1?include=cast', '/movies/1/actors',
+                    '/actors/1/movies', '/changes', '/movies/99',
+                    '/movies?limit=abc'):
+            res = self.client().get(url)
+            self.assertEqual(self.request('GET', url),
+                             (res.status_code, json.loads(res.data)), url)
+
+    def test_database_rendered_pages_sent_as_messagepack(self):
+        self.app.config['DB_JSON_RENDER'] = True
+        try:
+            status, data = self.request('GET', '/movies?include=cast')
+        finally:
+            self.app.config['DB_JSON_RENDER'] = False
+
+        self.assertEqual(status, 200)
+        self.assertEqual(data['movies'][0]['actors'][0]['name'], 'Actor 2')
+
+    def test_write_endpoints(self):
+        status, data = self.request('POST', '/movies', 'post:movies', json={
+            'title': 'Raees', 'release_date': '10-Jan-2020'})
+        self.assertEqual((status, data['movies']['title']), (200, 'Raees'))
+
+        status, data = self.request('POST', '/actors', 'post:actors', json={
+            'name': 'Salman Khan', 'age': 51, 'gender': 'Male'})
+        self.assertEqual((status, data['actors']['name']),
+                         (200, 'Salman Khan'))
+
+        status, data = self.request('POST', '/actors/bulk', 'post:actors',
+                                    json=[{'name': 'A'}, {'age': 3}])
+        self.assertEqual((status, data['actors']['created']), (200, 1))
+
+        status, data = self.request('PATCH', '/movies/1', 'patch:movies',
+                                    json={'title': 'Movie One'})
+        self.assertEqual((status, data['movies']['title']),
+                         (200, 'Movie One'))
+
+        status, data = self.request('PATCH', '/actors/1', 'patch:actors',
+                                    json={'age': 40})
+        self.assertEqual((status, data['actors']['age']), (200, 40))
+
+        status, data = self.request('PUT', '/movies/3/actors', 'patch:movies',
+                                    json={'actors': [1, 2]})
+        self.assertEqual(status, 200)
+        self.assertEqual([actor['id'] for actor in data['actors']], [1, 2])
+
+        status, data = self.request('DELETE', '/movies/3', 'delete:movies')
+        self.assertEqual((status, data['delete']), (200, 3))
+
+        status, data = self.request('DELETE', '/actors/2', 'delete:actors')
+        self.assertEqual((status, data['delete']), (200, 2))
+
+    def test_auth_errors(self):
+        status, data = self.request('DELETE', '/movies/1', 'get:movies')
+
+        self.assertEqual(status, 403)
+        self.assertEqual(data['success'], False)
+
+    def test_formats_cached_and_tagged_apart(self):
+        json_res = self.client().get('/movies')
+        res = self.client().get('/movies', headers=self.msgpack)
+
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertNotEqual(res.headers['ETag'], json_res.headers['ETag'])
+        self.assertIn('Accept', res.headers['Vary'])
+        self.assertEqual(unpackb(res.data), json.loads(json_res.data))
+
+        res = self.client().get('/movies', headers=dict(
+            self.msgpack, **{'If-None-Match': json_res.headers['ETag']}))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/msgpack')
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+
+    def test_json_sent_by_default_and_for_streams(self):
+        for headers in ({}, {'Accept': '*/*'}, {'Accept': 'text/html'}):
+            res = self.client().get('/movies/1', headers=headers)
+            self.assertEqual(res.mimetype, 'application/json')
+
+        res = self.client().get('/movies?stream=true', headers=self.msgpack)
+        self.assertEqual(res.mimetype, 'application/json')
+        self.assertEqual(len(json.loads(res.data)['movies']), 3)
+
+
+class CompressionTestCase(CatalogTestCase):
+    """This class represents the response compression test case"""
+
+    movie_count = 40
+    gzip = {'Accept-Encoding': 'gzip, deflate'}
+
+    def compressed_bytes(self):
+        return registry.counter('compression_bytes_in_total').value
+
+    def test_large_response_compressed(self):
+        plain = self.client().get('/movies?fields=id,title')
+        res = self.client().get('/movies?fields=id,title', headers=self.gzip)
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(res.headers['ETag'], 'W/' + plain.headers['ETag'])
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+        self.assertLess(len(res.data), len(plain.data))
+
+    def test_small_response_sent_as_is(self):
+        res = self.client().get('/movies/1', headers=self.gzip)
+
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(json.loads(res.data)['movies']['id'], 1)
+
+    def test_deflate(self):
+        plain = self.client().get('/movies?ids=' + ','.join(
+            str(id) for id in range(1, 41)))
+        res = self.client().get(plain.request.full_path,
+                                headers={'Accept-Encoding': 'deflate'})
+
+        self.assertEqual(res.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(res.data), plain.data)
+
+    def test_stream_compressed_as_produced(self):
+        self.app.config['STREAM_BATCH_SIZE'] = 7
+        try:
+            res = self.client().get('/movies?stream=true', headers=self.gzip,
+                                    buffered=False)
+            self.assertNotIn('Content-Length', res.headers)
+            body = gzip.decompress(b''.join(res.response))
+        finally:
+            self.app.config['STREAM_BATCH_SIZE'] = 1000
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(json.loads(body)['movies']), 40)
+
+    def test_cache_keeps_compressed_body(self):
+        first = self.client().get('/movies', headers=self.gzip)
+        compressed = self.compressed_bytes()
+        second = self.client().get('/movies', headers=self.gzip)
+        plain = self.client().get('/movies')
+
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(second.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(self.compressed_bytes(), compressed)
+        self.assertEqual(plain.headers['X-Cache'], 'HIT')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(plain.data, gzip.decompress(first.data))
+
+    def test_weak_etag_answers_304(self):
+        etag = self.client().get('/movies', headers=self.gzip).headers['ETag']
+        res = self.client().get('/movies', headers=dict(
+            self.gzip, **{'If-None-Match': etag}))
+
+        self.assertEqual(res.status_code, 304)
+
+    def test_event_streams_not_compressed(self):
+        def events(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/event-stream')])
+            return [b'data: x\n\n' * 1000]
+
+        app = CompressionMiddleware(events, min_size=10)
+        headers = {}
+        body = app({'REQUEST_METHOD': 'GET',
+                    'HTTP_ACCEPT_ENCODING': 'gzip'},
+                   lambda status, response_headers, exc_info=None:
+                   headers.update(response_headers))
+
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(b''.join(body), b'data: x\n\n' * 1000)
+
+    def test_ratio_and_cpu_in_metrics(self):
+        self.client().get('/movies', headers=self.gzip)
+        metrics = json.loads(self.client().get('/metrics').data)['metrics']
+
+        self.assertGreater(metrics['compression_ratio'], 1)
+        self.assertGreaterEqual(metrics['compression_cpu_seconds']['count'], 1)
+
+
+class SingleStatementWriteTestCase(CatalogTestCase):
+    """This class represents the single round-trip PATCH and DELETE test case"""
+
+    movie_count = 2
+    actor_count = 2
+
+    def setUp(self):
+        super().setUp()
+        returning = db.engine.dialect.full_returning
+        # UPDATE ... RETURNING, or UPDATE then SELECT without RETURNING
+        self.update_statements = 1 if returning else 2
+        # Change feed bookkeeping of the commit: take the sequence number
+        # (read back without RETURNING), bump the table stamp, stamp the
+        # rows; a delete also leaves a tombstone
+        self.bookkeeping_statements = 3 if returning else 4
+
+    def test_update_movie(self):
+        with self.count_queries(include_bookkeeping=True) as statements:
+            res = self.client().patch('/movies/1', json={
+                'title': 'The Raees',
+                'release_date': '23-Mar-2020'
+            }, headers=self.auth_headers('patch:movies'))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movies']['title'], 'The Raees')
+        self.assertEqual(len(statements), self.update_statements +
+                         self.bookkeeping_statements)
+        self.assertTrue(statements[0].startswith('UPDATE'))
+        self.assertEqual(Movie.query.get(1).title, 'The Raees')
+
+    def test_update_actor(self):
+        with self.count_queries(include_bookkeeping=True) as statements:
+            res = self.client().patch('/actors/1', json={
+                'name': 'Salman Khan',
+                'age': 51,
+                'gender': 'Male'
+            }, headers=self.auth_headers('patch:actors'))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors'], {'id': 1, 'name': 'Salman Khan',
+                                          'age': 51, 'gender': 'Male'})
+        self.assertEqual(len(statements), self.update_statements +
+                         self.bookkeeping_statements)
+
+    def test_404_sent_when_updating_missing_actor(self):
+        with self.count_queries(include_bookkeeping=True) as statements:
+            res = self.client().patch('/actors/99', json={'name': 'Nobody'},
+                                      headers=self.auth_headers('patch:actors'))
+
+        self.assertEqual(res.status_code, 404)
+        # The guarded UPDATE, then the SELECT telling missing from unchanged
+        self.assertEqual(len(statements), 2)
+        self.assertTrue(statements[1].startswith('SELECT'))
+
+    def test_delete_movie(self):
+        with self.count_queries(include_bookkeeping=True) as statements:
+            res = self.client().delete(
+                '/movies/2', headers=self.auth_headers('delete:movies'))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['delete'], 2)
+        self.assertEqual(len(statements), 1 + self.bookkeeping_statements + 1)
+        self.assertTrue(statements[0].startswith('DELETE'))
+        self.assertTrue(statements[-1].startswith('INSERT INTO tombstones'))
+        self.assertIsNone(Movie.query.get(2))
+
+    def test_404_sent_when_deleting_missing_actor(self):
+        with self.count_queries(include_bookkeeping=True) as statements:
+            res = self.client().delete(
+                '/actors/121', headers=self.auth_headers('delete:actors'))
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(len(statements), 1)
+
+
+class PartialUpdateTestCase(CatalogTestCase):
+    """This class represents the partial, no-op suppressing PATCH test case"""
+
+    movie_count = 1
+    actor_count = 1
+
+    def setUp(self):
+        super().setUp()
+        self.commits = 0
+
+        def on_commit(conn):
+            self.commits += 1
+
+        self.on_commit = on_commit
+        event.listen(db.engine, 'commit', on_commit)
+
+    def tearDown(self):
+        event.remove(db.engine, 'commit', self.on_commit)
+        super().tearDown()
+
+    def patch_actor(self, body):
+        return self.client().patch('/actors/1', json=body,
+                                   headers=self.auth_headers('patch:actors'))
+
+    def test_omitted_fields_are_left_alone(self):
+        res = self.patch_actor({'age': 33})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['modified'])
+        self.assertEqual(data['actors'], {'id': 1, 'name': 'Actor 1',
+                                          'age': 33, 'gender': 'Female'})
+        self.assertEqual(self.commits, 1)
+
+    def test_omitted_movie_fields_are_left_alone(self):
+        res = self.client().patch('/movies/1', json={'title': 'Renamed'},
+                                  headers=self.auth_headers('patch:movies'))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movies']['title'], 'Renamed')
+        self.assertIsNotNone(Movie.query.get(1).release_date)
+
+    def test_identical_patch_is_not_written(self):
+        res = self.patch_actor({'name': 'Actor 1', 'age': 21,
+                                'gender': 'Female'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse(data['modified'])
+        self.assertEqual(data['actors']['name'], 'Actor 1')
+        self.assertEqual(self.commits, 0)
+
+    def test_identical_null_is_not_written(self):
+        db.session.execute(Actor.__table__.update().values(gender=None))
+        db.session.commit()
+        self.commits = 0
+
+        res = self.patch_actor({'gender': None})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse(json.loads(res.data)['modified'])
+        self.assertEqual(self.commits, 0)
+
+    def test_identical_movie_patch_is_not_written(self):
+        movie = Movie.query.get(1)
+        res = self.client().patch('/movies/1', json={
+            'title': movie.title,
+            'release_date': movie.release_date.isoformat()
+        }, headers=self.auth_headers('patch:movies'))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse(json.loads(res.data)['modified'])
+        self.assertEqual(self.commits, 0)
+
+    def test_400_sent_for_empty_patch(self):
+        res = self.patch_actor({})
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_400_sent_for_invalid_field(self):
+        res = self.patch_actor({'age': 'old'})
+
+        self.assertEqual(res.status_code, 400)
+
+
+class CooperativeTestCase(CatalogTestCase):
+    """This class represents the gevent worker support test case"""
+
+    def test_sessions_scoped_per_thread_or_greenlet(self):
+        sessions = []
+
+        def use_session():
+            sessions.append(db.session())
+            db.session.remove()
+
+        thread = threading.Thread(target=use_session)
+        thread.start()
+        thread.join()
+
+        self.assertIsNot(sessions[0], db.session())
+
+    def test_wait_callback_waits_on_the_socket(self):
+        extensions = types.SimpleNamespace(POLL_OK=0, POLL_READ=1,
+                                           POLL_WRITE=2)
+        psycopg2 = types.SimpleNamespace(OperationalError=RuntimeError,
+                                         extensions=extensions)
+        conn = unittest.mock.Mock()
+        conn.poll.side_effect = [2, 1, 1, 0]
+        conn.fileno.return_value = 7
+        waits = []
+        with unittest.mock.patch.multiple(
+                cooperative, psycopg2=psycopg2,
+                wait_read=lambda fd, timeout: waits.append(('r', fd)),
+                wait_write=lambda fd, timeout: waits.append(('w', fd))):
+            cooperative.gevent_wait_callback(conn)
+
+            conn.poll.side_effect = [9]
+            with self.assertRaises(RuntimeError):
+                cooperative.gevent_wait_callback(conn)
+
+        self.assertEqual(waits, [('w', 7), ('r', 7), ('r', 7)])
+
+    def test_nothing_done_outside_gevent(self):
+        app = unittest.mock.Mock(config={})
+        with unittest.mock.patch.object(cooperative, 'patch_psycopg2') as patch:
+            cooperative.setup_cooperative(app, [jwks_cache])
+
+        self.assertEqual(app.config['COOPERATIVE'], False)
+        patch.assert_not_called()
+
+    def test_locks_created_before_patching_refused(self):
+        app = unittest.mock.Mock(config={'COOPERATIVE': True})
+        unpatched = types.SimpleNamespace(_lock=threading.RLock())
+        with unittest.mock.patch.object(cooperative, 'patch_psycopg2',
+                                        return_value=True) as patch:
+            cooperative.setup_cooperative(app, [jwks_cache, token_cache])
+            with self.assertRaises(RuntimeError):
+                cooperative.setup_cooperative(app, [jwks_cache, unpatched])
+
+        self.assertEqual(patch.call_count, 2)
+
+
+class GunicornConfigTestCase(CatalogTestCase):
+    """This class represents the gunicorn fork hooks test case"""
+
+    movie_count = 3
+    actor_count = 3
+
+    def setUp(self):
+        super().setUp()
+        self.conf = load_gunicorn_conf(WEB_CONCURRENCY='', WARM_UP='true',
+                                       WORKER_CLASS='sync')
+        self.server = types.SimpleNamespace(
+            cfg=types.SimpleNamespace(preload_app=True))
+        self.worker = types.SimpleNamespace(
+            cfg=types.SimpleNamespace(worker_class_str='sync', threads=2,
+                                      worker_connections=1000),
+            log=unittest.mock.Mock())
+        self.addCleanup(auth.stop_jwks_refresher, wait=True)
+
+    def idle_connection(self):
+        connection = unittest.mock.Mock()
+        http_client._idle[('https', 'example.auth0.com')] = [connection]
+        return connection
+
+    def test_workers_follow_available_cpus(self):
+        with unittest.mock.patch.object(self.conf, '_cgroup_cpu_quota',
+                                        return_value=None), \
+                unittest.mock.patch.object(os, 'sched_getaffinity',
+                                           return_value={0, 1, 2, 3},
+                                           create=True):
+            self.assertEqual(self.conf.available_cpus(), 4)
+        with unittest.mock.patch.object(self.conf, '_cgroup_cpu_quota',
+                                        return_value=1.5), \
+                unittest.mock.patch.object(os, 'sched_getaffinity',
+                                           return_value={0, 1, 2, 3},
+                                           create=True):
+            self.assertEqual(self.conf.available_cpus(), 2)
+
+        self.assertEqual(self.conf.default_workers('sync', 4), 9)
+        self.assertEqual(self.conf.default_workers('gevent', 4), 4)
+        self.assertEqual(self.conf.workers, self.conf.default_workers(
+            'sync', self.conf.available_cpus()))
+        self.assertEqual(self.conf.threads, 1)
+        self.assertTrue(self.conf.preload_app)
+
+    def test_gevent_workers_by_default(self):
+        with unittest.mock.patch.dict(os.environ):
+            os.environ.pop('WORKER_CLASS', None)
+            # Without preload, gevent is left to patch the workers
+            conf = load_gunicorn_conf(WEB_CONCURRENCY='',
+                                      PRELOAD_APP='false')
+
+        self.assertEqual(conf.worker_class, 'gevent')
+        self.assertEqual(conf.workers, conf.available_cpus())
+
+    def test_environment_overrides(self):
+        conf = load_gunicorn_conf(WEB_CONCURRENCY='3', WEB_THREADS='4',
+                                  WORKER_CLASS='gthread', PRELOAD_APP='false')
+
+        self.assertEqual((conf.workers, conf.threads, conf.worker_class),
+                         (3, 4, 'gthread'))
+        self.assertFalse(conf.preload_app)
+
+    def test_master_hands_nothing_down_before_forking(self):
+        refresher = auth.start_jwks_refresher(jwks_cache)
+        connection = self.idle_connection()
+        with unittest.mock.patch.object(db.engine, 'dispose') as dispose:
+            self.conf.when_ready(self.server)
+
+        dispose.assert_called_once_with()
+        self.assertFalse(refresher.is_alive())
+        connection.close.assert_called_once_with()
+        self.assertEqual(http_client._idle, {})
+
+    def test_worker_drops_inherited_connections(self):
+        connection = self.idle_connection()
+        with unittest.mock.patch.object(db.engine, 'dispose') as dispose, \
+                unittest.mock.patch.dict(self.app.config,
+                                         JWKS_BACKGROUND_REFRESH=True):
+            self.conf.post_fork(self.server, self.worker)
+
+        dispose.assert_called_once_with()
+        connection.close.assert_called_once_with()
+        self.assertTrue(auth._refresher.is_alive())
+
+    def test_hooks_skipped_without_preload(self):
+        self.server.cfg.preload_app = False
+        connection = self.idle_connection()
+        with unittest.mock.patch.object(db.engine, 'dispose') as dispose:
+            self.conf.when_ready(self.server)
+            self.conf.post_fork(self.server, self.worker)
+
+        dispose.assert_not_called()
+        connection.close.assert_not_called()
+        http_client._idle.clear()
+
+    def test_worker_warmed_up_before_serving(self):
+        with unittest.mock.patch.dict(self.app.config, JWKS_PREFETCH=True):
+            self.conf.post_worker_init(self.worker)
+
+        self.assertIsNotNone(jwks_cache.expires_in())
+        self.assertEqual(len(response_cache._entries), 2)
+        with self.count_queries() as queries:
+            response = self.client().get(
+                '/movies', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries, [])
+        self.worker.log.warning.assert_not_called()
+        self.worker.log.exception.assert_not_called()
+
+
+class StreamingTestCase(CatalogTestCase):
+    """This class represents the streaming list endpoints test case"""
+
+    movie_count = 7
+    actor_count = 2
+
+    def setUp(self):
+        super().setUp()
+        self.app.config['STREAM_BATCH_SIZE'] = 3
+
+    def tearDown(self):
+        self.app.config['STREAM_BATCH_SIZE'] = 1000
+        super().tearDown()
+
+    def test_stream_movies(self):
+        res = self.client().get('/movies?stream=true')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual([m['id'] for m in data['movies']], list(range(1, 8)))
+        self.assertEqual(data['movies'][0],
+                         json.loads(self.client().get('/movies?limit=1')
+                                    .data)['movies'][0])
+
+    def test_stream_batch_boundary(self):
+        self.app.config['STREAM_BATCH_SIZE'] = 2
+        data = json.loads(self.client().get('/actors?stream=true').data)
+
+        self.assertEqual(len(data['actors']), 2)
+
+    def test_404_sent_when_streaming_empty_table(self):
+        Actor.query.delete()
+        db.session.commit()
+
+        self.assertEqual(self.client().get('/actors?stream=true').status_code,
+                         404)
+
+
+class StreamingMemoryTestCase(CatalogTestCase):
+    """This class checks that streaming memory does not grow with the table"""
+
+    def seed_movies(self, count):
+        Movie.query.delete()
+        db.session.execute(Movie.__table__.insert(), [
+            {'id': i, 'title': f'Movie {i}',
+             'release_date': datetime(2000, 1, 1)}
+            for i in range(1, count + 1)
+        ])
+        db.session.commit()
+
+    def peak_memory(self, count):
+        self.seed_movies(count)
+        tracemalloc.start()
+        # Recorded warnings would be counted as streaming memory
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            try:
+                res = self.client().get('/movies?stream=true',
+                                        buffered=False)
+                size = sum(len(chunk) for chunk in res.response)
+                res.close()
+                return tracemalloc.get_traced_memory()[1], size
+            finally:
+                tracemalloc.stop()
+
+    def test_peak_memory_flat_on_large_table(self):
+        self.app.config['STREAM_BATCH_SIZE'] = 500
+        try:
+            small_peak, small_size = self.peak_memory(2000)
+            large_peak, large_size = self.peak_memory(20000)
+        finally:
+            self.app.config['STREAM_BATCH_SIZE'] = 1000
+
+        self.assertGreater(large_size, 9 * small_size)
+        self.assertLess(large_peak, 1.5 * small_peak)
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
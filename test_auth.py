@@ -0,0 +1,552 @@
+import base64
+import functools
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+
+from flask import Flask, jsonify
+
+import auth
+from auth import (
+    SIGNATURE_BACKENDS, AuthError, JWKSCache, JWKSRefresher,
+    RejectedTokenCache, VerifiedTokenCache, authenticate_token,
+    b64url_decode, fetch_jwks, get_signature_backend, jwks_cache,
+    parse_max_age, prevalidate_token, rejection_cache, requires_auth,
+    setup_auth, token_cache, verify_decode_jwt
+)
+from jwt_testing import (
+    JWKSServer, generate_rsa_key, make_jwks, mint_token, static_fetcher
+)
+from metrics import registry
+
+
+def setUpModule():
+    global KEY, OTHER_KEY
+    KEY = generate_rsa_key('key-1', bits=1024)
+    OTHER_KEY = generate_rsa_key('key-2', bits=1024)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class JWKSCacheTestCase(unittest.TestCase):
+    """This class represents the JWKS cache test case"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.fetcher = static_fetcher(make_jwks([KEY]))
+        self.cache = JWKSCache(fetcher=self.fetcher, ttl=600,
+                               min_refresh_interval=30, clock=self.clock)
+
+    def test_key_set_fetched_once_while_fresh(self):
+        for _ in range(10):
+            self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+            self.clock.now += 1
+
+        self.assertEqual(self.fetcher.calls, 1)
+
+    def test_key_set_refetched_after_ttl(self):
+        self.cache.get_key('key-1')
+        self.clock.now += 601
+        self.cache.get_key('key-1')
+
+        self.assertEqual(self.fetcher.calls, 2)
+
+    def test_cache_control_max_age_overrides_ttl(self):
+        fetcher = static_fetcher(make_jwks([KEY]), max_age=15)
+        cache = JWKSCache(fetcher=fetcher, ttl=600, clock=self.clock)
+        cache.get_key('key-1')
+        self.clock.now += 10
+        cache.get_key('key-1')
+        self.clock.now += 10
+        cache.get_key('key-1')
+
+        self.assertEqual(fetcher.calls, 2)
+
+    def test_unknown_kid_forces_rate_limited_refresh(self):
+        self.cache.get_key('key-1')
+        self.clock.now += 31
+        self.assertIsNone(self.cache.get_key('unknown'))
+        self.assertIsNone(self.cache.get_key('unknown'))
+
+        self.assertEqual(self.fetcher.calls, 2)
+
+    def test_rotated_key_picked_up_by_forced_refresh(self):
+        self.cache.get_key('key-1')
+        self.cache.fetcher = static_fetcher(make_jwks([KEY, OTHER_KEY]))
+        self.clock.now += 31
+
+        self.assertEqual(self.cache.get_key('key-2')['kid'], 'key-2')
+
+    def test_parse_max_age(self):
+        self.assertEqual(parse_max_age('public, max-age=15'), 15)
+        self.assertEqual(parse_max_age('no-store'), 0)
+        self.assertIsNone(parse_max_age('public'))
+        self.assertIsNone(parse_max_age(None))
+
+
+class JWKSRefreshTestCase(unittest.TestCase):
+    """This class represents the JWKS download and refresh test case"""
+
+    def setUp(self):
+        self.server = JWKSServer(make_jwks([KEY]), max_age=300).start()
+        self.fetcher = functools.partial(fetch_jwks, self.server.url)
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_fetch_jwks_reuses_connection(self):
+        for _ in range(3):
+            jwks, max_age = fetch_jwks(self.server.url)
+
+        self.assertEqual(jwks['keys'][0]['kid'], 'key-1')
+        self.assertEqual(max_age, 300)
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_last_good_keys_served_when_refresh_fails(self):
+        failures = registry.counter('auth_jwks_refresh_failures_total')
+        failures_before = failures.value
+        cache = JWKSCache(fetcher=self.fetcher, retry_interval=30,
+                          clock=self.clock)
+        cache.get_key('key-1')
+        self.server.fail = True
+        self.clock.now += 301
+
+        self.assertEqual(cache.get_key('key-1')['kid'], 'key-1')
+        self.assertEqual(failures.value, failures_before + 1)
+        # The failed refresh is not retried before retry_interval
+        cache.get_key('key-1')
+        self.assertEqual(self.server.requests, 2)
+
+    def test_503_when_no_keys_were_ever_fetched(self):
+        self.server.fail = True
+        cache = JWKSCache(fetcher=self.fetcher, clock=self.clock)
+
+        with self.assertRaises(AuthError) as context:
+            cache.get_key('key-1')
+        self.assertEqual(context.exception.status_code, 503)
+
+    def test_background_refresher_refreshes_before_expiry(self):
+        self.server.max_age = 1
+        cache = JWKSCache(fetcher=self.fetcher)
+        refresher = JWKSRefresher(cache, min_sleep=0.1)
+        refresher.start()
+        try:
+            deadline = time.monotonic() + 5
+            while self.server.requests < 3 and time.monotonic() < deadline:
+                time.sleep(0.05)
+        finally:
+            refresher.stop()
+
+        self.assertGreaterEqual(self.server.requests, 3)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_setup_auth_prefetches_keys(self):
+        jwks_cache.clear()
+        jwks_cache.fetcher = self.fetcher
+        try:
+            app = Flask(__name__)
+            app.config['JWKS_BACKGROUND_REFRESH'] = False
+            setup_auth(app)
+            self.assertEqual(self.server.requests, 1)
+            jwks_cache.get_key('key-1')
+            self.assertEqual(self.server.requests, 1)
+        finally:
+            jwks_cache.clear()
+            jwks_cache.fetcher = fetch_jwks
+
+
+class VerifyDecodeJwtTestCase(unittest.TestCase):
+    """This class represents the token verification test case"""
+
+    def setUp(self):
+        self.fetcher = static_fetcher(make_jwks([KEY]))
+        jwks_cache.clear()
+        jwks_cache.fetcher = self.fetcher
+
+    def tearDown(self):
+        jwks_cache.clear()
+        jwks_cache.fetcher = fetch_jwks
+
+    def test_verify_decode_jwt_uses_cached_keys(self):
+        token = mint_token(KEY[0], 'key-1', permissions=['post:movies'])
+        for _ in range(3):
+            payload = verify_decode_jwt(token)
+
+        self.assertEqual(payload['permissions'], ['post:movies'])
+        self.assertEqual(self.fetcher.calls, 1)
+
+
+
+class VerifiedTokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified token cache test case"""
+
+    def setUp(self):
+        jwks_cache.clear()
+        jwks_cache.fetcher = static_fetcher(make_jwks([KEY]))
+        jwks_cache.get_key('key-1')
+        self.clock = FakeClock()
+        self.cache = VerifiedTokenCache(maxsize=2, clock=self.clock)
+
+    def tearDown(self):
+        jwks_cache.clear()
+        jwks_cache.fetcher = fetch_jwks
+
+    def token(self, **claims):
+        return mint_token(KEY[0], 'key-1', **claims)
+
+    def test_hit_after_put(self):
+        token = self.token()
+        payload = {'exp': self.clock.now + 60, 'permissions': []}
+        self.assertIsNone(self.cache.get(token))
+        self.cache.put(token, payload)
+
+        self.assertIs(self.cache.get(token), payload)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_entry_evicted_at_exp(self):
+        token = self.token()
+        self.cache.put(token, {'exp': self.clock.now + 60})
+        self.clock.now += 60
+
+        self.assertIsNone(self.cache.get(token))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_least_recently_used_entry_evicted(self):
+        tokens = [self.token(sub=str(i)) for i in range(3)]
+        self.cache.put(tokens[0], {'exp': self.clock.now + 60})
+        self.cache.put(tokens[1], {'exp': self.clock.now + 60})
+        self.cache.get(tokens[0])
+        self.cache.put(tokens[2], {'exp': self.clock.now + 60})
+
+        self.assertIsNotNone(self.cache.get(tokens[0]))
+        self.assertIsNone(self.cache.get(tokens[1]))
+
+    def test_entry_dropped_when_signing_key_is_rotated_out(self):
+        token = self.token()
+        self.cache.put(token, {'exp': self.clock.now + 60})
+        jwks_cache.fetcher = static_fetcher(make_jwks([OTHER_KEY]))
+        jwks_cache.refresh()
+
+        self.assertIsNone(self.cache.get(token))
+
+    def test_concurrent_access(self):
+        tokens = [self.token(sub=str(i)) for i in range(8)]
+        cache = VerifiedTokenCache(maxsize=4, clock=self.clock)
+
+        def worker(token):
+            for _ in range(200):
+                if cache.get(token) is None:
+                    cache.put(token, {'exp': self.clock.now + 60})
+
+        threads = [threading.Thread(target=worker, args=(token,))
+                   for token in tokens]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertLessEqual(len(cache), 4)
+        self.assertEqual(cache.hits + cache.misses, 8 * 200)
+
+
+class SignatureBackendTestCase(unittest.TestCase):
+    """This class represents the RS256 signature backends test case"""
+
+    def setUp(self):
+        token = mint_token(KEY[0], 'key-1')
+        signing_input, _, signature = token.rpartition('.')
+        self.signing_input = signing_input.encode('ascii')
+        self.signature = b64url_decode(signature)
+
+    def check_backend(self, name):
+        backend = get_signature_backend(name)
+        public_key = backend.load_key(KEY[1])
+
+        self.assertTrue(backend.verify(public_key, self.signing_input,
+                                       self.signature))
+        self.assertFalse(backend.verify(public_key, self.signing_input + b'x',
+                                        self.signature))
+        other_key = backend.load_key(OTHER_KEY[1])
+        self.assertFalse(backend.verify(other_key, self.signing_input,
+                                        self.signature))
+
+    def test_rsa_backend(self):
+        self.check_backend('rsa')
+
+    def test_jose_backend(self):
+        self.check_backend('jose')
+
+    @unittest.skipUnless(SIGNATURE_BACKENDS['cryptography'].available(),
+                         'cryptography is not installed')
+    def test_cryptography_backend(self):
+        self.check_backend('cryptography')
+
+    def test_rsa_backend_rejects_other_hash_algorithms(self):
+        import rsa
+        private_key = rsa.PrivateKey.load_pkcs1(KEY[0].encode('ascii'))
+        signature = rsa.sign(self.signing_input, private_key, 'SHA-1')
+        backend = get_signature_backend('rsa')
+
+        self.assertFalse(backend.verify(backend.load_key(KEY[1]),
+                                        self.signing_input, signature))
+
+    def test_fastest_available_backend_selected(self):
+        expected = 'cryptography' \
+            if SIGNATURE_BACKENDS['cryptography'].available() else 'rsa'
+        self.assertEqual(get_signature_backend().name, expected)
+
+    def test_unknown_backend_rejected(self):
+        with self.assertRaises(ValueError):
+            get_signature_backend('openssl-cli')
+
+    def test_tampered_payload_rejected(self):
+        jwks_cache.clear()
+        jwks_cache.fetcher = static_fetcher(make_jwks([KEY]))
+        try:
+            header, payload, signature = \
+                mint_token(KEY[0], 'key-1').split('.')
+            claims = json.loads(b64url_decode(payload))
+            claims['permissions'] = ['delete:movies']
+            payload = base64.urlsafe_b64encode(
+                json.dumps(claims).encode()).rstrip(b'=').decode()
+
+            with self.assertRaises(AuthError) as context:
+                verify_decode_jwt('.'.join([header, payload, signature]))
+            self.assertEqual(context.exception.status_code, 400)
+        finally:
+            jwks_cache.clear()
+            jwks_cache.fetcher = fetch_jwks
+
+
+class TokenPrevalidationTestCase(unittest.TestCase):
+    """This class represents the structural token checks test case"""
+
+    def setUp(self):
+        jwks_cache.clear()
+        jwks_cache.fetcher = static_fetcher(make_jwks([KEY]))
+        self.token = mint_token(KEY[0], 'key-1')
+
+    def tearDown(self):
+        jwks_cache.clear()
+        jwks_cache.fetcher = fetch_jwks
+
+    def assertMalformed(self, token):
+        with mock.patch('jose.jwt.decode') as decode:
+            with self.assertRaises(AuthError) as context:
+                verify_decode_jwt(token)
+        self.assertEqual(context.exception.status_code, 401)
+        self.assertEqual(context.exception.error['description'],
+                         'Authorization malformed')
+        decode.assert_not_called()
+
+    def test_valid_token_passes(self):
+        header, rsa_key = prevalidate_token(self.token)
+
+        self.assertEqual(header['kid'], 'key-1')
+        self.assertEqual(rsa_key['kid'], 'key-1')
+
+    def test_wrong_segment_count_rejected(self):
+        self.assertMalformed('garbage')
+        self.assertMalformed(self.token.rsplit('.', 1)[0])
+        self.assertMalformed(self.token + '.extra')
+
+    def test_non_base64url_characters_rejected(self):
+        self.assertMalformed(self.token.replace('.', '.+', 1))
+
+    def test_undecodable_header_rejected(self):
+        self.assertMalformed('e30x.' + self.token.split('.', 1)[1])
+
+    def test_disallowed_alg_rejected(self):
+        header = base64.urlsafe_b64encode(
+            b'{"alg":"HS256","kid":"key-1"}').rstrip(b'=').decode()
+        self.assertMalformed(header + '.' + self.token.split('.', 1)[1])
+
+    def test_missing_kid_rejected(self):
+        header = base64.urlsafe_b64encode(
+            b'{"alg":"RS256"}').rstrip(b'=').decode()
+        self.assertMalformed(header + '.' + self.token.split('.', 1)[1])
+
+    def test_truncated_signature_rejected(self):
+        self.assertMalformed(self.token[:-4])
+
+    def test_unknown_kid_rejected_without_crypto(self):
+        token = mint_token(OTHER_KEY[0], 'key-2')
+        with mock.patch('jose.jwt.decode') as decode:
+            with self.assertRaises(AuthError) as context:
+                verify_decode_jwt(token)
+        self.assertEqual(context.exception.status_code, 400)
+        decode.assert_not_called()
+
+
+class RejectedTokenCacheTestCase(unittest.TestCase):
+    """This class represents the rejected token cache test case"""
+
+    def setUp(self):
+        jwks_cache.clear()
+        jwks_cache.fetcher = static_fetcher(make_jwks([KEY]))
+        token_cache.clear()
+        rejection_cache.clear()
+
+    def tearDown(self):
+        jwks_cache.clear()
+        jwks_cache.fetcher = fetch_jwks
+        token_cache.clear()
+        rejection_cache.clear()
+
+    def test_forged_token_verified_once(self):
+        # Signed with a key whose kid claims to be the Auth0 one
+        token = mint_token(OTHER_KEY[0], 'key-1')
+        with mock.patch('auth.verify_decode_jwt',
+                        wraps=auth.verify_decode_jwt) as verify:
+            for _ in range(3):
+                with self.assertRaises(AuthError) as context:
+                    authenticate_token(token)
+                self.assertEqual(context.exception.status_code, 400)
+
+        self.assertEqual(verify.call_count, 1)
+
+    def test_rejection_expires(self):
+        clock = FakeClock()
+        cache = RejectedTokenCache(ttl=30, clock=clock)
+        cache.put('token', AuthError({'code': 'Token_Expired'}, 401))
+        with self.assertRaises(AuthError):
+            cache.check('token')
+        clock.now += 30
+
+        cache.check('token')
+        self.assertEqual(len(cache), 0)
+
+    def test_server_errors_and_unknown_keys_not_cached(self):
+        cache = RejectedTokenCache()
+        cache.put('a', AuthError({'code': 'JWKS_Unavailable'}, 503))
+        cache.put('b', AuthError({'code': 'Unknown_Key'}, 400))
+
+        self.assertEqual(len(cache), 0)
+
+
+class RequiresAuthTestCase(unittest.TestCase):
+    """This class represents the requires_auth decorator test case"""
+
+    def setUp(self):
+        jwks_cache.clear()
+        jwks_cache.fetcher = static_fetcher(make_jwks([KEY]))
+        token_cache.clear()
+        self.app = Flask(__name__)
+
+        @self.app.route('/protected', methods=['POST'])
+        @requires_auth('post:movies')
+        def protected(payload):
+            return jsonify({'success': True, 'sub': payload['sub']})
+
+        @self.app.errorhandler(AuthError)
+        def authentication_problem(error):
+            return jsonify({'success': False}), error.status_code
+
+        self.client = self.app.test_client
+
+    def tearDown(self):
+        jwks_cache.clear()
+        jwks_cache.fetcher = fetch_jwks
+        token_cache.clear()
+
+    def post(self, token):
+        return self.client().post('/protected', headers={
+            'Authorization': 'Bearer ' + token
+        })
+
+    def test_repeated_token_verified_once(self):
+        token = mint_token(KEY[0], 'key-1', permissions=['post:movies'])
+        with mock.patch('auth.verify_decode_jwt',
+                        wraps=auth.verify_decode_jwt) as verify:
+            for _ in range(3):
+                res = self.post(token)
+                self.assertEqual(res.status_code, 200)
+
+        self.assertEqual(verify.call_count, 1)
+
+    def test_cached_token_still_checked_for_permission(self):
+        token = mint_token(KEY[0], 'key-1', permissions=['get:movies'])
+        self.assertEqual(self.post(token).status_code, 403)
+        self.assertEqual(len(token_cache), 1)
+        self.assertEqual(self.post(token).status_code, 403)
+
+
+
+class AuthTimingTestCase(unittest.TestCase):
+    """This class represents the requires_auth stage timing test case"""
+
+    def setUp(self):
+        jwks_cache.clear()
+        jwks_cache.fetcher = static_fetcher(make_jwks([KEY]))
+        token_cache.clear()
+        self.auth_timing = auth.AUTH_TIMING
+        self.token = mint_token(KEY[0], 'key-1', permissions=['post:movies'])
+
+    def tearDown(self):
+        jwks_cache.clear()
+        jwks_cache.fetcher = fetch_jwks
+        token_cache.clear()
+        auth.AUTH_TIMING = self.auth_timing
+
+    def make_client(self, enabled):
+        app = Flask(__name__)
+        app.config.update(JWKS_PREFETCH=False, JWKS_BACKGROUND_REFRESH=False,
+                          AUTH_TIMING=enabled)
+        setup_auth(app)
+
+        @app.route('/protected', methods=['POST'])
+        @requires_auth('post:movies')
+        def protected(payload):
+            return jsonify({'success': True})
+
+        return app.test_client()
+
+    def post(self, client):
+        return client.post('/protected', headers={
+            'Authorization': 'Bearer ' + self.token
+        })
+
+    def test_server_timing_lists_stages(self):
+        verify = registry.histogram('auth_verify_seconds')
+        count_before = verify.count
+        res = self.post(self.make_client(True))
+
+        stages = [entry.split(';')[0] for entry in
+                  res.headers['Server-Timing'].split(', ')]
+        self.assertEqual(stages, [
+            'auth-header', 'auth-cache', 'auth-parse', 'auth-jwks',
+            'auth-key', 'auth-verify', 'auth-claims', 'auth-permissions'
+        ])
+        self.assertEqual(verify.count, count_before + 1)
+        self.assertIn('auth_verify_seconds', registry.snapshot())
+
+    def test_cached_token_skips_verification_stages(self):
+        client = self.make_client(True)
+        self.post(client)
+        res = self.post(client)
+
+        self.assertEqual(res.headers['Server-Timing'].count('auth-'), 3)
+
+    def test_timing_disabled(self):
+        client = self.make_client(False)
+        with mock.patch('auth.StageTimer') as timer:
+            res = self.post(client)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Server-Timing', res.headers)
+        timer.assert_not_called()
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()